@@ -0,0 +1,148 @@
+from concurrent.futures import ThreadPoolExecutor
+from requests import RequestException, Response
+from requests.structures import CaseInsensitiveDict
+from CustomResponse import CustomResponse
+from CustomSession import LANGUAGES, URL_ROOT, accept_language, build_query
+from functools import partial
+from itertools import count
+from RetryScheduler import RetryScheduler
+import asyncio
+import instrumentation
+
+
+class AsyncSession:
+    """
+    Class for getting OECD resources from asyncio code (requires httpx, and h2 for HTTP/2):
+    - builds the url and the Accept header of each query as "CustomSession()" does, from the same list of arguments
+    - sends the requests through a single "httpx.AsyncClient", reusing its connections (HTTP/2 if available)
+    - retries the throttled and failed requests as scheduled by "retry", without blocking the event loop
+    - parses the responses in a worker pool, so the event loop is never blocked by the XML parsing
+    - negotiates the names' "languages" and the wire "format" as "CustomSession()" does
+    The responses are regular "CustomResponse()" objects, to be used with the extractors as is.
+    Used as an async context manager, or closed with "aclose()".
+    """
+
+    def __init__(
+        self,
+        url_root: str = URL_ROOT,
+        http2: bool = True,
+        max_connections: int = 20,
+        timeout: float = 60.0,
+        retry: RetryScheduler = None,
+        executor=None,
+        languages: tuple = LANGUAGES,
+        format: str = "xml",
+    ) -> None:
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError(
+                "The async session requires httpx: pip install httpx[http2]"
+            ) from None
+        try:
+            import h2
+        except ImportError:
+            http2 = False
+        self.url_root = url_root
+        self.languages = tuple(languages)
+        self.format = format
+        self.retry = retry if retry is not None else RetryScheduler()
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            headers={"Accept-Language": accept_language(self.languages)},
+        )
+        self.transport_errors = (httpx.TransportError,)
+        self.connect_errors = (httpx.ConnectError, httpx.ConnectTimeout)
+        """
+        Transport errors failing to connect (retried at most "RetryScheduler.max_connect_retries" times).
+        """
+        self.executor = executor if executor is not None else ThreadPoolExecutor()
+        """
+        Worker pool the responses are parsed in (a thread pool by default).
+        """
+        self.own_executor = executor is None
+
+    async def send(self, url: str, headers: dict):
+        """
+        Sends the request, retrying it as long as needed and allowed, as "RetryScheduler.send()" does
+        (through "RetryScheduler.schedule()"), but waiting without blocking the event loop.
+        Returns the last response received, or raises the last transport error.
+        """
+        retry = self.retry
+        for attempt in count():
+            if retry.limiter is not None:
+                await asyncio.to_thread(retry.throttle)
+            else:
+                retry.throttle()
+            try:
+                response = await self.client.get(url, headers=headers)
+            except self.transport_errors as e:
+                delay = retry.schedule(
+                    attempt, error=e, connect=isinstance(e, self.connect_errors)
+                )
+                if delay is None:
+                    raise
+            else:
+                delay = retry.schedule(attempt, response)
+                if delay is None:
+                    return response
+            await asyncio.sleep(delay)
+
+    async def get(self, args: list, params=None) -> CustomResponse:
+        """
+        Gets the resource identified by the query's arguments (see "CustomSession()"),
+        and returns it parsed, as a "CustomResponse()".
+        Raises a "RequestException", carrying the response, if the endpoint could not serve it.
+        """
+        query = build_query(args, params, self.format)
+        url = "/".join([self.url_root, query["url_tail"]])
+        with instrumentation.span("request", url=url) as request:
+            response = await self.send(url, {"Accept": query["accept"]})
+            request["status"] = response.status_code
+            request["http_version"] = response.http_version
+        wrapped = Response()
+        wrapped.status_code = response.status_code
+        wrapped.reason = response.reason_phrase
+        wrapped.url = str(response.url)
+        wrapped.headers = CaseInsensitiveDict(response.headers)
+        wrapped.elapsed = response.elapsed
+        wrapped._content = response.content
+        if response.status_code != 200:
+            raise RequestException(
+                f"Something went wrong! Status code: <{response.status_code}>",
+                response=wrapped,
+            )
+        instrumentation.count("bytes_decoded", len(response.content))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(CustomResponse, wrapped, languages=self.languages)
+        )
+
+    async def gather(self, queries: list, return_exceptions: bool = False) -> list:
+        """
+        Gets the resources of many queries (lists of arguments) concurrently, over the shared connections.
+        Returns the responses in the order of the queries (with "return_exceptions", the failed queries' exceptions
+        in place of their responses).
+        """
+        return await asyncio.gather(
+            *(self.get(args) for args in queries),
+            return_exceptions=return_exceptions,
+        )
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+        if self.own_executor:
+            self.executor.shutdown(wait=False)
+        else:
+            pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.aclose()
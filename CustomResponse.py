@@ -1,7 +1,69 @@
+import io
 import re
+from itertools import islice
 from requests import Response
-from xml.etree import ElementTree as ET
+from requests.exceptions import StreamConsumedError
 from xml.etree.ElementTree import Element
+import instrumentation
+import os
+import parsers
+import spooling
+
+EXTRACTED_TAGS = {
+    "Dataflow": "structure",
+    "Structure": "structure",
+    "Codelist": "structure",
+    "Code": "structure",
+    "Parent": "structure",
+    "Name": "common",
+}
+"""
+Tags looked up by the extractors, with the description of the namespace they belong to.
+"""
+
+PATHS = {
+    "names": "{Name}",
+    "structure": "{Structure}",
+    "codes": "{Code}",
+    "parent": "{Parent}",
+    "reference": "Ref",
+}
+"""
+Paths run by the extractors under each artefact, by name, to be formatted with the qualified tags
+(e.g. the names of an artefact or code, in all languages, its codes, its parent code, a reference).
+"""
+
+LANGUAGES = ("en",)
+"""
+Languages of the names extracted by default, in order of preference.
+"""
+
+SPACES = re.compile(" +")
+"""
+Runs of spaces, collapsed in the text of the outputted nodes.
+"""
+
+FORMATS = {"+csv": "csv", "+json": "json", "/csv": "csv", "/json": "json"}
+"""
+Wire formats other than XML, by the suffix/subtype of their media type (e.g. "application/vnd.sdmx.data+csv").
+"""
+
+
+def wire_format(content_type: str) -> str:
+    """
+    The wire format of a response ("xml", "csv" or "json"), from its "Content-Type" header.
+    """
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    for suffix, name in FORMATS.items():
+        if media_type.endswith(suffix):
+            return name
+    return "xml"
+
+
+OUTPUT_BUFFER_SIZE = 1 << 20
+"""
+Size of the write buffer of the output files, in bytes.
+"""
 
 
 class CustomResponse(Response):
@@ -10,44 +72,125 @@ class CustomResponse(Response):
     Inherits from "requests.Response()".
     """
 
-    def __init__(self, response: Response) -> None:
+    def __init__(
+        self,
+        response: Response,
+        stream: bool = False,
+        parser: str = None,
+        languages: tuple = LANGUAGES,
+        format: str = None,
+        spool: str = None,
+    ) -> None:
         super().__init__()
         self.__dict__.update(response.__dict__)
-        self.hierarchy = self.get_xml_hierarchy()
+        self.parser = parsers.backend(parser)
+        """
+        The parser backend (see "parsers"): lxml if installed, the standard library otherwise.
+        """
+        self.languages = tuple(languages)
+        """
+        Languages of the names extracted by default, in order of preference (those the response was requested in).
+        """
+        self.format = format or wire_format(self.headers.get("Content-Type", ""))
+        """
+        Wire format of the body: "xml" (SDMX-ML), "csv" (SDMX-CSV) or "json" (SDMX-JSON), by default from its
+        "Content-Type". Only XML bodies are parsed into a tree; the others are decoded by the extractors
+        (see "decoders").
+        """
+        self.spool = spool
+        """
+        Path of the file the body was spooled to, if any (see "spooling"): the body is then parsed incrementally,
+        from a memory map of the file, as many times as needed.
+        """
+        self.streaming = stream or spool is not None
+        """
+        Whether the XML response is parsed incrementally from the raw stream (or the spool file), instead of as a whole.
+        A streamed response can be consumed only once, a spooled one any number of times.
+        """
+        self.cache_key = None
+        """
+        Key and body digest of the cache entry the response was built from/stored in, if any.
+        """
+        self.cache_digest = None
+        self.prefixes = {}
+        """
+        Two-way namespace index, built from the namespace declarations as they are parsed:
+        - "prefixes" maps each declared prefix to its namespace
+        - "namespace_prefixes" maps each namespace to its prefix
+        - "descriptions" maps each SDMX namespace to its description
+        - "description_namespaces" maps each description to its SDMX namespace
+        """
+        self.namespace_prefixes = {}
+        self.descriptions = {}
+        self.description_namespaces = {}
+        self.tags = {}
+        """
+        The qualified(Clark notation) names of the tags looked up by the extractors, by local name.
         """
-        The XML response as an element tree.
+        self.paths = {}
         """
-        self.namespaces = self.get_namespaces()
+        The compiled paths of the extractors, by name (see "path()").
         """
-        The namespaces prefixing the node tags in the element tree.
+        self.labels = {}
         """
+        The display form of each tag outputted so far (see "label()").
+        """
+        if self.streaming:
+            self.hierarchy = None
+            self.namespaces = []
+            self.stream_consumed = False
+        elif self.format != "xml":
+            self.hierarchy = None
+            self.namespaces = []
+        else:
+            self.hierarchy = self.get_xml_hierarchy()
+            """
+            The XML response as an element tree.
+            """
+            self.namespaces = self.get_namespaces()
+            """
+            The namespaces declared in the response.
+            (in streaming mode, filled in as they are parsed)
+            """
 
     def detail(self) -> None:
         """
-        Prints relevant response information.
+        Reports relevant response information, as status messages (see "instrumentation.message()").
         """
         indent = " " * 4
-        print("\nResponse details: ")
-        print(indent + f"- Code: {self.status_code}\t")
-        print(indent + "- Headers: ")
+        instrumentation.message("\nResponse details: ")
+        instrumentation.message(indent + f"- Code: {self.status_code}\t")
+        instrumentation.message(indent + "- Headers: ")
         indent *= 2
         for key, val in self.headers.items():
-            print(indent + "-> " + key, ":", val)
+            instrumentation.message(f"{indent}-> {key} : {val}")
         return
 
+    def index_namespace(self, prefix: str, uri: str) -> None:
+        """
+        Adds a namespace declaration to the namespace index, and qualifies the extracted tags belonging to it.
+        """
+        namespace = "{" + uri + "}"
+        self.prefixes[prefix] = namespace
+        self.namespace_prefixes.setdefault(namespace, prefix)
+        if namespace not in self.descriptions:
+            if description := re.search(r"/v2_1/(.+)}$", namespace):
+                description = description.group(1)
+                self.descriptions[namespace] = description
+                self.description_namespaces.setdefault(description, namespace)
+                for tag, tag_description in EXTRACTED_TAGS.items():
+                    if tag_description == description:
+                        self.tags[tag] = namespace + tag
+                    else:
+                        pass
+            else:
+                pass
+
     def get_namespaces(self) -> list:
         """
-        Finds all the namespaces prefixing the node tags.
+        Lists all the namespaces declared in the response, in order of declaration.
         """
-        namespaces = []
-        for element in self.hierarchy.iter():
-            if namespace := re.search(r"^({.+})", element.tag):
-                namespace = namespace.group(1)
-                if namespace not in namespaces:
-                    namespaces.append(namespace)
-                else:
-                    pass
-        return namespaces
+        return list(self.namespace_prefixes)
 
     def get_namespace_descriptions(self) -> list:
         """
@@ -55,107 +198,303 @@ class CustomResponse(Response):
         - the description as key
         - the namespace as value
         """
-        namespace_descriptions = []
-        for namespace in self.namespaces:
-            namespace_descriptions.append(
-                {
-                    "description": re.search(r"/v2_1/(.+)}$", namespace).group(1),
-                    "namespace": namespace,
-                }
-            )
-        return namespace_descriptions
+        return [
+            {"description": description, "namespace": namespace}
+            for namespace, description in self.descriptions.items()
+        ]
 
     def find_description(self, namespace: str) -> str:
         """
-        Iterates through the list of descriptions and finds the description corresponding to the namespace.
+        Looks up the description corresponding to the namespace, in the namespace index.
         """
-        description = ""
-        for d in self.get_namespace_descriptions():
-            if d["namespace"] == namespace:
-                description = d["description"]
-                break
-            else:
-                pass
-        return description
+        return self.descriptions.get(namespace, "")
 
     def find_namespace(self, description: str) -> str:
         """
-        Iterates through the list of descriptions and finds the namespace corresponding to the description.
+        Looks up the namespace corresponding to the description, in the namespace index.
         """
-        for d in self.get_namespace_descriptions():
-            if d["description"] == description:
-                namespace = d["namespace"]
-                break
-            else:
-                pass
-        return namespace
+        return self.description_namespaces[description]
 
     def print_namespaces(self) -> None:
         """
-        Prints the namespaces.
+        Reports the namespaces, as status messages (see "instrumentation.message()").
         """
-        print("\nXPath namespaces: ")
+        instrumentation.message("\nXPath namespaces: ")
         for name in self.namespaces:
-            print("-> " + name)
-        print("\n")
+            instrumentation.message("-> " + name)
+        instrumentation.message("\n")
+
+    def path(self, name: str):
+        """
+        Returns the compiled path of the given name (see "PATHS"): a callable returning the matching elements
+        under an element. Compiled once per backend, and looked up once per response.
+        """
+        compiled = self.paths.get(name)
+        if compiled is None:
+            compiled = self.paths[name] = self.parser.path(
+                PATHS[name].format(**self.tags)
+            )
+        return compiled
+
+    def parse_tree(self) -> Element:
+        """
+        Parses the XML response with the parser backend, indexing its namespaces, and returns the root element.
+        """
+        events = self.parser.iterparse(io.BytesIO(self.content), ("start-ns",))
+        for _, (prefix, uri) in events:
+            self.index_namespace(prefix or "", uri)
+        return events.root
 
     def get_xml_hierarchy(self) -> Element:
         """
         Parses the XML response and returns it's tree structure.
+        A document deeper than lxml allows (see "parsers.too_deep()") is parsed with the stdlib backend instead.
         """
-        root = ET.fromstring(self.content)
+        with instrumentation.span("parse", bytes=len(self.content)) as parse:
+            try:
+                root = self.parse_tree()
+            except Exception as e:
+                if not parsers.too_deep(e):
+                    raise
+                self.parser = parsers.backend("stdlib")
+                root = self.parse_tree()
+            parse["namespaces"] = len(self.namespace_prefixes)
+        if instrumentation.enabled():
+            instrumentation.count("elements", sum(1 for _ in root.iter()))
         return root
 
-    def printable_hierarchy(self, element=None, level=0) -> list:
+    @classmethod
+    def from_spool(cls, path: str, languages: tuple = LANGUAGES):
         """
-        Prepares the tree structured response to be outputted:
-        - navigates the tree by recursion
-        - takes into account the hierarchy level each node finds itself in
-        - extracts and prettyfies the contents: tags, attributes, text
-        - prepares a list with the individual nodes of the tree as elements
-        - the order of the nodes in the list is hierarchical
+        Rebuilds a response from a kept spool file (see "CustomSession.get()"), e.g. to extract again a body
+        downloaded by a previous run, without downloading it again. The wire format is read from the file's extension.
+        """
+        response = Response()
+        response.status_code = 200
+        response.url = path
+        return cls(
+            response,
+            languages=languages,
+            format=os.path.splitext(path)[1].lstrip(".") or None,
+            spool=path,
+        )
+
+    @property
+    def content(self) -> bytes:
+        """
+        The body. A spooled body is read from its file: use "body()" to read it without holding it in memory.
+        """
+        if self.spool is not None:
+            with open(self.spool, "rb") as file:
+                return file.read()
+        return super().content
+
+    def body(self):
+        """
+        The body as a binary file, for the parsers and decoders:
+        - the downloaded content
+        - the spool file, read through its memory map (see "spooling.MappedBody()"), as many times as needed
+        - the raw stream (decoded, e.g. gzip), which can be consumed only once
+        """
+        if self.spool is not None:
+            return spooling.MappedBody(self.spool)
+        elif not self.streaming:
+            return io.BytesIO(self.content)
+        if self.stream_consumed:
+            raise StreamConsumedError("The response stream has already been consumed")
+        self.stream_consumed = True
+        if hasattr(self.raw, "decode_content"):
+            self.raw.decode_content = True
+        return self.raw
+
+    def iterparse_stream(self, parser=None):
+        """
+        Parses the raw response stream incrementally, without building the whole element tree:
+        - collects the namespaces from the "start-ns" events
+        - yields the ("start"|"end", element) events, in document order
+        The caller is responsible for clearing the elements it has finished with.
+        The "stream_parse" span covers the whole parse, interleaved with the caller's work on the events.
+        A spooled response is parsed from its spool file, the memory map being released once the parse ends.
+        The events are parsed with the response's parser backend, unless another one is given.
+        """
+        source = self.body()
+        elements = 0
+        with instrumentation.span(
+            "stream_parse", spooled=self.spool is not None
+        ) as parse:
+            try:
+                for event, item in (parser or self.parser).iterparse(
+                    source, ("start-ns", "start", "end")
+                ):
+                    if event == "start-ns":
+                        self.index_namespace(item[0] or "", item[1])
+                        self.namespaces = self.get_namespaces()
+                    elif event == "end":
+                        elements += 1
+                        yield event, item
+                    else:
+                        yield event, item
+            finally:
+                if self.spool is not None:
+                    source.close()
+                else:
+                    pass
+                parse["namespaces"] = len(self.namespace_prefixes)
+                parse["elements"] = elements
+                instrumentation.count("elements", elements)
+
+    def iter_elements(self, *names: str):
+        """
+        Yields, one at a time and in document order, the outermost elements whose tag (stripped of the namespace)
+        is among "names": a match nested inside another match (e.g. "Obs" inside "Series") comes along with its ancestor.
+        In streaming mode:
+        - each element is yielded once it's fully parsed, then cleared and detached from its parent
+        - elements outside of any yielded element are discarded as soon as they are parsed
+        so the memory held stays bounded by the largest yielded element, whatever the size of the response.
+        Only XML responses have elements: the others are decoded by the extractors (see "decoders").
+        """
+        if self.format != "xml":
+            raise ValueError(f"Not an XML response: {self.format}")
+        elif not self.streaming:
+            stack = [self.hierarchy]
+            while stack:
+                element = stack.pop()
+                if element.tag.rpartition("}")[2] in names:
+                    yield element
+                else:
+                    stack.extend(reversed(element))
+            return
+        parents = []
+        matched = 0
+        for event, element in self.iterparse_stream():
+            if event == "start":
+                parents.append(element)
+                if element.tag.rpartition("}")[2] in names:
+                    matched += 1
+                else:
+                    pass
+            else:
+                parents.pop()
+                if element.tag.rpartition("}")[2] in names:
+                    matched -= 1
+                    if matched:
+                        continue
+                    yield element
+                elif matched:
+                    continue
+                element.clear()
+                if parents:
+                    parents[-1].remove(element)
+                else:
+                    pass
+
+    def label(self, tag: str) -> str:
+        """
+        Display form of a tag: its namespace replaced by the namespace's description (e.g. "-> (structure) Codelist").
+        Computed once per distinct tag.
+        """
+        label = self.labels.get(tag)
+        if label is None:
+            namespace, brace, local = tag.rpartition("}")
+            if brace:
+                label = f"-> ({self.find_description(namespace + brace)}) {local}"
+            else:
+                label = tag
+            self.labels[tag] = label
+        return label
+
+    def printable_node(self, element: Element, level: int, tag: str = None) -> str:
+        """
+        Extracts and prettyfies the contents of a single node: tags, attributes, text.
+        The tag can be given in its display form (see "label()").
         """
-        if element is None:
-            element = self.hierarchy
-        to_display = []
         indent = (" " * 4) * level
-        tag = element.tag
-        if element.attrib.items():
+        if tag is None:
+            tag = element.tag
+        if element.attrib:
             attributes = ", ".join(
-                f'{re.sub(r"^({.+})", "", k)}="{v}"' for k, v in element.attrib.items()
+                f'{k.rpartition("}")[2]}="{v}"' for k, v in element.attrib.items()
             )
         else:
             attributes = "None"
         if element.text is not None:
             text = element.text.replace("\n", "").replace("\r", "")
-            text = re.sub(" +", " ", text)
+            text = SPACES.sub(" ", text)
         else:
             text = "None"
-        node = f"{indent}{tag} [Attributes: {attributes}]: {text}"
-        to_display.append(node)
-        for child in element:
-            to_display.extend(self.printable_hierarchy(child, level + 1))
-        return to_display
-
-    def output_hierarchy(self, rng=None) -> None:
-        """
-        Further prettyfies the response and writes it to an output file.
-        """
-        namespaces = self.namespaces
-        printable = self.printable_hierarchy()
-        for i in range(len(printable)):
-            for n in namespaces:
-                if printable[i].strip().startswith(n):
-                    description = self.find_description(n)
-                    printable[i] = re.sub(n, f"-> ({description}) ", printable[i])
-                    break
+        return f"{indent}{tag} [Attributes: {attributes}]: {text}"
+
+    def iter_nodes(self, element=None, level=0):
+        """
+        Yields the (node, hierarchy level) pairs of the tree, in hierarchical (document) order, without recursion.
+        In streaming mode, the nodes are yielded as they are parsed:
+        - a node is yielded when its first child starts (or when it ends), once its text is known
+        - each node is cleared and detached from its parent once it ends
+        - the nodes are parsed with the stdlib backend, which has no limit on the depth of the documents
+          (the stream can't be parsed again if lxml stopped on it, see "parsers.too_deep()")
+        """
+        if not self.streaming:
+            stack = [(self.hierarchy if element is None else element, level)]
+            while stack:
+                element, level = stack.pop()
+                yield element, level
+                stack.extend((child, level + 1) for child in reversed(element))
+            return
+        pending = []
+        for event, element in self.iterparse_stream(parsers.backend("stdlib")):
+            if event == "start":
+                if pending and not pending[-1][2]:
+                    parent = pending[-1]
+                    yield parent[0], parent[1]
+                    parent[2] = True
                 else:
                     pass
-        with open("hierarchy.txt", "w") as file:
-            file.write("XPath resource hierarchy:" + "\n" + "=" * 50 + "\n")
-            if rng == None:
-                for i in printable:
-                    file.write(i + "\n")
+                pending.append([element, len(pending), False])
             else:
-                for i in printable[:rng]:
-                    file.write(i + "\n")
+                node = pending.pop()
+                if not node[2]:
+                    yield element, node[1]
+                else:
+                    pass
+                element.clear()
+                if pending:
+                    pending[-1][0].remove(element)
+                else:
+                    pass
+
+    def printable_hierarchy(self, element=None, level=0) -> list:
+        """
+        Prepares the tree structured response to be outputted:
+        - navigates the tree iteratively (see "iter_nodes()")
+        - takes into account the hierarchy level each node finds itself in
+        - extracts and prettyfies the contents: tags, attributes, text
+        - prepares a list with the individual nodes of the tree as elements
+        - the order of the nodes in the list is hierarchical
+        """
+        return [
+            self.printable_node(node, node_level)
+            for node, node_level in self.iter_nodes(element, level)
+        ]
+
+    def stream_printable_hierarchy(self):
+        """
+        Streaming counterpart of "printable_hierarchy()": yields the nodes in the same hierarchical order, as they are parsed.
+        """
+        for node, level in self.iter_nodes():
+            yield self.printable_node(node, level)
+
+    def output_hierarchy(self, rng=None, path: str = "hierarchy.txt") -> None:
+        """
+        Further prettyfies the response and writes it to an output file (by default hierarchy.txt):
+        - the nodes are written one at a time, through a buffered writer, without building the whole output
+        - the namespace of each tag is replaced by its description, looked up once per distinct tag
+        - the tree walk stops after "rng" nodes (in streaming mode, so does parsing)
+        """
+        with instrumentation.span("write", path=path) as write:
+            with open(path, "w", buffering=OUTPUT_BUFFER_SIZE) as file:
+                file.write("XPath resource hierarchy:" + "\n" + "=" * 50 + "\n")
+                file.writelines(
+                    self.printable_node(node, level, self.label(node.tag)) + "\n"
+                    for node, level in islice(self.iter_nodes(), rng)
+                )
+                write["bytes"] = file.tell()
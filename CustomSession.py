@@ -1,26 +1,225 @@
-from requests import Session, RequestException
-from CustomResponse import CustomResponse
+from requests import Response, Session, RequestException
+from requests.structures import CaseInsensitiveDict
+from CustomResponse import CustomResponse, LANGUAGES, wire_format
+from RetryScheduler import RetryScheduler
+from functools import partial
+from urllib3.exceptions import HTTPError
+import chunking
+import instrumentation
+import io
+import os
+import spooling
+import tempfile
+
+URL_ROOT = "https://sdmx.oecd.org/public/rest/v2"
+"""
+leading string of the url for identifying any resource, using the OECD endpoint
+"""
+
+STRUCTURE_SEGMENTS = ("agency_id", "resource_id", "version", "item_id")
+"""
+Optional path segments identifying structural metadata, after the artefact type (SDMX REST v2):
+structure/{artefact_type}/{agency_id}/{resource_id}/{version}/{item_id}
+"""
+
+STRUCTURE_PARAMETERS = {
+    "detail": (
+        "full",
+        "allstubs",
+        "referencestubs",
+        "allcompletestubs",
+        "referencecompletestubs",
+        "referencepartial",
+        "raw",
+    ),
+    "references": (
+        "none",
+        "parents",
+        "parentsandsiblings",
+        "ancestors",
+        "children",
+        "descendants",
+        "all",
+    ),
+}
+"""
+Query parameters of structure queries, with their allowed values ("references" also takes an artefact type).
+"""
+
+
+def structure_url_tail(artefact_type: str, segments=(), parameters=None) -> str:
+    """
+    Builds the trailing string of the url identifying structural metadata:
+    - the artefact type, followed by the given path segments (agency, resource id, version, item id)
+    - the "detail"/"references" query parameters, as a dictionary or a query string
+    Trailing segments left out default to all ("*") or, for the version, to the latest ("~").
+    """
+    segments = list(segments)
+    if len(segments) > len(STRUCTURE_SEGMENTS):
+        raise RequestException(
+            f"Structure queries take at most {len(STRUCTURE_SEGMENTS)} path segments: {STRUCTURE_SEGMENTS}"
+        )
+    if isinstance(parameters, str):
+        parameters = dict(p.split("=", 1) for p in parameters.split("&") if "=" in p)
+    parameters = parameters or {}
+    for name, value in parameters.items():
+        if name not in STRUCTURE_PARAMETERS:
+            raise RequestException(
+                f'"{name}" not in {tuple(STRUCTURE_PARAMETERS)} structure query parameters'
+            )
+        elif name == "detail" and value not in STRUCTURE_PARAMETERS["detail"]:
+            raise RequestException(
+                f'"{value}" not in {STRUCTURE_PARAMETERS["detail"]} details'
+            )
+        else:
+            pass
+    url_tail = "/".join(["structure", artefact_type] + segments)
+    if parameters:
+        url_tail += "?" + "&".join(f"{k}={v}" for k, v in parameters.items())
+    return url_tail
+
+
+MEDIA_TYPES = {
+    "structure": {
+        "xml": "application/vnd.sdmx.structure+xml; charset=utf-8; version=2.1",
+        "json": "application/vnd.sdmx.structure+json; charset=utf-8; version=2.0.0",
+    },
+    "data": {
+        "xml": "application/vnd.sdmx.structurespecificdata+xml; charset=utf-8; version=2.1",
+        "csv": "application/vnd.sdmx.data+csv; charset=utf-8; version=2.0.0",
+        "json": "application/vnd.sdmx.data+json; charset=utf-8; version=2.0.0",
+    },
+}
+"""
+Media types the responses can be negotiated in, by query type and wire format:
+SDMX-ML (XML), SDMX-CSV (data only) and SDMX-JSON.
+"""
+
+ACCEPT = {query_type: formats["xml"] for query_type, formats in MEDIA_TYPES.items()}
+"""
+Accepted media type of the responses, by query type (SDMX-ML, unless another format is asked for).
+"""
+
+
+def range_start(response: Response):
+    """
+    First byte position of a partial response's "Content-Range" ("bytes start-end/length"), or None.
+    """
+    unit, _, positions = response.headers.get("Content-Range", "").partition(" ")
+    start = positions.split("-")[0]
+    return int(start) if unit == "bytes" and start.isdigit() else None
+
+
+def accept_language(languages) -> str:
+    """
+    Builds the "Accept-Language" header asking for the names in the given languages, in order of preference
+    (e.g. "fr, en;q=0.9" for ("fr", "en")).
+    """
+    return ", ".join(
+        language if i == 0 else f"{language};q={max(10 - i, 1) / 10}"
+        for i, language in enumerate(languages)
+    )
+
+
+def media_type(query_type: str, format: str = "xml") -> str:
+    """
+    The media type of the responses to a query type, in a wire format ("xml", "csv" or "json").
+    Raises a "RequestException" for an unknown query type, or a format it can't be answered in.
+    """
+    if query_type not in MEDIA_TYPES:
+        raise RequestException(f'"{query_type}" not in {MEDIA_TYPES.keys()}')
+    elif format not in MEDIA_TYPES[query_type]:
+        raise RequestException(
+            f'"{format}" not in {tuple(MEDIA_TYPES[query_type])} {query_type} formats'
+        )
+    else:
+        return MEDIA_TYPES[query_type][format]
+
+
+def build_query(args: list, params=None, format: str = "xml") -> dict:
+    """
+    Builds a query from its list of arguments (see "CustomSession()"):
+    - "query_type": "structure" or "data"
+    - "artefact_type" (structure queries) or "data_query" (data queries: the arguments identifying the resource)
+    - "accept": the media type of the response, in the wire "format"
+    - "url_tail": the trailing string of the url, identifying the resource
+    Raises a "RequestException" for an unknown query type or format, or invalid structure query arguments.
+    """
+    query_type = args[0]
+    query = {"query_type": query_type, "accept": media_type(query_type, format)}
+    if query_type == "structure":
+        query["artefact_type"] = args[1]
+        segments = [a for a in args[2:] if "=" not in a]
+        parameters = "&".join(a for a in args[2:] if "=" in a)
+        query["url_tail"] = structure_url_tail(args[1], segments, parameters or params)
+    else:
+        context, agency_id, dataflow_id, dataflow_version = args[1:5]
+        filter_expression, optional_parameters = args[5:7]
+        query["data_query"] = list(args[1:7])
+        query["url_tail"] = (
+            f"{query_type}/{context}/{agency_id}/{dataflow_id}/{dataflow_version}"
+            f"/{filter_expression}?{optional_parameters}"
+        )
+    return query
 
 
 class CustomSession(Session):
     """
     Class for managing API sessions getting OECD resources (building the api, sending request).
     Inherits from "requests.Session".
+    Takes the query as a list of arguments (otherwise asks for it interactively):
+    * ["structure", artefact_type, (agency_id, resource_id, version, item_id), ("detail=...&references=...")]
+    * ["data", context, agency_id, dataflow_id, dataflow_version, filter_expression, optional_parameters]
     """
 
-    def __init__(self, args=None) -> None:
+    def __init__(
+        self,
+        args=None,
+        cache=None,
+        url_root: str = URL_ROOT,
+        retry=None,
+        params=None,
+        languages: tuple = LANGUAGES,
+        format: str = "xml",
+    ) -> None:
         super().__init__()
+        self.url_root = url_root
+        self.data_query = None
+        """
+        For data queries, the arguments identifying the resource:
+        [context, agency_id, dataflow_id, dataflow_version, filter_expression, optional_parameters]
+        """
+        self.cache = cache
+        """
+        Optional "ResponseCache()" the responses are served from/stored in.
+        """
+        self.params = params
+        """
+        For structure queries, optional "detail"/"references" query parameters.
+        """
+        self.retry = retry if retry is not None else RetryScheduler()
+        """
+        "RetryScheduler()" retrying the requests throttled or failed by the endpoint
+        (can be shared between sessions, along with its rate limiter and metrics).
+        """
+
+        self.languages = tuple(languages)
+        """
+        Languages of the names to extract, in order of preference: negotiated with "Accept-Language",
+        and extracted from the responses by default (see "standalone_functions.iter_dataflows()").
+        """
+        self.format = format
+        """
+        Wire format the responses are negotiated in: "xml" (SDMX-ML), "csv" (SDMX-CSV, data only) or "json" (SDMX-JSON).
+        The extractors give the same outputs whatever the format (see "decoders").
+        """
 
         self.headers = {
-            "Accept": "application/vnd.sdmx.structure+xml; charset=utf-8; version=2.1",
-            "Accept-Language": "en",
+            "Accept": ACCEPT["structure"],
+            "Accept-Language": accept_language(self.languages),
             "Accept-Encoding": "gzip, deflate, br",
         }
         query_types = {"1": "structure", "2": "data"}
-        url_root = "https://sdmx.oecd.org/public/rest/v2"
-        """
-        leading string of the url for identifying any resource, using the OECD endpoint
-        """
 
         if args is None:
             query_type = input(
@@ -39,15 +238,22 @@ class CustomSession(Session):
                     break
             url_tail = ""
             if self.query_type == "structure":
-                self.headers["Accept"] = (
-                    "application/vnd.sdmx.structure+xml; charset=utf-8; version=2.1"
-                )
+                self.headers["Accept"] = media_type("structure", self.format)
                 self.artefact_type = input(f"Input the artefact type: ")
-                url_tail = f"{self.query_type}/{self.artefact_type}"
-            elif self.query_type == "data":
-                self.headers["Accept"] = (
-                    "application/vnd.sdmx.structurespecificdata+xml; charset=utf-8; version=2.1"
+                segments = []
+                for segment in STRUCTURE_SEGMENTS:
+                    value = input(f"Input the {segment} (optional, Enter to skip): ")
+                    if value == "":
+                        break
+                    segments.append(value)
+                parameters = input(
+                    'Input the optional parameters \n("detail" and "references", Enter to skip): '
                 )
+                url_tail = structure_url_tail(
+                    self.artefact_type, segments, parameters or self.params
+                )
+            elif self.query_type == "data":
+                self.headers["Accept"] = media_type("data", self.format)
                 context = input("\nInput the context: ")
                 agency_id = input("Input the agency identifier: ")
                 dataflow_id = input("Input the dataflow identifier: ")
@@ -58,6 +264,14 @@ class CustomSession(Session):
                 optional_parameters = input(
                     'Input the optional parameters \n(dimension value "Time Period", attributes and measures): '
                 )
+                self.data_query = [
+                    context,
+                    agency_id,
+                    dataflow_id,
+                    dataflow_version,
+                    filter_expression,
+                    optional_parameters,
+                ]
                 url_tail = f"{self.query_type}/{context}/{agency_id}/{dataflow_id}/{dataflow_version}/{filter_expression}?{optional_parameters}"
                 """
                 trailing string of the url for identifying a specific resource
@@ -66,46 +280,303 @@ class CustomSession(Session):
             return
 
         else:
-            query_type = args[0]
-            if query_type not in query_types.values():
-                raise RequestException(f'"{query_type}" not in {query_types.values()}')
+            query = build_query(args, self.params, self.format)
+            self.query_type = query["query_type"]
+            self.headers["Accept"] = query["accept"]
+            if self.query_type == "structure":
+                self.artefact_type = query["artefact_type"]
             else:
-                self.query_type = query_type
-                if self.query_type == "structure":
-                    self.headers["Accept"] = (
-                        "application/vnd.sdmx.structure+xml; charset=utf-8; version=2.1"
-                    )
-                    self.artefact_type = args[1]
-                    url_tail = f"{self.query_type}/{self.artefact_type}"
-                elif self.query_type == "data":
-                    self.headers["Accept"] = (
-                        "application/vnd.sdmx.structurespecificdata+xml; charset=utf-8; version=2.1"
-                    )
-                    context = args[1]
-                    agency_id = args[2]
-                    dataflow_id = args[3]
-                    dataflow_version = args[4]
-                    filter_expression = args[5]
-                    optional_parameters = args[6]
-                    url_tail = f"{self.query_type}/{context}/{agency_id}/{dataflow_id}/{dataflow_version}/{filter_expression}?{optional_parameters}"
-                    """
-                    trailing string of the url for identifying a specific resource
-                    """
-                self.url = "/".join([url_root, url_tail])
-                return
-
-    def get(self) -> CustomResponse:
+                self.data_query = query["data_query"]
+            self.url = "/".join([url_root, query["url_tail"]])
+            return
+
+    def get(self, stream: bool = False, spool: str = None) -> CustomResponse:
         """
         Overwritten "get" method, inherited from "requests.Session".
         Instead of a regular "requests.Response", instantiates and returns a "CustomResponse()" object.
+        The stages are instrumented (see "instrumentation"): "request" (up to the response headers,
+        connection setup included), "download" (body download and decoding), then the parsing.
+        With "stream", the body is not downloaded upfront, but parsed incrementally as it's consumed.
+        With "spool" (a directory, e.g. "tempfile.gettempdir()"), the body is downloaded to a spool file there
+        (see "spool_body()"), then parsed incrementally from it, as many times as needed: for bodies larger than memory.
+        The spool file is kept (see "CustomResponse.spool"), to be removed by the caller.
+        Throttled (429) and failed (5xx) requests are retried, as scheduled by "retry".
+        With a cache, fresh cached responses are served as is, and stale ones are revalidated:
+        only a modified resource is downloaded again (streamed and spooled responses are served, not stored).
         """
-        response = super().get(self.url, headers=self.headers)
-        if response.status_code != 200:
+        accept = self.headers["Accept"]
+        language = self.headers["Accept-Language"]
+        headers = self.headers
+        entry = None
+        if self.cache is not None:
+            entry = self.cache.lookup(self.url, accept, language)
+            if entry is not None and self.cache.is_fresh(entry):
+                instrumentation.count("cache_hits")
+                instrumentation.message("All good! Served from cache")
+                return self.cached_response(entry, stream)
+            elif entry is not None:
+                headers = {**self.headers, **self.cache.conditional_headers(entry)}
+            else:
+                pass
+        with instrumentation.span("request", url=self.url) as request:
+            response = self.retry.send(
+                partial(super().get, self.url, headers=headers, stream=True)
+            )
+            request["status"] = response.status_code
+            request["time_to_first_byte"] = response.elapsed.total_seconds()
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            self.cache.refresh(entry, response)
+            instrumentation.count("cache_revalidations")
+            instrumentation.message(
+                f"Not modified! Status code: <{response.status_code}>, served from cache"
+            )
+            return self.cached_response(entry, stream)
+        elif response.status_code != 200:
+            response.close()
             raise RequestException(
-                f"Something went wrong! Status code: <{response.status_code}>"
+                f"Something went wrong! Status code: <{response.status_code}>",
+                response=response,
             )
         else:
-            print(f"All good! Status code: <{response.status_code}>")
-            print("Processing the response...")
-            custom_response = CustomResponse(response)
+            instrumentation.message(f"All good! Status code: <{response.status_code}>")
+            instrumentation.message("Processing the response...")
+            path = None
+            if spool is not None:
+                path = self.spool_body(response, spool)
+            elif not stream:
+                self.download(response)
+            else:
+                pass
+            if self.cache is not None and not stream and path is None:
+                entry = self.cache.store(self.url, accept, response, language)
+            else:
+                entry = None
+            custom_response = CustomResponse(
+                response, stream=stream, languages=self.languages, spool=path
+            )
+            if entry is not None:
+                custom_response.cache_key = entry["key"]
+                custom_response.cache_digest = entry["digest"]
             return custom_response
+
+    def download(self, response: Response) -> bytes:
+        """
+        Downloads (and decodes, e.g. gzip) the whole body of a response, timing it as the "download" span,
+        with the bytes received on the wire and the bytes decoded.
+        """
+        encoding = response.headers.get("Content-Encoding", "identity")
+        with instrumentation.span("download", encoding=encoding) as download:
+            content = response.content
+            received = (
+                response.raw.tell() if hasattr(response.raw, "tell") else len(content)
+            )
+            download["bytes_received"] = received
+            download["bytes_decoded"] = len(content)
+        instrumentation.count("bytes_received", received)
+        instrumentation.count("bytes_decoded", len(content))
+        return content
+
+    def spool_body(self, response: Response, directory: str) -> str:
+        """
+        Downloads (and decodes, e.g. gzip) the whole body of a response to a spool file in the directory
+        (see "spooling.spool()"), in chunks of "spooling.SPOOL_CHUNK_SIZE", without holding it in memory.
+        Timed as the "download" span, as "download()" is. Returns the path of the spool file.
+        """
+        encoding = response.headers.get("Content-Encoding", "identity")
+        suffix = "." + wire_format(response.headers.get("Content-Type", ""))
+        with instrumentation.span(
+            "download", encoding=encoding, spooled=True
+        ) as download:
+            try:
+                path, decoded = spooling.spool(
+                    response.raw.stream(spooling.SPOOL_CHUNK_SIZE, decode_content=True),
+                    directory,
+                    suffix,
+                )
+                received = response.raw.tell()
+            finally:
+                response.close()
+            download["bytes_received"] = received
+            download["bytes_decoded"] = decoded
+        instrumentation.count("bytes_received", received)
+        instrumentation.count("bytes_decoded", decoded)
+        return path
+
+    def get_resumable(
+        self, ledger, job: str, directory: str, label: str = None
+    ) -> CustomResponse:
+        """
+        Fetches the resource as a checkpointed task of a job (see "JobLedger()"), spooled to a file in the directory:
+        - a task already downloaded is served from its spool file, without any request
+        - an interrupted download is resumed from where it stopped with a Range request, when the server allows it
+          and some of the body was received
+          (it sent "Accept-Ranges: bytes" and a validator, checked with "If-Range"); otherwise it's started over,
+          as it is when the server answers the Range request with a range starting elsewhere (416, or 206 from another byte)
+        - the body is downloaded as is (gzip/deflate, rather than brotli), and decoded once complete;
+          a body that doesn't decode (e.g. truncated) fails the download, kept to be resumed
+        Returns the spooled response (see "CustomResponse.spool"), or raises a "RequestException",
+        an interrupted download being kept to be resumed.
+        """
+        accept = self.headers["Accept"]
+        task = ledger.task(job, self.url, accept)
+        if (
+            task is not None
+            and task["status"] in ("downloaded", "done")
+            and os.path.exists(task["path"])
+        ):
+            instrumentation.count("tasks_skipped")
+            response = CustomResponse.from_spool(task["path"], self.languages)
+            response.url = self.url
+            return response
+        headers = {**self.headers, "Accept-Encoding": "gzip, deflate"}
+        offset = 0
+        if (
+            task is not None
+            and task["status"] == "partial"
+            and task["validator"]
+            and os.path.exists(task["path"])
+        ):
+            offset = os.path.getsize(task["path"])
+        else:
+            pass
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = task["validator"]
+        else:
+            pass
+        with instrumentation.span("request", url=self.url, offset=offset) as request:
+            response = self.retry.send(
+                partial(super().get, self.url, headers=headers, stream=True)
+            )
+            request["status"] = response.status_code
+        if offset and (
+            response.status_code == 416
+            or (response.status_code == 206 and range_start(response) != offset)
+        ):
+            response.close()
+            os.remove(task["path"])
+            ledger.update(job, self.url, accept, status="partial", validator=None)
+            return self.get_resumable(ledger, job, directory, label)
+        elif response.status_code == 206 and offset:
+            instrumentation.count("tasks_resumed")
+            path, mode = task["path"], "ab"
+            validator, encoding = task["validator"], task["encoding"]
+        elif response.status_code == 200:
+            encoding = response.headers.get("Content-Encoding", "identity")
+            if encoding not in ("identity", *spooling.CONTENT_ENCODINGS):
+                response.close()
+                raise RequestException(
+                    f"Unsupported content encoding: {encoding} (requested {headers['Accept-Encoding']})",
+                    response=response,
+                )
+            else:
+                pass
+            if (
+                task is not None
+                and task["status"] == "partial"
+                and task["path"]
+                and os.path.exists(task["path"])
+            ):
+                # The whole body is sent again: the interrupted download is discarded, not left behind
+                os.remove(task["path"])
+            else:
+                pass
+            offset = 0
+            suffix = "." + wire_format(response.headers.get("Content-Type", ""))
+            descriptor, path = tempfile.mkstemp(
+                suffix + ".part", spooling.SPOOL_PREFIX, directory
+            )
+            os.close(descriptor)
+            mode = "wb"
+            etag = response.headers.get("ETag", "")
+            validator = (
+                etag if etag and not etag.startswith("W/") else None
+            ) or response.headers.get("Last-Modified")
+            if response.headers.get("Accept-Ranges") != "bytes":
+                validator = None
+            else:
+                pass
+        else:
+            response.close()
+            raise RequestException(
+                f"Something went wrong! Status code: <{response.status_code}>",
+                response=response,
+            )
+        ledger.update(
+            job,
+            self.url,
+            accept,
+            label=label,
+            status="partial",
+            path=path,
+            validator=validator,
+            encoding=encoding,
+        )
+        received = 0
+        with instrumentation.span(
+            "download", encoding=encoding, resumed_from=offset
+        ) as download:
+            try:
+                with open(path, mode) as file:
+                    for chunk in response.raw.stream(
+                        spooling.SPOOL_CHUNK_SIZE, decode_content=False
+                    ):
+                        received += file.write(chunk)
+            except (HTTPError, OSError) as e:
+                raise RequestException(
+                    f"Download interrupted after {offset + received} bytes: {e}"
+                ) from e
+            finally:
+                response.close()
+                download["bytes_received"] = received
+            spool_path = path.removesuffix(".part")
+            try:
+                decoded, digest = spooling.decode(path, spool_path, encoding)
+            except ValueError as e:
+                raise RequestException(
+                    f"Download incomplete after {offset + received} bytes: {e}"
+                ) from e
+            download["bytes_decoded"] = decoded
+        instrumentation.count("bytes_received", received)
+        instrumentation.count("bytes_decoded", decoded)
+        ledger.update(
+            job,
+            self.url,
+            accept,
+            status="downloaded",
+            path=spool_path,
+            digest=digest,
+            bytes=decoded,
+        )
+        return CustomResponse(response, languages=self.languages, spool=spool_path)
+
+    def get_chunked(self, **options) -> list:
+        """
+        For data queries, fetches the resource in chunks (time period windows and/or partitions of the filter expression),
+        in parallel, and returns the observations merged back into a single ordered list.
+        Takes the options of "chunking.fetch_chunked()".
+        """
+        if self.data_query is None:
+            raise RequestException("Only data queries can be fetched in chunks")
+        else:
+            return chunking.fetch_chunked(self, **options)
+
+    def cached_response(self, entry: dict, stream: bool = False) -> CustomResponse:
+        """
+        Rebuilds a "CustomResponse()" from a cached entry.
+        """
+        response = Response()
+        response.status_code = 200
+        response.url = self.url
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        if stream:
+            response.raw = io.BytesIO(entry["body"])
+        else:
+            response._content = entry["body"]
+        custom_response = CustomResponse(
+            response, stream=stream, languages=self.languages
+        )
+        custom_response.cache_key = entry["key"]
+        custom_response.cache_digest = entry["digest"]
+        return custom_response
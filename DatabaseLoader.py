@@ -0,0 +1,386 @@
+from ObservationColumns import ObservationColumns
+import instrumentation
+import math
+import sqlite3
+import time
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS "subjects" ("id" INTEGER, "name" TEXT, PRIMARY KEY("id"));',
+    'CREATE TABLE IF NOT EXISTS "indicators" ("id" INTEGER, "name" TEXT, "dataset" INTEGER, PRIMARY KEY("id"));',
+    'CREATE TABLE IF NOT EXISTS "measures" ("id" INTEGER, "name" TEXT, "unit" TEXT, PRIMARY KEY("id"));',
+    'CREATE TABLE IF NOT EXISTS "scopes" ("id" INTEGER, "time" TEXT, "reference_period" TEXT, PRIMARY KEY("id"));',
+    'CREATE TABLE IF NOT EXISTS "flags" ("id" INTEGER, "name" TEXT, PRIMARY KEY("id"));',
+    'CREATE TABLE IF NOT EXISTS "scores" ("id" INTEGER, "dataflow_id" TEXT NOT NULL, "series_key" TEXT NOT NULL, '
+    '"subject_id" INTEGER NOT NULL DEFAULT 0, "indicator_id" INTEGER NOT NULL DEFAULT 0, '
+    '"measure_id" INTEGER NOT NULL DEFAULT 0, "scope_id" INTEGER NOT NULL DEFAULT 0, "value" NUMERIC, '
+    '"flag_id" INTEGER NOT NULL DEFAULT 0, PRIMARY KEY("id"));',
+    'CREATE TABLE IF NOT EXISTS "loads" ("dataflow_id" TEXT, "digest" TEXT, "rows" INTEGER, '
+    '"completed" INTEGER, "loaded_at" REAL, PRIMARY KEY("dataflow_id"));',
+)
+"""
+Tables of the Macro.db database (created if missing), along with the "loads" ledger,
+recording the progress of each dataflow's load.
+"""
+
+SCORES_KEY = (
+    'CREATE UNIQUE INDEX IF NOT EXISTS "scores_key" ON "scores" ("dataflow_id", "series_key", "scope_id") '
+    "WHERE \"dataflow_id\" != '';"
+)
+"""
+Unique key of the "scores" facts (dataflow, series key and scope), making the loads idempotent;
+the key's columns are never NULL (which sqlite3 treats as distinct), a missing dimension's id being "MISSING_ID".
+The facts of no known dataflow ("LEGACY_DATAFLOW", e.g. inserted by other tools) are left out of it, as before.
+Created once the "scores" table has its columns (see "DatabaseLoader.migrate()").
+"""
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA cache_size = -200000;",
+)
+"""
+Connection settings for bulk loading: write-ahead log, no fsync per transaction, 200MB page cache.
+"""
+
+FIELDS = {
+    "subjects": {"name": "REF_AREA"},
+    "indicators": {"name": "TRANSACTION"},
+    "measures": {"name": "MEASURE", "unit": "UNIT_MEASURE"},
+    "scopes": {"time": "TIME_PERIOD", "reference_period": "PRICE_BASE"},
+    "flags": {"name": "OBS_STATUS"},
+}
+"""
+Default mapping of the dimension tables' columns to the SDMX fields of the observations.
+"""
+
+MISSING_ID = 0
+"""
+Id of a missing dimension in the "scores" table (the dimension tables' ids start at 1).
+"""
+
+SCORE_COLUMNS = {
+    "subjects": "subject_id",
+    "indicators": "indicator_id",
+    "measures": "measure_id",
+    "scopes": "scope_id",
+    "flags": "flag_id",
+}
+"""
+Column of the "scores" table referencing each dimension table.
+"""
+
+LEGACY_DATAFLOW = ""
+"""
+Dataflow of the facts of a "scores" table predating the dataflow and series key columns (unknown).
+"""
+
+MIGRATED_COLUMNS = {
+    "dataflow_id": f"TEXT NOT NULL DEFAULT '{LEGACY_DATAFLOW}'",
+    "series_key": "TEXT NOT NULL DEFAULT ''",
+    **{column: "INTEGER NOT NULL DEFAULT 0" for column in SCORE_COLUMNS.values()},
+    "value": "NUMERIC",
+}
+"""
+Columns added to a "scores" table missing them (see "DatabaseLoader.migrate()"), with their definitions.
+"""
+
+
+def labels(codelists: list, codelist_ids: dict) -> dict:
+    """
+    Builds, from the output of "codelists()", the names of the codes of each field,
+    given the (agency_id, codelist_id) of the field's codelist, e.g. {"REF_AREA": ("OECD", "CL_AREA")}.
+    The database stores names rather than codes.
+    """
+    fields = {ids: field for field, ids in codelist_ids.items()}
+    names = {field: {} for field in codelist_ids}
+    for code in codelists:
+        field = fields.get((code["agency_id"], code["codelist_id"]))
+        if field is not None:
+            names[field][code["code_id"]] = code["code_name"]
+    return names
+
+
+class DatabaseLoader:
+    """
+    Class for bulk loading extracted OECD data into the Macro.db sqlite3 database:
+    - upserts the dimension tables (subjects, indicators, measures, scopes, flags), resolving their ids
+      through an in-memory cache, loaded with a single query per table, instead of per-row SELECTs
+    - upserts the "scores" facts with "executemany()", in large batched transactions
+    - is idempotent (facts are keyed on their dataflow, series key and scope), and resumable per dataflow:
+      an interrupted load restarts after its last committed batch, and a completed one is skipped
+    """
+
+    def __init__(self, path: str = "Macro.db", batch_size: int = 50000) -> None:
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path)
+        for pragma in PRAGMAS:
+            self.connection.execute(pragma)
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+            self.migrate()
+            self.connection.execute(SCORES_KEY)
+        self.ids = {}
+        """
+        Id of each row of the dimension tables, by table and by value(s).
+        """
+
+    def migrate(self) -> None:
+        """
+        Brings a "scores" table created by earlier versions (e.g. the original Macro.db) to the current schema,
+        before its unique key is created (in the caller's transaction):
+        - the missing columns are added (see "MIGRATED_COLUMNS"), and the dimension ids' NULLs set to "MISSING_ID"
+        - the former unique key (on the dimension ids and the scope) is dropped
+        - the facts get the "LEGACY_DATAFLOW", and a series key made of their dimension ids
+          ("subject_id=1;indicator_id=2;measure_id=3"), for reference: they're not part of the unique key
+        The facts loaded since are keyed on their actual dataflow and series key, apart from these.
+        """
+        columns = {
+            row[1] for row in self.connection.execute('PRAGMA table_info("scores");')
+        }
+        missing = [column for column in MIGRATED_COLUMNS if column not in columns]
+        if not missing:
+            return
+        for column in missing:
+            self.connection.execute(
+                f'ALTER TABLE "scores" ADD COLUMN "{column}" {MIGRATED_COLUMNS[column]};'
+            )
+        self.connection.execute(
+            'UPDATE "scores" SET '
+            + ", ".join(
+                f'"{column}" = COALESCE("{column}", {MISSING_ID})'
+                for column in SCORE_COLUMNS.values()
+            )
+            + ";"
+        )
+        if "series_key" in missing:
+            self.connection.execute('DROP INDEX IF EXISTS "scores_key";')
+            self.connection.execute(
+                """UPDATE "scores" SET "series_key" = 'subject_id=' || "subject_id" """
+                """|| ';indicator_id=' || "indicator_id" || ';measure_id=' || "measure_id";"""
+            )
+        else:
+            pass
+
+    def dimension_ids(self, table: str) -> dict:
+        """
+        Returns the cache of a dimension table's ids, loading it on first use.
+        """
+        if table not in self.ids:
+            columns = ", ".join(f'"{c}"' for c in FIELDS[table])
+            self.ids[table] = {
+                tuple(row[1:]): row[0]
+                for row in self.connection.execute(
+                    f'SELECT "id", {columns} FROM "{table}";'
+                )
+            }
+        return self.ids[table]
+
+    def resolve(self, table: str, key: tuple, dataset=None) -> int:
+        """
+        Returns the id of a dimension table's row, inserting the row if missing.
+        """
+        ids = self.dimension_ids(table)
+        id_ = ids.get(key)
+        if id_ is None:
+            columns = list(FIELDS[table])
+            values = list(key)
+            if table == "indicators" and dataset is not None:
+                columns.append("dataset")
+                values.append(dataset)
+            id_ = ids[key] = self.connection.execute(
+                f'INSERT INTO "{table}" ({", ".join(columns)}) VALUES ({", ".join("?" * len(values))});',
+                values,
+            ).lastrowid
+        return id_
+
+    def upsert_dimension(self, table: str, keys, dataset=None) -> list:
+        """
+        Upserts rows of a dimension table, e.g. the subjects from the names of a codelist's codes.
+        Returns their ids.
+        """
+        with self.connection:
+            return [self.resolve(table, tuple(key), dataset) for key in keys]
+
+    def progress(self, dataflow_id: str, digest: str):
+        """
+        Returns the (rows, completed) of a dataflow's previous load of the same content, or None.
+        """
+        row = self.connection.execute(
+            'SELECT "rows", "completed", "digest" FROM "loads" WHERE "dataflow_id" = ?;',
+            (dataflow_id,),
+        ).fetchone()
+        if row is None or row[2] != digest:
+            return None
+        return row[0], bool(row[1])
+
+    def load(
+        self,
+        dataflow_id: str,
+        columns: ObservationColumns,
+        names: dict = None,
+        digest: str = None,
+        dataset=None,
+        fields: dict = FIELDS,
+        key_fields: list = None,
+    ) -> int:
+        """
+        Loads the observations of a dataflow (output of "observation_columns()") into the "scores" table:
+        - the fields' codes are translated to names with "names" (output of "labels()"), when available
+        - each distinct combination of codes is resolved to a dimension id only once
+        - the facts are upserted in batches of "batch_size", each batch committed along with the load's progress
+        - "fields" can map the tables' columns to other SDMX fields than the default ones
+        - each fact is keyed on the dataflow, its series key and its scope; the series key ("REF_AREA=AUS;FREQ=A")
+          is made of the "key_fields": by default those held by the series (see "ObservationColumns.series_fields"),
+          or for flat observations, all their fields but the scopes' and flags' ones; missing fields are left out
+        With the "digest" of the loaded content (e.g. the response's body digest), an interrupted load of the same
+        content resumes after its last committed batch, and a completed one is skipped.
+        Returns the number of facts loaded, and reports the load rate as a status message (see "instrumentation.message()").
+        """
+        names = names or {}
+        digest = digest or ""
+        start = 0
+        previous = self.progress(dataflow_id, digest)
+        if previous is not None:
+            if previous[1]:
+                instrumentation.message(
+                    f"{dataflow_id}: already loaded ({previous[0]} rows), skipped"
+                )
+                return 0
+            start = previous[0]
+            instrumentation.message(f"{dataflow_id}: resuming after {start} rows")
+
+        references = []
+        for table, table_fields in fields.items():
+            codes = [
+                (
+                    columns.codes.get(field),
+                    columns.dictionaries.get(field),
+                    names.get(field, {}),
+                )
+                for field in table_fields.values()
+            ]
+            references.append((table, codes, {}))
+
+        if key_fields is None:
+            observation_fields = set(fields.get("scopes", {}).values()) | set(
+                fields.get("flags", {}).values()
+            )
+            key_fields = list(columns.series_fields) or [
+                field for field in columns.codes if field not in observation_fields
+            ]
+        else:
+            pass
+        key_codes = [
+            (field, columns.codes[field], columns.dictionaries[field])
+            for field in sorted(key_fields)
+            if field in columns.codes
+        ]
+        series_keys = {}
+
+        def decode(code, dictionary, table_names):
+            value = dictionary[code] if dictionary is not None else None
+            return table_names.get(value, value)
+
+        def rows(begin: int, end: int):
+            for i in range(begin, end):
+                combination = tuple(codes[i] for _, codes, _ in key_codes)
+                series_key = series_keys.get(combination)
+                if series_key is None:
+                    series_key = series_keys[combination] = ";".join(
+                        f"{field}={dictionary[code]}"
+                        for (field, _, dictionary), code in zip(key_codes, combination)
+                        if code
+                    )
+                ids = [dataflow_id, series_key]
+                for table, codes, combinations in references:
+                    combination = tuple(
+                        c[i] if c is not None else 0 for c, _, _ in codes
+                    )
+                    id_ = combinations.get(combination)
+                    if id_ is None:
+                        key = tuple(
+                            decode(code, d, n)
+                            for code, (_, d, n) in zip(combination, codes)
+                        )
+                        if all(k is None for k in key):
+                            id_ = MISSING_ID
+                        else:
+                            id_ = self.resolve(table, key, dataset)
+                        combinations[combination] = id_
+                    ids.append(id_)
+                value = columns.values[i]
+                ids.append(None if math.isnan(value) else value)
+                yield ids
+
+        score_columns = (
+            ["dataflow_id", "series_key"]
+            + [SCORE_COLUMNS[table] for table in fields]
+            + ["value"]
+        )
+        key_columns = ["dataflow_id", "series_key", "scope_id"]
+        updates = ", ".join(
+            f'"{c}" = excluded."{c}"' for c in score_columns if c not in key_columns
+        )
+        statement = (
+            f'INSERT INTO "scores" ({", ".join(score_columns)}) '
+            f'VALUES ({", ".join("?" * len(score_columns))}) '
+            f'ON CONFLICT ({", ".join(key_columns)}) WHERE "dataflow_id" != \'\' '
+            f"DO UPDATE SET {updates};"
+        )
+        began = time.perf_counter()
+        for begin in range(start, len(columns), self.batch_size):
+            end = min(begin + self.batch_size, len(columns))
+            with self.connection:
+                self.connection.executemany(statement, rows(begin, end))
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO "loads" VALUES (?, ?, ?, ?, ?);',
+                    (dataflow_id, digest, end, int(end == len(columns)), time.time()),
+                )
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO "loads" VALUES (?, ?, ?, 1, ?);',
+                (dataflow_id, digest, len(columns), time.time()),
+            )
+        elapsed = time.perf_counter() - began
+        loaded = len(columns) - start
+        instrumentation.message(
+            f"{dataflow_id}: {loaded} rows loaded in {elapsed:.2f}s ({loaded / max(elapsed, 1e-9):.0f} rows/s)"
+        )
+        return loaded
+
+    def apply_changes(self, changes: list, codelist_columns: dict) -> int:
+        """
+        Applies the codes' changes of a sync's change log (see "sync.sync()") to the dimension tables,
+        given the (table, column) holding the names of each codelist's codes,
+        e.g. {("OECD", "CL_AREA"): ("subjects", "name")}:
+        - a modified code's previous name is renamed to its new name, in a single transaction
+        - added codes are inserted lazily, by the next loads of facts referencing them
+        - removed codes are kept, as facts may still reference them
+        Returns the number of values renamed.
+        """
+        renamed = 0
+        with self.connection:
+            for change in changes:
+                if (
+                    change["artefact_type"] != "codelist"
+                    or change["action"] != "modified"
+                ):
+                    continue
+                target = codelist_columns.get((change["agency_id"], change["id"]))
+                previous = change["previous"]["code_name"]
+                name = change["row"]["code_name"]
+                if target is None or previous == name:
+                    continue
+                table, column = target
+                renamed += self.connection.execute(
+                    f'UPDATE "{table}" SET "{column}" = ? WHERE "{column}" = ?;',
+                    (name, previous),
+                ).rowcount
+                self.ids.pop(table, None)
+        return renamed
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,121 @@
+import os
+import sqlite3
+import threading
+import time
+
+TASK_FIELDS = (
+    "job",
+    "url",
+    "accept",
+    "label",
+    "status",
+    "path",
+    "validator",
+    "encoding",
+    "digest",
+    "bytes",
+    "output",
+    "updated_at",
+)
+"""
+Columns of the ledger's tasks, in order.
+"""
+
+
+class JobLedger:
+    """
+    Class for checkpointing long-running jobs (batches, chunked queries) in an on-disk sqlite3 ledger,
+    so that a failed job restarts where it stopped instead of from scratch.
+    A job is made of tasks, one per request (keyed on the url and the "Accept" header), each going through:
+    - "partial": its body is being downloaded to the file at "path", from the response identified by "validator"
+      (ETag/Last-Modified, if the server allows Range requests): an interrupted download is resumed from the file's size
+    - "downloaded": its (decoded) body is complete at "path", along with its "digest" and size
+    - "done": its outputs (at "output") are written, so it's skipped altogether
+    The tasks of a job are cleared once the whole job completes (see "clear()").
+    """
+
+    def __init__(self, path: str = "job_ledger.db") -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "job TEXT, url TEXT, accept TEXT, label TEXT, status TEXT, path TEXT, validator TEXT, "
+                "encoding TEXT, digest TEXT, bytes INTEGER, output TEXT, updated_at REAL, "
+                "PRIMARY KEY (job, url, accept));"
+            )
+
+    def task(self, job: str, url: str, accept: str):
+        """
+        Returns the task of a job's request as a dictionary (see "TASK_FIELDS"), or None if it has none.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM tasks WHERE job = ? AND url = ? AND accept = ?;",
+                (job, url, accept),
+            ).fetchone()
+        return dict(zip(TASK_FIELDS, row)) if row is not None else None
+
+    def tasks(self, job: str, status: str = None) -> list:
+        """
+        Lists the tasks of a job (with the given status, if any), in the order they were last updated.
+        """
+        query = "SELECT * FROM tasks WHERE job = ?"
+        parameters = [job]
+        if status is not None:
+            query += " AND status = ?"
+            parameters.append(status)
+        else:
+            pass
+        with self.lock:
+            rows = self.connection.execute(
+                f"{query} ORDER BY updated_at;", parameters
+            ).fetchall()
+        return [dict(zip(TASK_FIELDS, row)) for row in rows]
+
+    def update(self, job: str, url: str, accept: str, **fields) -> dict:
+        """
+        Checkpoints a task: creates it, or updates the given fields (e.g. status="downloaded", digest=...).
+        Returns the task.
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT * FROM tasks WHERE job = ? AND url = ? AND accept = ?;",
+                (job, url, accept),
+            ).fetchone()
+            task = (
+                dict(zip(TASK_FIELDS, row))
+                if row is not None
+                else dict.fromkeys(TASK_FIELDS)
+            )
+            task.update(fields, job=job, url=url, accept=accept, updated_at=time.time())
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO tasks VALUES ({', '.join('?' * len(TASK_FIELDS))});",
+                [task[field] for field in TASK_FIELDS],
+            )
+        return task
+
+    def clear(self, job: str, remove_files: bool = True) -> int:
+        """
+        Clears the tasks of a job (e.g. once it completed), removing their downloaded files, unless they're
+        the tasks' outputs. Returns the number of tasks cleared.
+        """
+        tasks = self.tasks(job)
+        if remove_files:
+            for task in tasks:
+                if task["path"] and task["path"] != task["output"]:
+                    try:
+                        os.remove(task["path"])
+                    except FileNotFoundError:
+                        pass
+                else:
+                    pass
+        else:
+            pass
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM tasks WHERE job = ?;", (job,))
+        return len(tasks)
+
+    def close(self) -> None:
+        self.connection.close()
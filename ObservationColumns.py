@@ -0,0 +1,176 @@
+from array import array
+import math
+import sys
+
+MISSING = 0
+"""
+Code of a missing value, in every dictionary-encoded column.
+"""
+
+
+class ObservationColumns:
+    """
+    Class for holding observations in compact, column oriented buffers, instead of one dictionary per observation:
+    - the observation values ("OBS_VALUE") as doubles, in an "array('d')" (NaN when missing or not numeric)
+    - every other field (dimensions, time period, attributes) as integer codes, in an "array('I')",
+      indexing a dictionary of its distinct (interned) values, code 0 standing for a missing value
+    The buffers can be handed over to NumPy without copying, or decoded row by row for bulk inserts.
+    """
+
+    def __init__(self) -> None:
+        self.length = 0
+        self.values = array("d")
+        self.codes = {}
+        """
+        The integer codes of each dictionary-encoded field, one per observation.
+        """
+        self.dictionaries = {}
+        """
+        The distinct values of each dictionary-encoded field, indexed by their codes.
+        """
+        self.lookups = {}
+        """
+        The code of each distinct value, by field.
+        """
+        self.series_fields = {}
+        """
+        The fields held by the series (dimensions and series attributes, see "add_series()"), in order of appearance.
+        """
+
+    def __len__(self) -> int:
+        return self.length
+
+    @property
+    def fields(self) -> list:
+        """
+        The fields of the observations, in order of appearance, the observation value last.
+        """
+        return list(self.codes) + ["OBS_VALUE"]
+
+    def encoder(self, field: str):
+        """
+        Returns the codes and the lookup of a field, creating them (padded with missing values) if needed.
+        """
+        if field not in self.codes:
+            self.codes[field] = array("I", [MISSING]) * self.length
+            self.dictionaries[field] = [None]
+            self.lookups[field] = {}
+        return self.codes[field], self.lookups[field]
+
+    def encode(self, field: str, value: str) -> int:
+        """
+        Returns the code of a value, adding it to the dictionary of its field if needed.
+        """
+        lookup = self.lookups[field]
+        code = lookup.get(value)
+        if code is None:
+            code = lookup[value] = len(self.dictionaries[field])
+            self.dictionaries[field].append(sys.intern(value))
+        return code
+
+    def add_series(self, series: dict, observations) -> None:
+        """
+        Appends the observations (attribute dictionaries) of a series, encoding the series' own fields only once.
+        """
+        series_codes = []
+        for field, value in series.items():
+            self.series_fields[field] = None
+            codes, _ = self.encoder(field)
+            series_codes.append((codes, self.encode(field, value)))
+        for obs in observations:
+            for codes, code in series_codes:
+                codes.append(code)
+            self.add(obs, len(series_codes))
+
+    def add(self, obs: dict, filled: int = 0) -> None:
+        """
+        Appends a single observation, given its attributes, "filled" being the number of fields already appended
+        for it (by "add_series()"). The fields it lacks are padded with missing values.
+        """
+        length = self.length
+        value = math.nan
+        for field, text in obs.items():
+            if field == "OBS_VALUE":
+                try:
+                    value = float(text)
+                except ValueError:
+                    pass
+            else:
+                codes = self.codes.get(field)
+                if codes is None:
+                    codes, _ = self.encoder(field)
+                if len(codes) == length:
+                    code = self.lookups[field].get(text)
+                    if code is None:
+                        code = self.encode(field, text)
+                    codes.append(code)
+                    filled += 1
+        self.values.append(value)
+        self.length = length + 1
+        if filled < len(self.codes):
+            for codes in self.codes.values():
+                if len(codes) == length:
+                    codes.append(MISSING)
+
+    def column(self, field: str) -> list:
+        """
+        Decodes a whole column: a list of values, None standing for a missing value.
+        """
+        if field == "OBS_VALUE":
+            return list(self.values)
+        dictionary = self.dictionaries[field]
+        return [dictionary[code] for code in self.codes[field]]
+
+    def records(self, fields: list = None):
+        """
+        Iterates over the observations as tuples of values, in the order of "fields" (by default all of them),
+        decoding them lazily, e.g. for a bulk insert with "executemany()".
+        """
+        if fields is None:
+            fields = self.fields
+        return zip(
+            *(
+                (
+                    iter(self.values)
+                    if field == "OBS_VALUE"
+                    else map(self.dictionaries[field].__getitem__, self.codes[field])
+                )
+                for field in fields
+            )
+        )
+
+    def rows(self):
+        """
+        Yields the observations as dictionaries, the layout returned by "observations()"
+        (except for the observation values, as floats). Missing fields are left out.
+        """
+        fields = self.fields
+        for record in self.records(fields):
+            yield {
+                field: value
+                for field, value in zip(fields, record)
+                if value is not None
+                and not (field == "OBS_VALUE" and math.isnan(value))
+            }
+
+    def to_numpy(self) -> dict:
+        """
+        Wraps the buffers into NumPy arrays, without copying them (requires NumPy):
+        the values as float64, the codes as uint32, by field.
+        """
+        import numpy
+
+        arrays = {
+            field: numpy.frombuffer(codes, dtype=numpy.uint32)
+            for field, codes in self.codes.items()
+        }
+        arrays["OBS_VALUE"] = numpy.frombuffer(self.values, dtype=numpy.float64)
+        return arrays
+
+    def nbytes(self) -> int:
+        """
+        Size of the buffers, in bytes (dictionaries excluded).
+        """
+        return self.values.itemsize * len(self.values) + sum(
+            codes.itemsize * len(codes) for codes in self.codes.values()
+        )
@@ -0,0 +1,241 @@
+from requests import Response
+from records import Codelist, Record
+import hashlib
+import io
+import json
+import pickle
+import sqlite3
+import threading
+import time
+
+CACHED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+"""
+Response headers stored along with the cached bodies.
+"""
+
+CACHED_TYPES = (Record, Codelist)
+"""
+Classes of the extractors' outputs, loaded back from the cached extracts (with their subclasses):
+the records, and the codelists their codes are grouped under.
+"""
+
+
+class RecordUnpickler(pickle.Unpickler):
+    """
+    Unpickler of the cached extractor outputs: loads the containers and the records (see "CACHED_TYPES"),
+    and refuses any other class or function, so that a tampered cache file can't run code when it's read.
+    """
+
+    def find_class(self, module: str, name: str):
+        if module == "records":
+            cls = super().find_class(module, name)
+            if isinstance(cls, type) and issubclass(cls, CACHED_TYPES):
+                return cls
+            else:
+                pass
+        raise pickle.UnpicklingError(f"{module}.{name} is not a cached record type")
+
+
+class ResponseCache:
+    """
+    Class for persisting responses to OECD API calls in an on-disk sqlite3 store:
+    - entries are keyed on the url and the "Accept" header (and the "Accept-Language" header, unless English only)
+    - fresh entries (younger than "ttl" seconds) are served without contacting the endpoint
+    - stale entries are revalidated with a conditional request (If-None-Match/If-Modified-Since)
+    - the least recently used entries are evicted once the stored bodies exceed "max_size" bytes
+    The output of the extractors run on a cached body can be cached as well, pickled (see "extract()").
+    """
+
+    def __init__(
+        self,
+        path: str = "http_cache.db",
+        ttl: float = 24 * 3600,
+        max_size: int = 512 * 1024**2,
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, url TEXT, accept TEXT, body BLOB, headers TEXT, "
+                "digest TEXT, size INTEGER, stored_at REAL, accessed_at REAL);"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS extracts ("
+                "key TEXT, extractor TEXT, digest TEXT, output BLOB, "
+                "PRIMARY KEY (key, extractor));"
+            )
+
+    @staticmethod
+    def key(url: str, accept: str, language: str = "en") -> str:
+        """
+        Cache key of a request, from its url, "Accept" and "Accept-Language" headers.
+        """
+        if language != "en":
+            accept = f"{accept}\n{language}"
+        else:
+            pass
+        return hashlib.sha256(f"{url}\n{accept}".encode("utf-8")).hexdigest()
+
+    def lookup(self, url: str, accept: str, language: str = "en"):
+        """
+        Returns the cached entry of a request as a dictionary (or None), and marks it as recently used.
+        """
+        key = self.key(url, accept, language)
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT body, headers, digest, stored_at FROM responses WHERE key = ?;",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?;",
+                (time.time(), key),
+            )
+        return {
+            "key": key,
+            "body": row[0],
+            "headers": json.loads(row[1]),
+            "digest": row[2],
+            "stored_at": row[3],
+        }
+
+    def is_fresh(self, entry: dict) -> bool:
+        """
+        Whether the entry can be served without revalidation.
+        """
+        return time.time() - entry["stored_at"] < self.ttl
+
+    def conditional_headers(self, entry: dict) -> dict:
+        """
+        Headers turning a request for the entry into a conditional request.
+        """
+        headers = {}
+        if "ETag" in entry["headers"]:
+            headers["If-None-Match"] = entry["headers"]["ETag"]
+        if "Last-Modified" in entry["headers"]:
+            headers["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+        return headers
+
+    def store(
+        self, url: str, accept: str, response: Response, language: str = "en"
+    ) -> dict:
+        """
+        Stores the (decoded) body of a response, evicting the least recently used entries if needed.
+        Returns the stored entry.
+        """
+        key = self.key(url, accept, language)
+        body = response.content
+        headers = {
+            h: response.headers[h] for h in CACHED_HEADERS if h in response.headers
+        }
+        digest = hashlib.sha256(body).hexdigest()
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                (
+                    key,
+                    url,
+                    accept,
+                    body,
+                    json.dumps(headers),
+                    digest,
+                    len(body),
+                    now,
+                    now,
+                ),
+            )
+            self.connection.execute(
+                "DELETE FROM extracts WHERE key = ? AND digest != ?;", (key, digest)
+            )
+            self.evict()
+        return {
+            "key": key,
+            "body": body,
+            "headers": headers,
+            "digest": digest,
+            "stored_at": now,
+        }
+
+    def refresh(self, entry: dict, response: Response) -> None:
+        """
+        Marks a revalidated entry (answered with "304 Not Modified") as fresh again,
+        updating its validators if the endpoint sent new ones.
+        """
+        for h in CACHED_HEADERS:
+            if h in response.headers:
+                entry["headers"][h] = response.headers[h]
+        entry["stored_at"] = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE responses SET headers = ?, stored_at = ? WHERE key = ?;",
+                (json.dumps(entry["headers"]), entry["stored_at"], entry["key"]),
+            )
+
+    def evict(self) -> None:
+        """
+        Deletes the least recently used entries until the stored bodies fit in "max_size" bytes.
+        Must be called with the lock held, inside a transaction.
+        """
+        total = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses;"
+        ).fetchone()[0]
+        if total <= self.max_size:
+            return
+        for key, size in self.connection.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at;"
+        ).fetchall():
+            self.connection.execute("DELETE FROM responses WHERE key = ?;", (key,))
+            self.connection.execute("DELETE FROM extracts WHERE key = ?;", (key,))
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def extract(self, response, extractor):
+        """
+        Runs the extractor (e.g. "codelists()") on a response, reusing its cached output
+        when the response was built from, or stored in, the cache with the same body.
+        The output is pickled into the cache file, as the extractors' records can't be stored as JSON;
+        it's loaded back with "RecordUnpickler()", which only rebuilds records and builtin containers.
+        An output that doesn't load that way is extracted again, and replaced.
+        """
+        key = getattr(response, "cache_key", None)
+        digest = getattr(response, "cache_digest", None)
+        if key is None or digest is None:
+            return extractor(response)
+        name = f"{extractor.__module__}.{extractor.__qualname__}"
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT output FROM extracts WHERE key = ? AND extractor = ? AND digest = ?;",
+                (key, name, digest),
+            ).fetchone()
+        if row is not None:
+            try:
+                return RecordUnpickler(io.BytesIO(row[0])).load()
+            except pickle.UnpicklingError:
+                pass
+        else:
+            pass
+        output = extractor(response)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO extracts VALUES (?, ?, ?, ?);",
+                (key, name, digest, pickle.dumps(output)),
+            )
+        return output
+
+    def clear(self) -> None:
+        """
+        Deletes all the cached entries.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM responses;")
+            self.connection.execute("DELETE FROM extracts;")
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,211 @@
+from requests import ConnectionError, Response, Timeout
+from email.utils import parsedate_to_datetime
+from itertools import count
+import random
+import threading
+import time
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+"""
+Status codes of the responses worth retrying (throttled, or temporarily unavailable endpoint).
+"""
+
+
+class TokenBucket:
+    """
+    Client-side rate limiter, shared across threads:
+    - holds up to "capacity" tokens, refilled at "rate" tokens per second
+    - each request takes a token, waiting for it if the bucket is empty
+    - tokens are reserved under the lock and waited for outside of it, so waiting threads are served in turn
+    """
+
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self) -> None:
+        """
+        Adds the tokens accumulated since the last update. Must be called with the lock held.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        Takes tokens from the bucket, waiting until they are available.
+        Returns the time spent waiting, in seconds.
+        """
+        with self.lock:
+            self.refill()
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def defer(self, seconds: float) -> None:
+        """
+        Empties the bucket for "seconds" (e.g. on a "Retry-After" from the endpoint),
+        so that no thread sends a request before then.
+        """
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+
+class RetryScheduler:
+    """
+    Class for retrying the requests the OECD endpoint could not serve (429/5xx, connection errors):
+    - waits with exponential backoff and full jitter between attempts, up to "max_backoff" seconds
+    - honors the "Retry-After" header, if the endpoint sends one (capped at "max_backoff" seconds as well)
+    - retries the connection failures (e.g. an unresolvable host) at most "max_connect_retries" times,
+      as they rarely go away within a few seconds
+    - optionally paces all the requests through a shared "TokenBucket()" rate limiter
+    Keeps metrics on the retries and on the time spent throttled, shared by all the sessions using it.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 5,
+        max_connect_retries: int = 2,
+        backoff: float = 0.5,
+        max_backoff: float = 60.0,
+        limiter: TokenBucket = None,
+    ) -> None:
+        self.max_retries = max_retries
+        self.max_connect_retries = max_connect_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = limiter
+        self.lock = threading.Lock()
+        self.metrics = {
+            "requests": 0,
+            "retries": 0,
+            "failures": 0,
+            "throttled_time": 0.0,
+            "backoff_time": 0.0,
+            "statuses": {},
+        }
+        """
+        - "requests": attempts sent
+        - "retries": attempts that were retried
+        - "failures": requests given up on, after the last retry
+        - "throttled_time": seconds spent waiting on the rate limiter
+        - "backoff_time": seconds spent waiting between attempts
+        - "statuses": count of the retried status codes (or exception names)
+        With a rate limiter, a "429 Too Many Requests" defers the whole bucket instead of backing off,
+        so the wait is counted as throttled time.
+        """
+
+    def delay(self, attempt: int, response: Response = None) -> float:
+        """
+        Seconds to wait before the next attempt: the "Retry-After" of the response if any (up to "max_backoff"),
+        otherwise an exponential backoff with full jitter.
+        """
+        if response is not None and (
+            retry_after := response.headers.get("Retry-After")
+        ):
+            try:
+                return min(self.max_backoff, max(0.0, float(retry_after)))
+            except ValueError:
+                try:
+                    date = parsedate_to_datetime(retry_after)
+                    return min(
+                        self.max_backoff, max(0.0, date.timestamp() - time.time())
+                    )
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def record(self, key: str, value) -> None:
+        """
+        Adds the value to a metric.
+        """
+        with self.lock:
+            self.metrics[key] += value
+
+    def throttle(self) -> None:
+        """
+        Accounts for an attempt about to be sent: waits for the rate limiter's token, if any.
+        """
+        if self.limiter is not None:
+            self.record("throttled_time", self.limiter.acquire())
+        else:
+            pass
+        self.record("requests", 1)
+
+    def schedule(
+        self,
+        attempt: int,
+        response=None,
+        error: Exception = None,
+        connect: bool = False,
+    ):
+        """
+        Decides what follows an attempt, given its response or its error (with "connect", failing to connect), and records it:
+        - None if it's final: the response is to be returned (served, not worth retrying, or retried enough),
+          or the error raised (retried enough: "max_connect_retries" times for a connection failure)
+        - otherwise, the seconds to wait before the next attempt (the rate limiter deferred instead, on a 429)
+        Shared by the synchronous and the asynchronous senders ("send()", "AsyncSession.send()").
+        """
+        if error is None and response.status_code not in RETRY_STATUSES:
+            return None
+        elif attempt >= (self.max_connect_retries if connect else self.max_retries):
+            self.record("failures", 1)
+            return None
+        elif error is not None:
+            outcome = type(error).__name__
+            delay = self.delay(attempt)
+        else:
+            outcome = str(response.status_code)
+            delay = self.delay(attempt, response)
+            if response.status_code == 429 and self.limiter is not None:
+                self.limiter.defer(delay)
+                delay = 0.0
+            else:
+                pass
+        with self.lock:
+            self.metrics["retries"] += 1
+            self.metrics["statuses"][outcome] = (
+                self.metrics["statuses"].get(outcome, 0) + 1
+            )
+            self.metrics["backoff_time"] += delay
+        return delay
+
+    def send(self, request) -> Response:
+        """
+        Sends the request (a callable returning a response), retrying it as long as needed and allowed
+        (see "schedule()"). Returns the last response received, or raises the last connection error.
+        """
+        for attempt in count():
+            self.throttle()
+            try:
+                response = request()
+            except (ConnectionError, Timeout) as e:
+                delay = self.schedule(
+                    attempt, error=e, connect=isinstance(e, ConnectionError)
+                )
+                if delay is None:
+                    raise
+            else:
+                delay = self.schedule(attempt, response)
+                if delay is None:
+                    return response
+                response.close()
+            time.sleep(delay)
+
+    def report(self) -> str:
+        """
+        Summarizes the metrics in a single line.
+        """
+        with self.lock:
+            m = dict(self.metrics)
+        return (
+            f"{m['requests']} requests, {m['retries']} retries {m['statuses']}, "
+            f"{m['failures']} failures, {m['throttled_time']:.2f}s throttled, "
+            f"{m['backoff_time']:.2f}s backing off"
+        )
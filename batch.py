@@ -0,0 +1,221 @@
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from tabulate import tabulate
+from CustomSession import CustomSession, URL_ROOT
+from RetryScheduler import RetryScheduler
+import csv
+import instrumentation
+import os
+import re
+import threading
+import time
+
+
+def read_manifest(path: str) -> list:
+    """
+    Reads a manifest of data queries from a CSV file, one query per line, with the columns:
+    * context
+    * agency_id
+    * dataflow_id
+    * dataflow_version
+    * filter_expression
+    * optional_parameters
+    Blank lines and lines starting with "#" are skipped.
+    """
+    manifest = []
+    with open(path, newline="") as file:
+        for row in csv.reader(file):
+            if not row or row[0].startswith("#"):
+                continue
+            if len(row) != 6:
+                raise ValueError(f"Manifest line {row} does not have 6 columns")
+            manifest.append(tuple(field.strip() for field in row))
+    return manifest
+
+
+class HostLimiter:
+    """
+    Bounds the number of requests in flight to each host, across the threads of a batch.
+    """
+
+    def __init__(self, per_host: int) -> None:
+        self.per_host = per_host
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self.semaphores[host]
+
+
+def run_query(
+    n: int,
+    query: tuple,
+    adapter: HTTPAdapter,
+    limiter: HostLimiter,
+    output_dir: str,
+    cache=None,
+    url_root: str = URL_ROOT,
+    retry: RetryScheduler = None,
+    ledger=None,
+    job: str = "batch",
+) -> dict:
+    """
+    Runs a single query of a batch, through the shared connection pool, and writes its result
+    the same way as shell mode does (to its own hierarchy.txt, under the output directory).
+    With a "JobLedger()", the query is a checkpointed task of the job: skipped if done by a previous run,
+    otherwise downloaded to its directory (resuming an interrupted download, see "CustomSession.get_resumable()").
+    Returns the query's report: status, latency, size and output location.
+    """
+    result = {"n": n, "dataflow_id": query[2], "url": "None"}
+    name = re.sub(r"[^\w@.-]", "_", query[2])
+    directory = os.path.join(output_dir, f"{n:03d}_{name}")
+    start = time.perf_counter()
+    session = None
+    try:
+        session = CustomSession(
+            ["data", *query], cache=cache, url_root=url_root, retry=retry
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        result["url"] = session.url
+        task = (
+            ledger.task(job, session.url, session.headers["Accept"])
+            if ledger is not None
+            else None
+        )
+        if task is not None and task["status"] == "done":
+            result["latency"] = result["total"] = 0.0
+            result["status"] = "Skipped (done)"
+            result["bytes"] = task["bytes"]
+            result["output"] = task["output"]
+            return result
+        else:
+            pass
+        with limiter(session.url):
+            if ledger is not None:
+                os.makedirs(directory, exist_ok=True)
+                response = session.get_resumable(ledger, job, directory, str(n))
+            else:
+                response = session.get()
+        result["latency"] = time.perf_counter() - start
+        os.makedirs(directory, exist_ok=True)
+        response.output_hierarchy(path=os.path.join(directory, "hierarchy.txt"))
+        result["status"] = "OK"
+        result["bytes"] = (
+            os.path.getsize(response.spool)
+            if response.spool is not None
+            else len(response.content)
+        )
+        result["output"] = directory
+        if ledger is not None:
+            ledger.update(
+                job,
+                session.url,
+                session.headers["Accept"],
+                status="done",
+                output=directory,
+            )
+        else:
+            pass
+    except Exception as e:
+        # Whatever fails (the request, parsing its body, writing its output), only this query fails:
+        # the rest of the batch, its report and the ledger's clean-up still run
+        result["latency"] = time.perf_counter() - start
+        result["status"] = f"Failed: {type(e).__name__}: {e}"
+        result["bytes"] = 0
+        result["output"] = "None"
+    finally:
+        if session is not None:
+            # The connection pool is shared by the batch (and closed by "run_batch()"), not the session's own
+            for prefix in ("https://", "http://"):
+                session.adapters.pop(prefix, None)
+            session.close()
+        else:
+            pass
+    result["total"] = time.perf_counter() - start
+    return result
+
+
+def run_batch(
+    manifest: list,
+    max_workers: int = 8,
+    per_host: int = 4,
+    output_dir: str = "batch_output",
+    cache=None,
+    url_root: str = URL_ROOT,
+    retry: RetryScheduler = None,
+    ledger=None,
+    job: str = "batch",
+) -> list:
+    """
+    Runs the data queries of a manifest concurrently:
+    - with a bounded pool of "max_workers" threads
+    - sharing a single connection pool, with at most "per_host" requests in flight per host
+    - writing each result through the existing output path, to its own directory
+    - retrying throttled/failed requests through a single "RetryScheduler()" (and its rate limiter, if any)
+    - with a "JobLedger()", checkpointing each query as a task of the "job" (e.g. the manifest's path):
+      rerun after a failure, the batch skips the queries done and resumes the interrupted downloads;
+      once all the queries succeed, the job's checkpoints (and downloaded bodies) are cleared
+    Returns the per-query reports, in manifest order, and reports them along with the overall throughput
+    as status messages (see "instrumentation.message()").
+    """
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    limiter = HostLimiter(per_host)
+    if retry is None:
+        retry = RetryScheduler()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                run_query,
+                n,
+                query,
+                adapter,
+                limiter,
+                output_dir,
+                cache,
+                url_root,
+                retry,
+                ledger,
+                job,
+            )
+            for n, query in enumerate(manifest)
+        ]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    adapter.close()
+
+    instrumentation.message(
+        "\n"
+        + tabulate(
+            [
+                {
+                    "n": r["n"],
+                    "dataflow_id": r["dataflow_id"],
+                    "status": r["status"],
+                    "latency(s)": round(r["latency"], 3),
+                    "total(s)": round(r["total"], 3),
+                    "bytes": r["bytes"],
+                }
+                for r in results
+            ],
+            "keys",
+        )
+    )
+    succeeded = sum(r["status"] in ("OK", "Skipped (done)") for r in results)
+    size = sum(r["bytes"] for r in results)
+    instrumentation.message(
+        f"\n{succeeded}/{len(results)} queries succeeded in {elapsed:.2f}s: "
+        f"{len(results) / elapsed:.2f} queries/s, {size / elapsed / 1e6:.2f} MB/s"
+    )
+    instrumentation.message(f"Retries: {retry.report()}\n")
+    if ledger is not None and succeeded == len(results):
+        ledger.clear(job)
+    else:
+        pass
+    return results
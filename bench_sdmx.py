@@ -0,0 +1,337 @@
+"""
+Benchmark suite (pytest-benchmark) of the parsing, extraction and output of SDMX-ML messages, run offline:
+- on the recorded fixtures if any (see "sdmx_fixtures.record()"), otherwise on synthetic ones:
+  dataflow list, full codelist dump, and structure-specific data at 10k/1M/10M observations
+- the extraction of the same synthetic data in each wire format (SDMX-ML, SDMX-CSV, SDMX-JSON)
+- the download modes of the data (downloaded, streamed, spooled to disk), and the end-to-end "query()" shell mode,
+  against a local stub of the OECD endpoint
+- the startup of the command line (python -X importtime), for usage errors and "--help"
+Besides the wall time, each benchmark records (in "extra_info") the peak RSS growth and the peak traced allocations
+of one run, measured in a forked process.
+Run with: python -m pytest bench_sdmx.py (the data sizes are chosen with SDMX_BENCH_SIZES, e.g. "10k,1M,10M").
+"""
+
+from functools import partial
+from CustomSession import CustomSession
+from ResponseCache import ResponseCache
+from sdmx_fixtures import (
+    codelists_xml,
+    data_xml,
+    dataflows_xml,
+    fixture,
+    FORMAT_FIXTURES,
+    make_response,
+    RECORDED,
+)
+from stub_server import StubServer
+import standalone_functions as fct
+import main
+import multiprocessing
+import os
+import pytest
+import resource
+import subprocess
+import sys
+import tracemalloc
+
+pytest.importorskip("pytest_benchmark")
+
+SIZES = {"10k": 10_000, "1M": 1_000_000, "10M": 10_000_000}
+"""
+Number of observations of the synthetic data messages, by size name.
+"""
+
+OBS_PER_SERIES = 100
+"""
+Number of observations of each synthetic series.
+"""
+
+BENCH_SIZES = os.environ.get("SDMX_BENCH_SIZES", "10k").split(",")
+"""
+Sizes of the data messages benchmarked (10M observations take about 1.4GB of XML).
+"""
+
+
+def structures() -> dict:
+    """
+    The structure messages benchmarked, by name.
+    """
+    return {
+        "dataflows": fixture("dataflows", partial(dataflows_xml, 1500)),
+        "codelists": fixture("codelists", partial(codelists_xml, 200, 500)),
+    }
+
+
+@pytest.fixture(scope="module")
+def messages() -> dict:
+    """
+    All the messages benchmarked, by name (built once per module, lazily for the data sizes).
+    """
+
+    class Messages(dict):
+        def __missing__(self, name: str) -> bytes:
+            size = SIZES[name.removeprefix("data-")]
+            self[name] = data_xml(size // OBS_PER_SERIES, OBS_PER_SERIES)
+            return self[name]
+
+    return Messages(structures())
+
+
+@pytest.fixture(scope="module")
+def endpoint(messages):
+    """
+    Stub endpoint serving the structure messages, and the data messages under the recorded data query's path.
+    """
+    with StubServer() as server:
+        server.add("/structure/dataflow", messages["dataflows"])
+        server.add("/structure/codelist", messages["codelists"])
+        data_path = "/" + "/".join(RECORDED["data"][:-1]) + "?" + RECORDED["data"][-1]
+        for size in BENCH_SIZES:
+            server.add(f"{data_path}&size={size}", messages[f"data-{size}"])
+        yield server
+
+
+def rss() -> int:
+    """
+    Current resident set size of the process, in bytes.
+    """
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def memory_profile(function) -> dict:
+    """
+    Runs the function once in a forked process, and returns:
+    - "peak_rss_growth": growth of the peak RSS over the RSS at the start (ru_maxrss)
+    - "peak_allocated": peak of the memory allocated by Python (tracemalloc), in a second run
+    """
+
+    def child(connection) -> None:
+        start = rss()
+        function()
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        tracemalloc.start()
+        function()
+        allocated = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        connection.send(
+            {"peak_rss_growth": max(0, peak - start), "peak_allocated": allocated}
+        )
+        connection.close()
+
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=child, args=(sender,))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def run(benchmark, function, rounds: int = 3) -> None:
+    """
+    Benchmarks the function, and records its memory profile along with its timings.
+    """
+    benchmark.extra_info.update(memory_profile(function))
+    benchmark.pedantic(function, rounds=rounds, iterations=1, warmup_rounds=0)
+
+
+def rounds(name: str) -> int:
+    """
+    Fewer rounds for the largest messages.
+    """
+    return 1 if name in ("data-1M", "data-10M") else 3
+
+
+MESSAGES = ["dataflows", "codelists"] + [f"data-{size}" for size in BENCH_SIZES]
+
+
+@pytest.mark.parametrize("name", MESSAGES)
+def test_response(benchmark, messages, name):
+    content = messages[name]
+    run(benchmark, lambda: make_response(content), rounds(name))
+
+
+@pytest.mark.parametrize("name", MESSAGES)
+def test_get_namespaces(benchmark, messages, name):
+    response = make_response(messages[name])
+    run(benchmark, response.get_namespaces)
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_dataflows(benchmark, messages, stream):
+    content = messages["dataflows"]
+    run(benchmark, lambda: fct.dataflows(make_response(content, stream)))
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_codelists(benchmark, messages, stream):
+    content = messages["codelists"]
+    run(benchmark, lambda: fct.codelists(make_response(content, stream)))
+
+
+@pytest.mark.parametrize("rng", [None, 1000])
+@pytest.mark.parametrize("name", MESSAGES)
+def test_output_hierarchy(benchmark, messages, tmp_path, name, rng):
+    content = messages[name]
+    path = str(tmp_path / "hierarchy.txt")
+    run(
+        benchmark,
+        lambda: make_response(content, stream=True).output_hierarchy(rng, path),
+        rounds(name),
+    )
+
+
+@pytest.fixture(scope="module")
+def formats() -> dict:
+    """
+    The same synthetic data (of the first benchmarked size) in each wire format, with its media type.
+    """
+    size = SIZES[BENCH_SIZES[0]]
+    return {
+        format: (build(size // OBS_PER_SERIES, OBS_PER_SERIES), content_type)
+        for format, (build, content_type) in FORMAT_FIXTURES.items()
+    }
+
+
+@pytest.mark.parametrize("stream", [False, True])
+@pytest.mark.parametrize("format", list(FORMAT_FIXTURES))
+def test_observations_format(benchmark, formats, format, stream):
+    content, content_type = formats[format]
+    benchmark.extra_info["bytes"] = len(content)
+    run(
+        benchmark,
+        lambda: fct.observations(make_response(content, stream, content_type)),
+    )
+
+
+QUERIES = {
+    "dataflows": ["structure", "dataflow"],
+    "codelists": ["structure", "codelist"],
+    **{
+        f"data-{size}": RECORDED["data"][:-1] + [f"{RECORDED['data'][-1]}&size={size}"]
+        for size in BENCH_SIZES
+    },
+}
+"""
+Shell mode arguments of the end-to-end queries, by message name.
+"""
+
+
+@pytest.mark.parametrize("name", list(QUERIES))
+def test_query_shell(benchmark, endpoint, monkeypatch, tmp_path, name):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr("sys.argv", ["main.py", "--shell"] + QUERIES[name])
+    monkeypatch.setattr(
+        main, "CustomSession", partial(CustomSession, url_root=endpoint.url)
+    )
+    run(benchmark, main.query, rounds(name))
+
+
+@pytest.mark.parametrize("mode", ["download", "stream", "spool"])
+def test_get_modes(benchmark, endpoint, tmp_path, mode):
+    session = CustomSession(QUERIES[f"data-{BENCH_SIZES[0]}"], url_root=endpoint.url)
+    options = {
+        "stream": mode == "stream",
+        "spool": str(tmp_path) if mode == "spool" else None,
+    }
+
+    def get_columns():
+        response = session.get(**options)
+        fct.observation_columns(response)
+        if response.spool is not None:
+            os.remove(response.spool)
+        else:
+            pass
+
+    run(benchmark, get_columns, rounds(f"data-{BENCH_SIZES[0]}"))
+
+
+@pytest.fixture(scope="module")
+def query_daemon(endpoint, tmp_path_factory):
+    """
+    Daemon answering the queries against the stub endpoint, on a free port.
+    """
+    import daemon
+    import threading
+
+    cache = ResponseCache(str(tmp_path_factory.mktemp("daemon") / "http_cache.db"))
+    state = daemon.QueryDaemon(cache, endpoint.url)
+    httpd = daemon.serve(state, port=0)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+    state.close()
+
+
+@pytest.mark.parametrize("name", list(QUERIES))
+def test_query_daemon(benchmark, query_daemon, tmp_path, name):
+    """
+    The same queries as "test_query_shell", sent to a running daemon (after a first, cold one).
+    Timed only: the forked memory profile couldn't reach the daemon's thread.
+    """
+    import sdmx_client
+
+    def send() -> str:
+        status, report = sdmx_client.send_query(
+            QUERIES[name], cwd=str(tmp_path), port=query_daemon
+        )
+        assert status == 200
+        return report["served"]
+
+    send()
+    benchmark.extra_info["served"] = send()
+    benchmark.pedantic(send, rounds=rounds(name), iterations=1, warmup_rounds=0)
+
+
+IMPORT_COMMANDS = {
+    "help": ["main.py", "--help"],
+    "usage-error": ["main.py", "--shell", "data"],
+    "client-usage-error": ["sdmx_client.py", "--shell", "data"],
+    "all-dependencies": ["-c", "import main; main.load(*main.LAZY_IMPORTS)"],
+}
+"""
+Command lines whose startup is benchmarked, by name: those returning before any query (which should import
+none of the heavy dependencies), and, for reference, the import of all of them.
+"""
+
+
+def import_time(argv: list) -> dict:
+    """
+    Runs a command line once with "-X importtime", and returns:
+    - "modules": number of modules imported
+    - "import_ms": total time spent importing them (self times), in ms
+    - "heavy": the heavy dependencies among them (see "main.LAZY_IMPORTS")
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime"] + argv,
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    imports = [
+        line.split("|")
+        for line in process.stderr.splitlines()
+        if line.startswith("import time:") and "self [us]" not in line
+    ]
+    names = {name.strip() for _, _, name in imports}
+    heavy = {module for module, _ in main.LAZY_IMPORTS.values()} | {"lxml", "tabulate"}
+    return {
+        "modules": len(imports),
+        "import_ms": sum(int(time.split(":")[1]) for time, _, _ in imports) / 1000,
+        "heavy": sorted(names & heavy),
+    }
+
+
+@pytest.mark.parametrize("command", list(IMPORT_COMMANDS))
+def test_import_time(benchmark, command):
+    argv = IMPORT_COMMANDS[command]
+    benchmark.extra_info.update(import_time(argv))
+    benchmark.pedantic(
+        subprocess.run,
+        args=([sys.executable] + argv,),
+        kwargs={"capture_output": True},
+        rounds=5,
+        iterations=1,
+    )
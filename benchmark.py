@@ -0,0 +1,381 @@
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree as ET
+from requests import Response
+from CustomResponse import CustomResponse
+from sdmx_fixtures import codelists_xml, data_xml, dataflows_xml, make_response
+from stub_server import StubServer
+from CustomSession import CustomSession
+import standalone_functions as fct
+import parallel
+import parsers
+import io
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+def timed(function, repeat: int = 3) -> float:
+    """
+    Runs the function "repeat" times and returns the best wall time, in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(function) -> tuple:
+    """
+    Runs the function once, and returns its result along with the peak memory it allocated, in bytes.
+    """
+    tracemalloc.start()
+    try:
+        result = function()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def report(name: str, before: float, after: float) -> None:
+    """
+    Prints the before/after wall times of a benchmarked operation.
+    """
+    print(
+        f"{name:<40} before: {before * 1000:>10.1f} ms   after: {after * 1000:>10.1f} ms"
+        f"   speedup: x{before / after:.1f}"
+    )
+
+
+def legacy_namespaces(root) -> list:
+    """
+    Namespace scan as originally done by "CustomResponse.get_namespaces()": a regex over every node tag.
+    """
+    namespaces = []
+    for element in root.iter():
+        if namespace := re.search(r"^({.+})", element.tag):
+            namespace = namespace.group(1)
+            if namespace not in namespaces:
+                namespaces.append(namespace)
+    return namespaces
+
+
+def legacy_find_namespace(namespaces: list, description: str) -> str:
+    """
+    Namespace lookup as originally done by "CustomResponse.find_namespace()": a regex over every namespace.
+    """
+    for namespace in namespaces:
+        if re.search(r"/v2_1/(.+)}$", namespace).group(1) == description:
+            return namespace
+
+
+def legacy_output_hierarchy(response, rng=None, path: str = "hierarchy.txt") -> None:
+    """
+    Output as originally done by "CustomResponse.output_hierarchy()": the whole hierarchy built by recursion,
+    then each line matched against every namespace with a regex.
+    """
+
+    def printable(element, level):
+        to_display = [response.printable_node(element, level)]
+        for child in element:
+            to_display.extend(printable(child, level + 1))
+        return to_display
+
+    with open(path, "w") as file:
+        file.write("XPath resource hierarchy:" + "\n" + "=" * 50 + "\n")
+        for i in printable(response.hierarchy, 0)[:rng]:
+            for n in response.namespaces:
+                if i.strip().startswith(n):
+                    i = re.sub(n, f"-> ({response.find_description(n)}) ", i)
+                    break
+            file.write(i + "\n")
+
+
+def bench_namespaces(n_codelists: int = 200, n_codes: int = 500) -> None:
+    """
+    Namespace scan and lookups on a large codelist dump, before and after the namespace index.
+    The lookups are those paid by "codelists()": 2 per codelist and 3 per code.
+    """
+    content = codelists_xml(n_codelists, n_codes)
+    print(
+        f"\nNamespaces: {n_codelists} codelists x {n_codes} codes ({len(content) / 1e6:.1f} MB)"
+    )
+    root = ET.fromstring(content)
+    response = make_response(content)
+    n_lookups = n_codelists * (2 + 3 * n_codes)
+
+    report(
+        "parse + namespace scan",
+        timed(lambda: legacy_namespaces(ET.fromstring(content))),
+        timed(lambda: make_response(content)),
+    )
+    namespaces = legacy_namespaces(root)
+    report(
+        f"{n_lookups} namespace lookups",
+        timed(
+            lambda: [
+                legacy_find_namespace(namespaces, "structure") for _ in range(n_lookups)
+            ]
+        ),
+        timed(lambda: [response.tags["Code"] for _ in range(n_lookups)]),
+    )
+    print(
+        f"{'codelists() extraction':<40} {timed(lambda: fct.codelists(response)) * 1000:.1f} ms"
+    )
+
+
+def bench_observations(n_series: int = 1000, n_obs: int = 100) -> None:
+    """
+    Extraction of the observations of a data message: one dictionary per observation (before),
+    versus column oriented buffers (after). Both run on a streamed response, so the peak memory is the extracted output's.
+    """
+    content = data_xml(n_series, n_obs)
+    print(
+        f"\nObservations: {n_series} series x {n_obs} observations ({len(content) / 1e6:.1f} MB)"
+    )
+    report(
+        "extraction time",
+        timed(lambda: fct.observations(make_response(content, stream=True))),
+        timed(lambda: fct.observation_columns(make_response(content, stream=True))),
+    )
+    _, before = peak_memory(
+        lambda: fct.observations(make_response(content, stream=True))
+    )
+    columns, after = peak_memory(
+        lambda: fct.observation_columns(make_response(content, stream=True))
+    )
+    print(
+        f"{'peak memory':<40} before: {before / 1e6:>10.1f} MB   after: {after / 1e6:>10.1f} MB"
+        f"   buffers: {columns.nbytes() / 1e6:.1f} MB"
+    )
+
+
+def bench_hierarchy(n_series: int = 2000, n_obs: int = 100) -> None:
+    """
+    Output of a data message's hierarchy, in full and truncated to its first 1000 nodes:
+    recursive build then regex per line (before), versus the iterative, buffered writer (after).
+    The truncated output is also timed on a streamed response, which stops parsing after the 1000th node.
+    """
+    content = data_xml(n_series, n_obs)
+    print(f"\nHierarchy output: {len(content) / 1e6:.1f} MB data message")
+    path = os.path.join(tempfile.mkdtemp(), "hierarchy.txt")
+    response = make_response(content)
+    report(
+        "full output",
+        timed(lambda: legacy_output_hierarchy(response, path=path), repeat=1),
+        timed(lambda: response.output_hierarchy(path=path), repeat=1),
+    )
+    report(
+        "first 1000 nodes",
+        timed(lambda: legacy_output_hierarchy(response, 1000, path)),
+        timed(lambda: response.output_hierarchy(1000, path)),
+    )
+    report(
+        "first 1000 nodes, parsing included",
+        timed(
+            lambda: legacy_output_hierarchy(make_response(content), 1000, path),
+            repeat=1,
+        ),
+        timed(lambda: make_response(content, stream=True).output_hierarchy(1000, path)),
+    )
+
+
+def bench_export(n_codelists: int = 200, n_codes: int = 500) -> None:
+    """
+    Export of the codes of a large codelist dump: the whole list written with tabulate (before),
+    versus the codes streamed from the response into each exporter, in chunks (after).
+    """
+    content = codelists_xml(n_codelists, n_codes)
+    print(f"\nExport: {n_codelists * n_codes} codes ({len(content) / 1e6:.1f} MB)")
+    directory = tempfile.mkdtemp()
+
+    def legacy():
+        fct.output_codelists(
+            fct.codelists(make_response(content, stream=True)),
+            os.path.join(directory, "codelists.txt"),
+        )
+
+    formats = ["csv", "csv.gz"]
+    try:
+        import pyarrow
+
+        formats += ["parquet", "arrow"]
+    except ImportError:
+        print("(pyarrow not installed: Parquet/Arrow IPC skipped)")
+    before = timed(legacy, repeat=1)
+    _, before_memory = peak_memory(legacy)
+    for extension in formats:
+        path = os.path.join(directory, f"codelists.{extension}")
+
+        def streamed():
+            fct.output_codelists(
+                fct.iter_codelists(make_response(content, stream=True)), path
+            )
+
+        after = timed(streamed, repeat=1)
+        _, after_memory = peak_memory(streamed)
+        report(f"codelists.{extension}", before, after)
+        print(
+            f"{'':<40} peak memory: {before_memory / 1e6:.1f} MB -> {after_memory / 1e6:.1f} MB"
+            f"   size: {os.path.getsize(os.path.join(directory, 'codelists.txt')) / 1e6:.1f} MB"
+            f" -> {os.path.getsize(path) / 1e6:.1f} MB"
+        )
+
+
+def bench_parallel(n_codelists: int = 200, n_codes: int = 500) -> None:
+    """
+    Parsing and extraction of a large codelist dump and data message: serial (before),
+    versus split at the artefacts' boundaries and run in a process pool of 1, 2, 4... workers, up to the cores (after).
+    """
+    cores = os.cpu_count() or 1
+    workers = sorted({1, cores} | {2**i for i in range(1, 8) if 2**i < cores})
+    for name, content, extractor in (
+        (
+            f"{n_codelists} codelists x {n_codes} codes",
+            codelists_xml(n_codelists, n_codes),
+            fct.codelists,
+        ),
+        ("2000 series x 100 observations", data_xml(2000, 100), fct.observations),
+    ):
+        print(
+            f"\nParallel extraction: {name} ({len(content) / 1e6:.1f} MB, {cores} cores)"
+        )
+        before = timed(lambda: extractor(make_response(content)), repeat=1)
+        for n in workers:
+            with ProcessPoolExecutor(n, initializer=parallel.quiet) as pool:
+                after = timed(
+                    lambda: parallel.extract_parallel(
+                        make_response(content, stream=True), extractor, n, executor=pool
+                    ),
+                    repeat=1,
+                )
+            report(f"{n} workers", before, after)
+
+
+def bench_parsers(n_codelists: int = 200, n_codes: int = 500) -> None:
+    """
+    Parsing and extraction with each parser backend: the standard library (before) versus lxml (after),
+    on a large codelist dump and data message, as a whole and streamed.
+    """
+    if "lxml" not in parsers.BACKENDS:
+        sys.exit("The parsers benchmark requires lxml: pip install lxml\n")
+
+    def run(content: bytes, extractor, stream: bool, parser: str):
+        response = Response()
+        response.status_code = 200
+        if stream:
+            response.raw = io.BytesIO(content)
+        else:
+            response._content = content
+        return extractor(CustomResponse(response, stream=stream, parser=parser))
+
+    for name, content, extractor in (
+        (
+            f"{n_codelists} codelists x {n_codes} codes",
+            codelists_xml(n_codelists, n_codes),
+            fct.codelists,
+        ),
+        ("2000 series x 100 observations", data_xml(2000, 100), fct.observations),
+    ):
+        print(f"\nParser backends: {name} ({len(content) / 1e6:.1f} MB)")
+        for stream in (False, True):
+            before = timed(lambda: run(content, extractor, stream, "stdlib"))
+            after = timed(lambda: run(content, extractor, stream, "lxml"))
+            report("parse + extract" + (" (streamed)" if stream else ""), before, after)
+
+
+def bench_targeted(n_codelists: int = 200, n_codes: int = 500) -> None:
+    """
+    Extraction of a single codelist's codes, served by a local stub of the endpoint:
+    from the whole codelist dump filtered client-side (before), versus from the targeted codelist query (after).
+    """
+    dump = codelists_xml(n_codelists, n_codes)
+    targeted = codelists_xml(1, n_codes)
+    print(f"\nTargeted query: 1 codelist among {n_codelists} (x {n_codes} codes each)")
+    with StubServer() as server:
+        server.add("/structure/codelist", dump)
+        server.add("/structure/codelist/OECD.AG0/CL_0", targeted)
+
+        def extract(args: list) -> list:
+            response = CustomSession(args, url_root=server.url).get()
+            return [
+                code
+                for code in fct.codelists(response)
+                if code["agency_id"] == "OECD.AG0" and code["codelist_id"] == "CL_0"
+            ]
+
+        report(
+            "request + codelists() extraction",
+            timed(lambda: extract(["structure", "codelist"])),
+            timed(lambda: extract(["structure", "codelist", "OECD.AG0", "CL_0"])),
+        )
+    print(
+        f"{'bytes transferred':<40} before: {len(dump) / 1e6:>10.2f} MB   after: {len(targeted) / 1e6:>10.2f} MB"
+    )
+
+
+def retained_memory(function) -> tuple:
+    """
+    Runs the function once, and returns its result along with the memory it still holds (its result), in bytes.
+    """
+    tracemalloc.start()
+    try:
+        result = function()
+        return result, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_records(n_codelists: int = 200, n_codes: int = 500) -> None:
+    """
+    Memory held by the extracted dataflows and codes of large structure messages:
+    one dictionary per row, as originally returned (before), versus the compact records (after).
+    """
+    for name, content, extractor in (
+        (
+            f"{n_codelists} codelists x {n_codes} codes",
+            codelists_xml(n_codelists, n_codes),
+            fct.iter_codelists,
+        ),
+        ("20000 dataflows", dataflows_xml(20000), fct.iter_dataflows),
+    ):
+        response = make_response(content)
+        print(f"\nExtracted records: {name}")
+        rows, before = retained_memory(lambda: [dict(r) for r in extractor(response)])
+        del rows
+        rows, after = retained_memory(lambda: list(extractor(response)))
+        print(
+            f"{'memory held':<40} before: {before / 1e6:>10.2f} MB   after: {after / 1e6:>10.2f} MB"
+            f"   per row: {before / len(rows):.0f} -> {after / len(rows):.0f} bytes"
+        )
+
+
+BENCHMARKS = {
+    "namespaces": bench_namespaces,
+    "observations": bench_observations,
+    "hierarchy": bench_hierarchy,
+    "export": bench_export,
+    "parallel": bench_parallel,
+    "parsers": bench_parsers,
+    "targeted": bench_targeted,
+    "records": bench_records,
+}
+"""
+Available benchmarks, by name.
+"""
+
+
+def main() -> None:
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit(f"Available benchmarks: {list(BENCHMARKS)}\n")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
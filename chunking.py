@@ -0,0 +1,306 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests import RequestException
+from requests.adapters import HTTPAdapter
+from CustomResponse import CustomResponse
+import standalone_functions as fct
+import instrumentation
+import json
+import os
+import re
+import tempfile
+import time
+
+TIME_PERIOD = "c[TIME_PERIOD]"
+"""
+Optional parameter holding the time period constraint of a data query (e.g. "c[TIME_PERIOD]=ge:2018+le:2024").
+"""
+
+NO_RECORDS = 404
+"""
+Status of a data query matching no observations (SDMX REST's "NoRecordsFound"), e.g. a time window without data.
+"""
+
+OBS_FIELDS = ("TIME_PERIOD", "OBS_VALUE", "OBS_STATUS", "OBS_CONF", "OBS_COMMENT")
+"""
+Observation level fields, left out of the series key when merging.
+"""
+
+
+def time_range(optional_parameters: str):
+    """
+    Finds the lower and upper bounds ("ge:"/"le:") of the time period constraint among the optional parameters.
+    Returns None unless both bounds are given, starting with a year.
+    """
+    for parameter in optional_parameters.split("&"):
+        name, _, value = parameter.partition("=")
+        if name == TIME_PERIOD:
+            bounds = dict(
+                bound.split(":", 1) for bound in value.split("+") if ":" in bound
+            )
+            lower, upper = bounds.get("ge"), bounds.get("le")
+            if (
+                lower is not None
+                and upper is not None
+                and re.match(r"^\d{4}", lower)
+                and re.match(r"^\d{4}", upper)
+            ):
+                return lower, upper
+    return None
+
+
+def with_time_range(optional_parameters: str, lower: str, upper: str) -> str:
+    """
+    Replaces the time period constraint among the optional parameters with the given bounds.
+    """
+    return "&".join(
+        f"{TIME_PERIOD}=ge:{lower}+le:{upper}" if p.startswith(f"{TIME_PERIOD}=") else p
+        for p in optional_parameters.split("&")
+    )
+
+
+def key_partitions(filter_expression: str, parts: int) -> list:
+    """
+    Splits the filter expression into (at most) "parts" filter expressions, partitioning the values
+    of its dimension holding the most values (e.g. "A.AUS+FRA+DEU.B1GQ" -> "A.AUS+FRA.B1GQ", "A.DEU.B1GQ").
+    """
+    dimensions = filter_expression.split(".")
+    values = [dimension.split("+") for dimension in dimensions]
+    widest = max(range(len(values)), key=lambda i: len(values[i]))
+    if parts <= 1 or len(values[widest]) <= 1 or not all(values[widest]):
+        return [filter_expression]
+    parts = min(parts, len(values[widest]))
+    size = -(-len(values[widest]) // parts)
+    partitions = []
+    for i in range(0, len(values[widest]), size):
+        dimensions[widest] = "+".join(values[widest][i : i + size])
+        partitions.append(".".join(dimensions))
+    return partitions
+
+
+def next_window(cursor: int, years: int, last: int, covered: list) -> tuple:
+    """
+    The next time window of a key partition, from its cursor, around the windows "covered" by the chunks
+    completed in a previous run (see "completed_chunks()"): it starts after the covered years the cursor falls in,
+    and ends before the next covered ones. Returns its (start, end) years, start being past "last" if all are covered.
+    """
+    covered = sorted(covered)
+    for start, end in covered:
+        if start <= cursor <= end:
+            cursor = end + 1
+        else:
+            pass
+    end = min(cursor + years - 1, last)
+    for start, _ in covered:
+        if cursor < start <= end:
+            end = start - 1
+        else:
+            pass
+    return cursor, end
+
+
+def completed_chunks(ledger, job: str, languages: tuple) -> tuple:
+    """
+    Reads back the chunks of a job downloaded by a previous run, from their spool files (see "JobLedger()").
+    Returns their observations, and the windows they cover by key partition ((None, None) without time windows).
+    """
+    chunks = []
+    covered = {}
+    for task in ledger.tasks(job, "downloaded"):
+        if task["label"] is None or not os.path.exists(task["path"]):
+            continue
+        key, start, end = json.loads(task["label"])
+        chunks.append(
+            fct.observations(CustomResponse.from_spool(task["path"], languages))
+        )
+        covered.setdefault(key, []).append((start, end))
+    return chunks, covered
+
+
+def merge(chunks: list) -> list:
+    """
+    Merges the observations of the chunks into a single list, ordered by series key then time period,
+    dropping the duplicates found at the chunk boundaries.
+    """
+    merged = {}
+    for observations in chunks:
+        for obs in observations:
+            series = tuple((k, v) for k, v in obs.items() if k not in OBS_FIELDS)
+            merged.setdefault((series, obs.get("TIME_PERIOD", "")), obs)
+    return [merged[key] for key in sorted(merged)]
+
+
+def fetch_chunked(
+    session,
+    years: int = 5,
+    key_parts: int = 1,
+    max_workers: int = 4,
+    target_latency: float = 10.0,
+    target_bytes: float = 20e6,
+    ledger=None,
+    job: str = None,
+    directory: str = None,
+) -> list:
+    """
+    Fetches a data query in chunks, and merges the observations of the chunks back into a single ordered result:
+    - splits the time period constraint into windows of "years" years (if it has a lower and an upper bound)
+    - splits the filter expression into "key_parts" partitions of its widest dimension
+    - fetches the chunks in waves of up to "max_workers" consecutive windows, across the key partitions,
+      through a shared connection pool
+    - after each wave, resizes the windows so that a chunk takes about "target_latency" seconds and "target_bytes" bytes
+    - a window without observations ("NO_RECORDS") is an empty chunk; the query fails if all of them are
+    - a failed chunk spanning more than a year is split in two and fetched again
+    With a "JobLedger()", each chunk is a checkpointed task of the "job" (by default, the query's url), downloaded
+    to a spool file in "directory" (by default, the temporary directory): rerun after a failure, the query reads back
+    the chunks completed, fetches only the windows they don't cover, and resumes the interrupted downloads
+    (see "CustomSession.get_resumable()"). The job's checkpoints and files are cleared once the query completes.
+    The chunks are fetched in the query's format and languages. The run's statistics (chunks, empty, split and resumed
+    ones, bytes, observations, last window's years) are the attributes of the "fetch_chunked" span, and summarized
+    in a status message.
+    """
+    context, agency_id, dataflow_id, version, filter_expression, parameters = (
+        session.data_query
+    )
+    bounds = time_range(parameters)
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    keys = key_partitions(filter_expression, key_parts)
+    job = job or session.url
+    directory = directory or tempfile.gettempdir()
+    if ledger is not None:
+        chunks, covered = completed_chunks(ledger, job, session.languages)
+    else:
+        chunks, covered = [], {}
+    if bounds is None:
+        first = last = None
+        cursors = {}
+        queued = deque(
+            (key, None, None)
+            for key in keys
+            if (None, None) not in covered.get(key, ())
+        )
+    else:
+        first, last = int(bounds[0][:4]), int(bounds[1][:4])
+        cursors = {key: first for key in keys}
+        """
+        next year to fetch, for each key partition
+        """
+        queued = deque()
+
+    def fetch(key: str, start, end) -> tuple:
+        if start is None:
+            chunk_parameters = parameters
+        else:
+            lower = bounds[0] if start == first else str(start)
+            upper = bounds[1] if end == last else str(end)
+            chunk_parameters = with_time_range(parameters, lower, upper)
+        chunk_session = type(session)(
+            ["data", context, agency_id, dataflow_id, version, key, chunk_parameters],
+            cache=session.cache,
+            url_root=session.url_root,
+            retry=session.retry,
+            languages=session.languages,
+            format=session.format,
+        )
+        chunk_session.mount("https://", adapter)
+        chunk_session.mount("http://", adapter)
+        try:
+            begin = time.perf_counter()
+            if ledger is not None:
+                response = chunk_session.get_resumable(
+                    ledger, job, directory, json.dumps([key, start, end])
+                )
+                size = os.path.getsize(response.spool)
+            else:
+                response = chunk_session.get()
+                size = len(response.content)
+            latency = time.perf_counter() - begin
+            return fct.observations(response), size, latency
+        finally:
+            # The connection pool is shared by the chunks (and closed once they're all fetched)
+            for prefix in ("https://", "http://"):
+                chunk_session.adapters.pop(prefix, None)
+            chunk_session.close()
+
+    start_time = time.perf_counter()
+    with instrumentation.span("fetch_chunked", url=session.url) as stats:
+        stats.update(chunks=0, empty=0, splits=0, bytes=0, resumed=len(chunks))
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                while queued or cursors:
+                    wave = []
+                    while queued and len(wave) < max_workers:
+                        wave.append(queued.popleft())
+                    while cursors and len(wave) < max_workers:
+                        for key, cursor in list(cursors.items()):
+                            if len(wave) >= max_workers:
+                                break
+                            cursor, end = next_window(
+                                cursor, years, last, covered.get(key, [])
+                            )
+                            if cursor > last:
+                                del cursors[key]
+                                continue
+                            wave.append((key, cursor, end))
+                            if end < last:
+                                cursors[key] = end + 1
+                            else:
+                                del cursors[key]
+                    futures = [
+                        (chunk, executor.submit(fetch, *chunk)) for chunk in wave
+                    ]
+                    costs = []
+                    for (key, start, end), future in futures:
+                        try:
+                            observations, size, latency = future.result()
+                        except RequestException as e:
+                            if (
+                                e.response is not None
+                                and e.response.status_code == NO_RECORDS
+                            ):
+                                stats["empty"] += 1
+                                continue
+                            elif start is None or start == end:
+                                raise
+                            middle = (start + end) // 2
+                            queued.extend(
+                                [(key, start, middle), (key, middle + 1, end)]
+                            )
+                            stats["splits"] += 1
+                            continue
+                        chunks.append(observations)
+                        stats["chunks"] += 1
+                        stats["bytes"] += size
+                        if start is not None:
+                            span = end - start + 1
+                            costs.append((latency / span, size / span))
+                    if costs:
+                        latency_per_year = max(c[0] for c in costs)
+                        bytes_per_year = max(c[1] for c in costs)
+                        years = int(
+                            min(
+                                last - first + 1,
+                                target_latency / max(latency_per_year, 1e-9),
+                                target_bytes / max(bytes_per_year, 1),
+                            )
+                        )
+                        years = max(1, years)
+        finally:
+            adapter.close()
+        if stats["empty"] and not stats["chunks"] and not stats["resumed"]:
+            raise RequestException(
+                f"Something went wrong! Status code: <{NO_RECORDS}>, no records found in any window"
+            )
+        merged = merge(chunks)
+        stats["observations"] = len(merged)
+        stats["years"] = years
+    if ledger is not None:
+        ledger.clear(job)
+    else:
+        pass
+    instrumentation.message(
+        f"Fetched {stats['chunks']} chunks ({stats['empty']} empty, {stats['splits']} split after failing, "
+        f"{stats['resumed']} completed by a previous run, "
+        f"{stats['bytes'] / 1e6:.2f} MB) in {time.perf_counter() - start_time:.2f}s, "
+        f"{len(merged)} observations, last window: {years} years"
+    )
+    return merged
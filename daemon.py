@@ -0,0 +1,304 @@
+"""
+Daemon mode: the shell mode's "query()" workflow served over a local HTTP API, so that repeated invocations
+(e.g. from an orchestrator) don't each pay the interpreter startup, the imports, a new TLS handshake and a cold parse.
+The daemon keeps, across queries:
+- a pooled connection adapter, mounted on the session of every query (keep-alive connections to the endpoint)
+- the "ResponseCache()" and its open sqlite3 connection (bodies and extracted rows, persisted)
+- the parsed structure responses (element tree, namespace index, compiled paths) and the rows extracted from them,
+  in memory, served as long as their cache entry is fresh and unchanged
+Run with: python daemon.py [--port=8765]; queried with the thin client "sdmx_client.py", which takes the shell mode's
+arguments (e.g. python sdmx_client.py -s structure dataflow).
+"""
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests import RequestException
+from requests.adapters import HTTPAdapter
+from CustomSession import CustomSession, LANGUAGES, URL_ROOT
+from ResponseCache import ResponseCache
+from main import makes_query
+import standalone_functions as fct
+import json
+import os
+import sys
+import threading
+import time
+
+DAEMON_HOST = "127.0.0.1"
+"""
+Address the daemon listens on: local connections only.
+"""
+
+DAEMON_PORT = int(os.environ.get("SDMX_DAEMON_PORT", 8765))
+"""
+Port the daemon listens on (SDMX_DAEMON_PORT, by default 8765).
+"""
+
+EXTRACTORS = {
+    "dataflow": (fct.dataflows, fct.output_dataflows, "dataflows.txt"),
+    "codelist": (fct.codelists, fct.output_codelists, "codelists.txt"),
+}
+"""
+Extractor, writer and output file of the structure artefacts extracted by the shell mode, by artefact type.
+"""
+
+
+def query_args(args: list) -> list:
+    """
+    Checks the arguments of a shell mode query (everything after "--shell"), as "main.query()" does.
+    Raises a "RequestException" with the shell mode's message if they don't make a query.
+    """
+    if makes_query(args):
+        return list(args)
+    elif args and args[0] == "structure":
+        raise RequestException(
+            "For structure queries, one to five more arguments needed after the query type, plus optionally the query parameters"
+        )
+    elif args and args[0] == "data":
+        raise RequestException(
+            "For data queries, 6 more arguments needed after the query type"
+        )
+    else:
+        raise RequestException('Supported query types: "structure" and "data"')
+
+
+class QueryDaemon:
+    """
+    State shared by the queries served by the daemon (see the module's description),
+    and the shell mode workflow run for each of them (see "run()").
+    """
+
+    def __init__(
+        self,
+        cache: ResponseCache = None,
+        url_root: str = URL_ROOT,
+        pool_size: int = 8,
+        max_warm: int = 32,
+    ) -> None:
+        self.cache = cache if cache is not None else ResponseCache()
+        self.url_root = url_root
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.max_warm = max_warm
+        self.warm = OrderedDict()
+        """
+        The parsed structure responses, with the rows extracted from them, by cache key (least recently used first).
+        """
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.served = {"warm": 0, "cache": 0, "network": 0, "failed": 0}
+
+    def response(self, session: CustomSession) -> tuple:
+        """
+        Returns the response to the session's query, along with where it was served from:
+        - "warm": an already parsed response, while its cache entry is fresh and has the same body
+        - "cache"/"network": a response got (and parsed) by the session, kept warm if it's a structure response
+        """
+        accept = session.headers["Accept"]
+        language = session.headers["Accept-Language"]
+        key = self.cache.key(session.url, accept, language)
+        with self.lock:
+            warm = self.warm.get(key)
+        if warm is not None:
+            entry = self.cache.lookup(session.url, accept, language)
+            if (
+                entry is not None
+                and self.cache.is_fresh(entry)
+                and entry["digest"] == warm[0].cache_digest
+            ):
+                with self.lock:
+                    self.warm.move_to_end(key)
+                return warm[0], "warm"
+            else:
+                pass
+        response = session.get()
+        served = "network" if session.retry.metrics["requests"] else "cache"
+        if session.query_type == "structure" and response.cache_key is not None:
+            with self.lock:
+                self.warm[key] = (response, {})
+                self.warm.move_to_end(key)
+                while len(self.warm) > self.max_warm:
+                    self.warm.popitem(last=False)
+        else:
+            pass
+        return response, served
+
+    def extract(self, response, extractor) -> list:
+        """
+        Runs the extractor on a response, reusing the rows already extracted from it while warm,
+        otherwise those cached on disk (see "ResponseCache.extract()").
+        """
+        with self.lock:
+            warm = self.warm.get(response.cache_key)
+        if warm is None or warm[0] is not response:
+            return self.cache.extract(response, extractor)
+        rows = warm[1].get(extractor)
+        if rows is None:
+            rows = warm[1][extractor] = self.cache.extract(response, extractor)
+        return rows
+
+    def run(self, args: list, cwd: str, languages: tuple = LANGUAGES) -> dict:
+        """
+        Runs a shell mode query, writing its outputs (hierarchy.txt, and dataflows.txt or codelists.txt)
+        to the client's working directory "cwd", as "main.query()" does.
+        Returns the query's report: url, where the response was served from, outputs, messages and elapsed time.
+        Raises a "RequestException" if the arguments don't make a query, or the request fails.
+        """
+        start = time.perf_counter()
+        session = CustomSession(
+            query_args(args),
+            cache=self.cache,
+            url_root=self.url_root,
+            languages=languages or LANGUAGES,
+        )
+        session.mount("https://", self.adapter)
+        session.mount("http://", self.adapter)
+        messages = [f"Session's resulting API: {session.url}"]
+        try:
+            response, served = self.response(session)
+        except RequestException:
+            with self.lock:
+                self.served["failed"] += 1
+            raise
+        with self.lock:
+            self.served[served] += 1
+        messages.append(f"Response served from: {served}")
+        outputs = [os.path.join(cwd, "hierarchy.txt")]
+        response.output_hierarchy(path=outputs[0])
+        if session.query_type == "structure" and session.artefact_type in EXTRACTORS:
+            extractor, output, name = EXTRACTORS[session.artefact_type]
+            outputs.append(os.path.join(cwd, name))
+            output(
+                self.extract(response, extractor),
+                outputs[-1],
+                languages=response.languages,
+            )
+        else:
+            pass
+        messages.append("Workflow completed!")
+        return {
+            "status": "OK",
+            "url": session.url,
+            "served": served,
+            "outputs": outputs,
+            "messages": messages,
+            "elapsed": time.perf_counter() - start,
+        }
+
+    def health(self) -> dict:
+        """
+        The daemon's status: uptime, number of warm responses, and queries served by origin.
+        """
+        with self.lock:
+            return {
+                "status": "OK",
+                "uptime": time.time() - self.started_at,
+                "warm": len(self.warm),
+                "served": dict(self.served),
+            }
+
+    def close(self) -> None:
+        self.adapter.close()
+        self.cache.close()
+
+
+def serve(
+    daemon: QueryDaemon, host: str = DAEMON_HOST, port: int = DAEMON_PORT
+) -> ThreadingHTTPServer:
+    """
+    Builds the HTTP server of the daemon (to be run with "serve_forever()"), answering:
+    - GET /health: the daemon's status (see "QueryDaemon.health()")
+    - POST /query, with a JSON body {"args": [...], "cwd": "...", "languages": [...]}: the query's report
+      (see "QueryDaemon.run()"), or {"status": "Failed", "error": "..."} with a 4xx status for an invalid request,
+      502 if the endpoint failed, or 500 if the query failed otherwise
+    Queries are only taken from local clients naming the daemon's address in their "Host" header,
+    with a "Content-Type: application/json" body. A web page can't send them (it can't set this content type
+    without a preflight request, nor its own host name once rebound to the loopback address), so it can't have
+    the daemon write files into an arbitrary directory; a local process could write them itself anyway.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path == "/health":
+                self.reply(200, daemon.health())
+            else:
+                self.reply(404, {"status": "Failed", "error": "Not Found"})
+
+        def do_POST(self) -> None:
+            if self.path != "/query":
+                self.reply(404, {"status": "Failed", "error": "Not Found"})
+                return
+            elif self.headers.get("Host") not in hosts:
+                self.reply(403, {"status": "Failed", "error": "Forbidden host"})
+                return
+            elif self.headers.get_content_type() != "application/json":
+                self.reply(
+                    415, {"status": "Failed", "error": "Expected application/json"}
+                )
+                return
+            else:
+                pass
+            try:
+                request = json.loads(
+                    self.rfile.read(int(self.headers["Content-Length"]))
+                )
+                args = query_args(request["args"])
+                cwd = request["cwd"]
+                languages = tuple(request.get("languages") or LANGUAGES)
+            except (KeyError, TypeError, ValueError, RequestException) as e:
+                self.reply(400, {"status": "Failed", "error": f"Invalid query: {e}"})
+                return
+            try:
+                self.reply(200, daemon.run(args, cwd, languages))
+            except RequestException as e:
+                self.reply(502, {"status": "Failed", "error": str(e)})
+            except Exception as e:
+                # Answered rather than dropped: the client takes a dropped connection for a missing daemon,
+                # and would run the query again by itself
+                self.reply(
+                    500, {"status": "Failed", "error": f"{type(e).__name__}: {e}"}
+                )
+
+        def reply(self, status: int, body: dict) -> None:
+            content = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    hosts = {f"{name}:{httpd.server_address[1]}" for name in (host, "localhost")}
+    """
+    Host headers the queries are taken with: the daemon's address (or "localhost") and port.
+    """
+    httpd.daemon_threads = True
+    return httpd
+
+
+def main() -> None:
+    """
+    Runs the daemon until interrupted, on the port given with "--port=..." (by default "DAEMON_PORT").
+    """
+    port = DAEMON_PORT
+    for arg in sys.argv[1:]:
+        if arg.startswith("--port="):
+            port = int(arg.split("=", 1)[1])
+        else:
+            pass
+    daemon = QueryDaemon()
+    httpd = serve(daemon, port=port)
+    print(f"Serving queries on http://{DAEMON_HOST}:{port} (Ctrl+C to stop)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        daemon.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+"""
+Decoders of the SDMX wire formats other than XML, producing the same outputs as the extractors of "standalone_functions"
+do on SDMX-ML:
+- SDMX-CSV (1.0 and 2.0) data, read row by row with a "csv" reader over the (raw) body
+- SDMX-JSON (1.0 and 2.0) data, read series by series with ijson when installed (incrementally, over the raw body),
+  otherwise loaded as a whole with the standard library
+- SDMX-JSON structures (dataflows and codelists), read artefact by artefact likewise
+Values are kept as the text they are sent as (e.g. "OBS_VALUE"), as in SDMX-ML.
+"""
+
+from decimal import Decimal
+from records import Code, Codelist, Dataflow, normalized, preferred
+from sys import intern
+import csv
+import io
+import json
+import re
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+CSV_STRUCTURE_COLUMNS = ("DATAFLOW", "STRUCTURE", "STRUCTURE_ID", "ACTION")
+"""
+Columns of SDMX-CSV identifying the structure of the rows (1.0: DATAFLOW, 2.0: STRUCTURE, STRUCTURE_ID, ACTION),
+rather than an observation's own properties.
+"""
+
+JSON_ROOTS = ("data.", "")
+"""
+Prefixes of the SDMX-JSON messages' contents: under "data" (2.0 and structure messages), at the root (older 1.0).
+"""
+
+URN_REFERENCE = re.compile(r"\.(\w+)=([^:]+):([^(]+)\(")
+"""
+Class, agency and id of the artefact referenced by an URN
+(e.g. "urn:sdmx:org.sdmx.infomodel.datastructure.DataStructure=OECD.SDD.NAD:DSD_NAAG(1.0)").
+"""
+
+
+def iter_csv_observations(source):
+    """
+    Decodes SDMX-CSV data: yields each row as an observation's dictionary, without the structure columns,
+    nor the empty values (as SDMX-ML omits the attributes missing). A row shorter than the header
+    is missing its last values, left out likewise.
+    """
+    reader = csv.reader(io.TextIOWrapper(source, encoding="utf-8-sig", newline=""))
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = [
+        (i, intern(field))
+        for i, field in enumerate(header)
+        if field not in CSV_STRUCTURE_COLUMNS
+    ]
+    for row in reader:
+        if row:
+            yield {field: row[i] for i, field in columns if i < len(row) and row[i]}
+
+
+def build(events, event: str, value):
+    """
+    Builds the JSON value starting with the given ijson event, consuming the events up to its end.
+    """
+    builder = ijson.ObjectBuilder()
+    builder.event(event, value)
+    depth = 1 if event in ("start_map", "start_array") else 0
+    while depth:
+        _, event, value = next(events)
+        builder.event(event, value)
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+        else:
+            pass
+    return builder.value
+
+
+def iter_json_data(source):
+    """
+    Reads an SDMX-JSON data message into its parts, in document order:
+    - ("structure", structure): the structure of the datasets (their dimensions and attributes)
+    - ("series", key, series): a series of a dataset
+    - ("observation", key, observation): an observation of a dataset without series ("AllDimensions")
+    With ijson, each part is built (and released) one at a time, as the message is read
+    (so the structure comes after the series if the message holds "dataSets" first).
+    """
+    if ijson is None:
+        message = json.load(source, parse_float=Decimal)
+        data = message.get("data", message)
+        structures = data.get("structures") or [data.get("structure", {})]
+        for structure in structures:
+            yield "structure", structure
+        for dataset in data.get("dataSets", []):
+            for key, series in dataset.get("series", {}).items():
+                yield "series", key, series
+            for key, observation in dataset.get("observations", {}).items():
+                yield "observation", key, observation
+        return
+    structures = {f"{root}structures.item" for root in JSON_ROOTS} | {
+        f"{root}structure" for root in JSON_ROOTS
+    }
+    series = {f"{root}dataSets.item.series" for root in JSON_ROOTS}
+    observations = {f"{root}dataSets.item.observations" for root in JSON_ROOTS}
+    events = ijson.parse(source)
+    for prefix, event, value in events:
+        if event == "start_map" and prefix in structures:
+            yield "structure", build(events, event, value)
+        elif event == "map_key" and prefix in series:
+            _, event, item = next(events)
+            yield "series", value, build(events, event, item)
+        elif event == "map_key" and prefix in observations:
+            _, event, item = next(events)
+            yield "observation", value, build(events, event, item)
+        else:
+            pass
+
+
+def component_values(component: dict) -> tuple:
+    """
+    The id of a dimension or attribute, and its values (their ids, or else their text), by index.
+    """
+    values = []
+    for value in component.get("values", []):
+        if isinstance(value, dict):
+            value = value.get("id", value.get("value", value.get("name")))
+        else:
+            pass
+        values.append(None if value is None else str(value))
+    return intern(component["id"]), values
+
+
+def json_layout(structure: dict) -> tuple:
+    """
+    The components of the datasets of a structure, decoded once for all their series:
+    - the dataset level dimensions' values, common to all the observations
+    - the series' dimensions and attributes, then the observations' dimensions, measures and attributes
+    """
+    dimensions = structure.get("dimensions", {})
+    attributes = structure.get("attributes", {})
+    measures = structure.get("measures", {}).get("observation") or [{"id": "OBS_VALUE"}]
+    constants = {}
+    for dimension in dimensions.get("dataSet", []):
+        id_, values = component_values(dimension)
+        if values:
+            constants[id_] = values[0]
+        else:
+            pass
+    return (
+        constants,
+        [component_values(d) for d in dimensions.get("series", [])],
+        [component_values(a) for a in attributes.get("series", [])],
+        [component_values(d) for d in dimensions.get("observation", [])],
+        [intern(m["id"]) for m in measures],
+        [component_values(a) for a in attributes.get("observation", [])],
+    )
+
+
+def json_part_observations(layout: tuple, part: tuple):
+    """
+    Decodes a series or an observation of an SDMX-JSON dataset (see "iter_json_data()"),
+    given the layout of the datasets' structure (see "json_layout()").
+    """
+    (
+        constants,
+        series_dimensions,
+        series_attributes,
+        observation_dimensions,
+        measures,
+        observation_attributes,
+    ) = layout
+    properties = dict(constants)
+    if part[0] == "series":
+        _, key, series = part
+        for (id_, values), index in zip(series_dimensions, key.split(":")):
+            properties[id_] = values[int(index)]
+        for (id_, values), index in zip(
+            series_attributes, series.get("attributes") or []
+        ):
+            if index is not None and values[index] is not None:
+                properties[id_] = values[index]
+            else:
+                pass
+        observations = series.get("observations", {}).items()
+    else:
+        observations = [part[1:]]
+    for key, observation_values in observations:
+        observation = properties.copy()
+        for (id_, values), index in zip(observation_dimensions, key.split(":")):
+            observation[id_] = values[int(index)]
+        for id_, value in zip(measures, observation_values):
+            if value is not None:
+                observation[id_] = str(value)
+            else:
+                pass
+        for (id_, values), index in zip(
+            observation_attributes, observation_values[len(measures) :]
+        ):
+            if index is not None and values[index] is not None:
+                observation[id_] = values[index]
+            else:
+                pass
+        yield observation
+
+
+def iter_json_observations(source):
+    """
+    Decodes SDMX-JSON data: yields each observation as a dictionary of its series' dimensions and attributes,
+    followed by its own dimensions (e.g. TIME_PERIOD), measures (e.g. OBS_VALUE) and attributes, as in SDMX-ML.
+    Missing (null) values are left out, as SDMX-ML omits them.
+    The keys of a JSON object come in no set order: the series read before the structure (e.g. with "dataSets" first)
+    are held until the structure is read, then decoded.
+    Raises a ValueError if the message holds several structures: which of them a series is keyed on
+    is not decoded.
+    """
+    layout = None
+    pending = []
+    for part in iter_json_data(source):
+        if part[0] == "structure":
+            if layout is None:
+                layout = json_layout(part[1])
+                for pending_part in pending:
+                    yield from json_part_observations(layout, pending_part)
+                pending = []
+            else:
+                raise ValueError(
+                    "SDMX-JSON messages with several structures are not supported"
+                )
+        elif layout is None:
+            pending.append(part)
+        else:
+            yield from json_part_observations(layout, part)
+    for pending_part in pending:
+        yield from json_part_observations(json_layout({}), pending_part)
+
+
+def iter_json_artefacts(source, artefact_type: str):
+    """
+    Reads the artefacts of a type ("dataflows", "codelists") from an SDMX-JSON structure message, one at a time.
+    """
+    if ijson is None:
+        message = json.load(source)
+        yield from message.get("data", message).get(artefact_type, [])
+        return
+    items = {f"{root}{artefact_type}.item" for root in JSON_ROOTS}
+    events = ijson.parse(source)
+    for prefix, event, value in events:
+        if event == "start_map" and prefix in items:
+            yield build(events, event, value)
+        else:
+            pass
+
+
+def json_names(artefact: dict, languages: tuple) -> dict:
+    """
+    The names of an artefact or code in each of the requested languages, normalized:
+    from its localized "names", or else its "name" (in the negotiated language, the first requested).
+    """
+    names = artefact.get("names")
+    if names is None:
+        names = {languages[0]: artefact["name"]} if "name" in artefact else {}
+    return {
+        language: normalized(names[language])
+        for language in languages
+        if language in names
+    }
+
+
+def reference_id(reference: str) -> str:
+    """
+    The id of a referenced item, given as is or as an URN (e.g. "urn:...Code=OECD:CL_AREA(1.0).AUS").
+    """
+    if "=" in reference:
+        return reference.rpartition(").")[2]
+    return reference
+
+
+def iter_json_dataflows(source, languages: tuple):
+    """
+    Decodes the dataflows of an SDMX-JSON structure message into "Dataflow()" records (see "iter_dataflows()").
+    """
+    multilingual = len(languages) > 1
+    for dataflow in iter_json_artefacts(source, "dataflows"):
+        names = json_names(dataflow, languages)
+        reference = URN_REFERENCE.search(dataflow.get("structure") or "")
+        if reference is not None:
+            reference_class, reference_agencyID, reference_id_ = reference.groups()
+        else:
+            reference_class = reference_agencyID = reference_id_ = "None"
+        yield Dataflow(
+            dataflow["id"],
+            intern(dataflow["agencyID"]),
+            preferred(names, languages),
+            reference_id_,
+            intern(reference_agencyID),
+            intern(reference_class),
+            (
+                {language: names.get(language, "") for language in languages}
+                if multilingual
+                else None
+            ),
+        )
+
+
+def iter_json_codelists(source, languages: tuple):
+    """
+    Decodes the codes of an SDMX-JSON structure message into "Code()" records (see "iter_codelists()").
+    """
+    multilingual = len(languages) > 1
+    for codelist in iter_json_artefacts(source, "codelists"):
+        names = json_names(codelist, languages)
+        codelist_name = preferred(names, languages)
+        parent_codelist = Codelist(
+            intern(codelist["agencyID"]),
+            codelist["id"],
+            codelist_name,
+            (
+                {language: names.get(language, "") for language in languages}
+                if multilingual
+                else None
+            ),
+        )
+        for code in codelist.get("codes", []):
+            code_names = json_names(code, languages)
+            code_name = preferred(code_names, languages)
+            if code_names:
+                codelist_name = code_name
+            else:
+                pass
+            parent = code.get("parent")
+            yield Code(
+                parent_codelist,
+                codelist_name,
+                code["id"],
+                code_name,
+                intern(reference_id(parent)) if parent else "None",
+                (
+                    {language: code_names.get(language, "") for language in languages}
+                    if multilingual
+                    else None
+                ),
+            )
+
+
+DECODERS = {
+    ("csv", "observations"): iter_csv_observations,
+    ("json", "observations"): iter_json_observations,
+    ("json", "dataflows"): iter_json_dataflows,
+    ("json", "codelists"): iter_json_codelists,
+}
+"""
+Decoder of each kind of rows ("observations", "dataflows", "codelists"), by wire format.
+"""
+
+
+def decoder(response, kind: str):
+    """
+    Returns the decoder of the rows of a non-XML response (see "CustomResponse.format"),
+    or raises a ValueError if its format holds no such rows (e.g. codelists in SDMX-CSV).
+    """
+    if (response.format, kind) not in DECODERS:
+        raise ValueError(f"No {kind} to decode from a {response.format} response")
+    return DECODERS[(response.format, kind)]
@@ -0,0 +1,404 @@
+from functools import partial
+from itertools import chain, islice
+from tabulate import tabulate
+import instrumentation
+import csv
+import gzip
+import os
+
+CHUNK_SIZE = 10000
+"""
+Number of rows handed over to an exporter at a time.
+"""
+
+
+class TextExporter:
+    """
+    Writes the rows as a fixed-width table (tabulate), the layout of dataflows.txt/codelists.txt.
+    tabulate measures every cell before writing, so the rows are held until the exporter is closed
+    (its columns being the fields of all the rows, whether or not they "evolve").
+    """
+
+    def __init__(self, path: str, fields: list, evolve: bool = False) -> None:
+        self.path = path
+        self.rows = []
+
+    def write(self, rows: list) -> None:
+        self.rows.extend(rows)
+
+    def close(self) -> None:
+        with open(self.path, "w") as file:
+            file.write(tabulate(self.rows, "keys"))
+
+
+class CsvExporter:
+    """
+    Writes the rows as CSV, optionally gzip compressed, one chunk at a time.
+    Fields a row lacks are left empty. Fields outside of "fields" raise a ValueError, unless the columns "evolve":
+    the new fields are then added as columns after the others, and once closed, the file is rewritten
+    with the header of all the fields (the rows written before a field appeared being padded).
+    """
+
+    def __init__(
+        self, path: str, fields: list, compress: bool = False, evolve: bool = False
+    ) -> None:
+        self.path = path
+        self.compress = compress
+        self.fields = list(fields)
+        self.known = set(self.fields)
+        self.evolve = evolve
+        self.evolved = False
+        self.file = self.open(path, "w")
+        self.writer = csv.DictWriter(self.file, self.fields)
+        self.writer.writeheader()
+
+    def open(self, path: str, mode: str):
+        if self.compress:
+            return gzip.open(path, mode + "t", newline="", compresslevel=6)
+        return open(path, mode, newline="")
+
+    def write(self, rows: list) -> None:
+        if self.evolve and not self.known.issuperset(chain.from_iterable(rows)):
+            for row in rows:
+                for field in row:
+                    if field not in self.known:
+                        self.known.add(field)
+                        self.fields.append(field)
+                    else:
+                        pass
+            self.writer.fieldnames = self.fields
+            self.evolved = True
+        else:
+            pass
+        self.writer.writerows(rows)
+
+    def close(self) -> None:
+        self.file.close()
+        if self.evolved:
+            self.rewrite()
+        else:
+            pass
+
+    def rewrite(self) -> None:
+        """
+        Rewrites the file with the header of all the fields, row by row, padding the rows written before
+        the last fields appeared (they lack these trailing columns).
+        """
+        previous = self.path + ".evolving"
+        os.replace(self.path, previous)
+        try:
+            with self.open(previous, "r") as source, self.open(
+                self.path, "w"
+            ) as target:
+                reader = csv.reader(source)
+                next(reader)
+                writer = csv.writer(target)
+                writer.writerow(self.fields)
+                width = len(self.fields)
+                writer.writerows(row + [""] * (width - len(row)) for row in reader)
+        finally:
+            os.remove(previous)
+
+
+class ArrowExporter:
+    """
+    Writes the rows as a Parquet file ("parquet") or an Arrow IPC file ("ipc"), one record batch per chunk
+    (requires pyarrow):
+    - the text fields are dictionary encoded (see "encode()"); values of other types are encoded as their text
+    - the other fields keep the type inferred from the first chunk, unless a later chunk doesn't fit it:
+      the schema is then widened (integers to floats, any other mismatch to text, all-null fields to any type),
+      and the batches written so far are rewritten with it (see "evolve()")
+    Fields outside of "fields" raise a ValueError, unless the columns "evolve": they're then added to the schema.
+    """
+
+    def __init__(
+        self, path: str, fields: list, format: str = "parquet", evolve: bool = False
+    ) -> None:
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError(
+                f'Exporting to "{path}" requires pyarrow: pip install pyarrow'
+            ) from None
+        self.pyarrow = pyarrow
+        self.path = path
+        self.fields = list(fields)
+        self.format = format
+        self.evolve_fields = evolve
+        self.schema = None
+        self.writer = None
+        self.dictionaries = {}
+        """
+        The code of each distinct value, and the distinct values, of each dictionary encoded field.
+        """
+        self.dictionary_arrays = {}
+        """
+        The distinct values of each dictionary encoded field as an Arrow array, extended with the new values only.
+        """
+
+    def encode(self, field: str, values: list):
+        """
+        Dictionary encodes the values of a text field:
+        - for Parquet, against a dictionary of the chunk's own values (Parquet re-encodes each row group's values,
+          so a dictionary growing across the chunks would make each row group cost as much as all the previous ones)
+        - for IPC, against the field's dictionary so far: only the values new to the dictionary are converted
+          and appended to its array (written as a delta)
+        """
+        pa = self.pyarrow
+        if self.format != "ipc":
+            try:
+                array = pa.array(values, type=pa.string())
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                array = pa.array(
+                    [
+                        value if value is None or isinstance(value, str) else str(value)
+                        for value in values
+                    ],
+                    type=pa.string(),
+                )
+            encoded = array.dictionary_encode()
+            return pa.DictionaryArray.from_arrays(
+                encoded.indices.cast(pa.int32()), encoded.dictionary
+            )
+        lookup, dictionary = self.dictionaries[field]
+        indices = []
+        for value in values:
+            if value is None:
+                indices.append(None)
+                continue
+            code = lookup.get(value)
+            if code is None:
+                text = value if isinstance(value, str) else str(value)
+                code = lookup.get(text)
+                if code is None:
+                    code = lookup[text] = len(dictionary)
+                    dictionary.append(text)
+                else:
+                    pass
+                lookup[value] = code
+            indices.append(code)
+        array = self.dictionary_arrays.get(field)
+        if array is None or len(array) < len(dictionary):
+            added = pa.array(
+                dictionary[0 if array is None else len(array) :], type=pa.string()
+            )
+            array = self.dictionary_arrays[field] = (
+                added if array is None else pa.concat_arrays([array, added])
+            )
+        else:
+            pass
+        return pa.DictionaryArray.from_arrays(pa.array(indices, type=pa.int32()), array)
+
+    def infer(self, values: list):
+        """
+        The type of a field, from its values: text (and mixed values) as a dictionary of strings.
+        """
+        pa = self.pyarrow
+        try:
+            type_ = pa.array(values).type
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, OverflowError):
+            type_ = pa.string()
+        if pa.types.is_string(type_) or pa.types.is_large_string(type_):
+            return pa.dictionary(pa.int32(), pa.string())
+        return type_
+
+    def widen(self, type_, inferred):
+        """
+        The type holding both a field's current type and the type inferred from its new values, if it doesn't fit
+        (see the class' description), otherwise None.
+        """
+        pa = self.pyarrow
+        if (
+            inferred == type_
+            or pa.types.is_null(inferred)
+            or (pa.types.is_floating(type_) and pa.types.is_integer(inferred))
+        ):
+            return None
+        elif pa.types.is_null(type_):
+            return inferred
+        elif (pa.types.is_integer(type_) or pa.types.is_floating(type_)) and (
+            pa.types.is_integer(inferred) or pa.types.is_floating(inferred)
+        ):
+            return pa.float64()
+        return pa.dictionary(pa.int32(), pa.string())
+
+    def array(self, field: str, values: list):
+        if field in self.dictionaries:
+            return self.encode(field, values)
+        return self.pyarrow.array(values, type=self.schema.field(field).type)
+
+    def open(self, types: dict) -> None:
+        """
+        Opens the writer, with the schema of the given field types.
+        """
+        pa = self.pyarrow
+        for field, type_ in types.items():
+            if pa.types.is_dictionary(type_) and field not in self.dictionaries:
+                self.dictionaries[field] = ({}, [])
+            else:
+                pass
+        self.schema = pa.schema(
+            [pa.field(field, types[field]) for field in self.fields]
+        )
+        if self.format == "ipc":
+            import pyarrow.ipc
+
+            options = pyarrow.ipc.IpcWriteOptions(
+                compression="zstd", emit_dictionary_deltas=True
+            )
+            self.writer = pyarrow.ipc.new_file(self.path, self.schema, options=options)
+        else:
+            import pyarrow.parquet
+
+            self.writer = pyarrow.parquet.ParquetWriter(
+                self.path, self.schema, compression="zstd"
+            )
+
+    def batches(self, path: str):
+        """
+        Reads back the record batches of a file written by the exporter, one at a time.
+        """
+        if self.format == "ipc":
+            import pyarrow.ipc
+
+            with self.pyarrow.memory_map(path) as source:
+                reader = pyarrow.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    yield reader.get_batch(i)
+        else:
+            import pyarrow.parquet
+
+            yield from pyarrow.parquet.ParquetFile(path).iter_batches()
+
+    def evolve(self, types: dict, columns: dict) -> None:
+        """
+        Widens the schema to the given field types (and the new fields), and rewrites the batches written so far
+        with it, one at a time: a Parquet/IPC file can't change its schema once written.
+        The dictionaries of the fields newly encoded start with the values of the chunk being written ("columns"),
+        as an IPC file can't grow a dictionary written empty.
+        """
+        self.writer.close()
+        previous = self.path + ".evolving"
+        os.replace(self.path, previous)
+        try:
+            self.open(
+                {
+                    field: types.get(field) or self.schema.field(field).type
+                    for field in self.fields
+                }
+            )
+            for field in types:
+                if field in self.dictionaries:
+                    self.encode(field, columns[field])
+                else:
+                    pass
+            for batch in self.batches(previous):
+                columns = batch.to_pydict()
+                self.write_columns(
+                    {
+                        field: columns.get(field) or [None] * batch.num_rows
+                        for field in self.fields
+                    }
+                )
+        finally:
+            os.remove(previous)
+
+    def write_columns(self, columns: dict) -> None:
+        arrays = [self.array(field, columns[field]) for field in self.fields]
+        self.writer.write_batch(self.pyarrow.record_batch(arrays, schema=self.schema))
+
+    def write(self, rows: list) -> None:
+        columns = {field: [] for field in self.fields}
+        for i, row in enumerate(rows):
+            for field in row:
+                if field in columns:
+                    continue
+                elif not self.evolve_fields:
+                    raise ValueError(f"Row contains fields not in {self.fields}")
+                self.fields.append(field)
+                columns[field] = [None] * i
+            for field, values in columns.items():
+                values.append(row.get(field))
+        if self.writer is None:
+            self.open({field: self.infer(columns[field]) for field in self.fields})
+            self.write_columns(columns)
+            return
+        types = {}
+        for field in self.fields:
+            if field not in self.schema.names:
+                types[field] = self.infer(columns[field])
+            elif field not in self.dictionaries:
+                type_ = self.widen(
+                    self.schema.field(field).type, self.infer(columns[field])
+                )
+                if type_ is not None:
+                    types[field] = type_
+                else:
+                    pass
+            else:
+                pass
+        if types:
+            self.evolve(types, columns)
+        else:
+            pass
+        self.write_columns(columns)
+
+    def close(self) -> None:
+        if self.writer is None:
+            self.open({field: self.infer([]) for field in self.fields})
+        self.writer.close()
+
+
+EXPORTERS = {
+    ".txt": TextExporter,
+    ".csv": CsvExporter,
+    ".csv.gz": partial(CsvExporter, compress=True),
+    ".parquet": ArrowExporter,
+    ".arrow": partial(ArrowExporter, format="ipc"),
+}
+"""
+Available exporters, by file extension.
+"""
+
+
+def exporter(path: str, fields: list, evolve: bool = False):
+    """
+    Returns the exporter matching the extension of the output file, its columns evolving if asked
+    (new fields added as they appear, see "CsvExporter()" and "ArrowExporter()").
+    """
+    for extension in sorted(EXPORTERS, key=len, reverse=True):
+        if path.endswith(extension):
+            return EXPORTERS[extension](path, fields, evolve=evolve)
+    raise ValueError(
+        f'Unsupported output format: "{path}" (supported: {list(EXPORTERS)})'
+    )
+
+
+def export(rows, path: str, fields: list = None, chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Writes the rows (dictionaries, e.g. from a generator) to an output file, in the format given by its extension,
+    "chunk_size" rows at a time, so that they never have to be held all at once (except for ".txt").
+    Unless "fields" are given, the columns are the fields of all the rows, in order of appearance: those of the first
+    chunk, then the others as they appear (the exporter's columns "evolve").
+    Returns the number of rows written.
+    Instrumented as a "write" span (which includes the extraction, when the rows come from a generator).
+    """
+    with instrumentation.span("write", path=path) as write:
+        rows = iter(rows)
+        chunk = list(islice(rows, chunk_size))
+        evolve = fields is None
+        if evolve:
+            fields = list(dict.fromkeys(field for row in chunk for field in row))
+        else:
+            pass
+        out = exporter(path, fields, evolve)
+        count = 0
+        try:
+            while chunk:
+                out.write(chunk)
+                count += len(chunk)
+                chunk = list(islice(rows, chunk_size))
+        finally:
+            out.close()
+        write["rows"] = count
+    return count
@@ -0,0 +1,201 @@
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+LISTENERS = []
+"""
+Callbacks receiving the instrumentation events, each event being a dictionary with a "type":
+- "span": a timed stage ("name", "start", "duration", "thread", and the stage's own attributes)
+- "count": a counter increment ("name", "value")
+- "message": a status message meant for the user ("text")
+Without listeners, the events are dropped: nothing is printed or recorded.
+"""
+
+
+def add_listener(listener) -> None:
+    """
+    Registers a callback, called with every event (from any thread).
+    """
+    LISTENERS.append(listener)
+
+
+def remove_listener(listener) -> None:
+    LISTENERS.remove(listener)
+
+
+def enabled() -> bool:
+    """
+    Whether anyone listens, so that costly measurements (e.g. counting elements) can be skipped otherwise.
+    """
+    return bool(LISTENERS)
+
+
+def emit(event: dict) -> None:
+    for listener in list(LISTENERS):
+        listener(event)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Times a stage of the pipeline (e.g. "request", "download", "parse", "extract", "write").
+    Yields the attributes of the span, which the stage can complete (e.g. with the bytes it handled).
+    The span is emitted once the stage ends, even if it fails (with the exception's name as "error"),
+    or if it's left early by a generator that is closed.
+    """
+    start = time.time()
+    begin = time.perf_counter()
+    try:
+        yield attributes
+    except GeneratorExit:
+        raise
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        if LISTENERS:
+            emit(
+                {
+                    "type": "span",
+                    "name": name,
+                    "start": start,
+                    "duration": time.perf_counter() - begin,
+                    "thread": threading.current_thread().name,
+                    **attributes,
+                }
+            )
+
+
+def count(name: str, value: float = 1) -> None:
+    """
+    Increments a counter (e.g. "bytes_received", "elements").
+    """
+    if LISTENERS:
+        emit({"type": "count", "name": name, "value": value})
+
+
+def message(text: str) -> None:
+    """
+    Emits a status message, printed only by the "console()" listener.
+    """
+    if LISTENERS:
+        emit({"type": "message", "text": text})
+
+
+def console(event: dict) -> None:
+    """
+    Listener printing the status messages, as the command-line interface does.
+    """
+    if event["type"] == "message":
+        print(event["text"])
+    else:
+        pass
+
+
+class TimingReport:
+    """
+    Listener aggregating the events into a timing report:
+    - the calls, total and maximum duration of each span name, and the list of all the spans, in order
+    - the total of each counter
+    - optionally, the profile and the top allocations of the run (see "profiled()")
+    Written as JSON with "write()".
+    """
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.spans = []
+        self.counters = {}
+        self.profile = None
+        """
+        Top functions (cProfile) and allocations (tracemalloc) of the run, if profiled.
+        """
+
+    def __call__(self, event: dict) -> None:
+        with self.lock:
+            if event["type"] == "span":
+                self.spans.append({k: v for k, v in event.items() if k != "type"})
+            elif event["type"] == "count":
+                self.counters[event["name"]] = (
+                    self.counters.get(event["name"], 0) + event["value"]
+                )
+            else:
+                pass
+
+    def summary(self) -> dict:
+        """
+        The calls, total and maximum duration (in seconds) of each span name, in order of first appearance.
+        """
+        stages = {}
+        with self.lock:
+            for s in self.spans:
+                stage = stages.setdefault(
+                    s["name"], {"calls": 0, "total": 0.0, "max": 0.0}
+                )
+                stage["calls"] += 1
+                stage["total"] += s["duration"]
+                stage["max"] = max(stage["max"], s["duration"])
+        return stages
+
+    def write(self, path: str = "timing.json") -> None:
+        """
+        Writes the report to an output file (by default timing.json), as JSON.
+        """
+        report = {
+            "started": self.started,
+            "elapsed": time.time() - self.started,
+            "stages": self.summary(),
+            "counters": dict(self.counters),
+            "spans": list(self.spans),
+        }
+        if self.profile is not None:
+            report["profile"] = self.profile
+        with open(path, "w") as file:
+            json.dump(report, file, indent=2, default=str)
+
+
+@contextmanager
+def profiled(report: TimingReport, path: str = "profile.prof", top: int = 20):
+    """
+    Profiles the enclosed run with cProfile and tracemalloc:
+    - the cProfile stats are dumped to "path" (for pstats/snakeviz)
+    - the "top" functions by cumulative time, the "top" allocation sites and the peak traced memory
+      are added to the report
+    """
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        profiler.dump_stats(path)
+        stats = pstats.Stats(profiler)
+        functions = sorted(stats.stats.items(), key=lambda s: s[1][3], reverse=True)
+        report.profile = {
+            "path": path,
+            "functions": [
+                {
+                    "function": f"{file}:{line}({name})",
+                    "calls": calls,
+                    "own": own,
+                    "cumulative": cumulative,
+                }
+                for (file, line, name), (_, calls, own, cumulative, _) in functions[
+                    :top
+                ]
+            ],
+            "peak_allocated": peak,
+            "allocations": [
+                {"site": str(stat.traceback), "size": stat.size, "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:top]
+            ],
+        }
@@ -1,135 +1,334 @@
-from requests import RequestException
-from CustomSession import CustomSession
-import standalone_functions as fct
-import sqlite3
+"""
+Command line of the queries (see "query()"), parsed with argparse.
+The heavy dependencies (requests, the parsers, tabulate, sqlite3) are imported lazily, on first use (see "LAZY_IMPORTS"),
+and each mode's only when it runs (see "MODES"): usage errors, "--help" and the validation of the arguments
+return without loading the HTTP and XML stacks. Measure with: python -X importtime main.py --help
+"""
+
+from contextlib import nullcontext
+import argparse
+import instrumentation
+import os
 import sys
 
+LAZY_IMPORTS = {
+    "RequestException": ("requests", "RequestException"),
+    "CustomSession": ("CustomSession", "CustomSession"),
+    "LANGUAGES": ("CustomSession", "LANGUAGES"),
+    "JobLedger": ("JobLedger", "JobLedger"),
+    "ResponseCache": ("ResponseCache", "ResponseCache"),
+    "fct": ("standalone_functions", None),
+    "batch": ("batch", None),
+    "reconciliation": ("reconciliation", None),
+    "sqlite3": ("sqlite3", None),
+}
+"""
+Module attributes imported on first use, by name: module, and attribute of the module (None for the module itself).
+"""
+
+MODES_HELP = 'Choose mode among: "--interactive"|"-i", "--shell"|"-s" or "--batch"|"-b"'
+"""
+Message of the usage errors, listing the run modes.
+"""
+
+
+def __getattr__(name: str):
+    """
+    Imports a lazy module attribute (see "LAZY_IMPORTS") on its first access, e.g. "main.CustomSession",
+    keeping it as a regular module attribute (so it can be patched) from then on.
+    Imported with "__import__" (as an import statement is), so that it's timed by "-X importtime".
+    """
+    if name not in LAZY_IMPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module, attribute = LAZY_IMPORTS[name]
+    __import__(module)
+    value = sys.modules[module]
+    if attribute is not None:
+        value = getattr(value, attribute)
+    else:
+        pass
+    globals()[name] = value
+    return value
+
+
+def load(*names: str) -> None:
+    """
+    Imports the lazy module attributes a function uses (see "LAZY_IMPORTS"), unless already imported (or patched).
+    """
+    for name in names:
+        if name not in globals():
+            __getattr__(name)
+        else:
+            pass
+
+
+class CommandParser(argparse.ArgumentParser):
+    """
+    Argument parser exiting with the command line's own messages (see "MODES_HELP") on usage errors.
+    """
+
+    def error(self, message: str):
+        sys.exit(f"{MODES_HELP} ({message})\n")
+
+
+def languages_list(value: str) -> tuple:
+    """
+    Parses the "--languages" flag: comma-separated languages, in order of preference.
+    """
+    return tuple(language for language in value.split(",") if language)
+
+
+def parser() -> CommandParser:
+    """
+    Builds the parser of the command line: one of the run modes, each taking its own arguments,
+    plus the "--profile" and "--languages" flags, anywhere among the arguments.
+    """
+    parser = CommandParser(
+        prog="main.py",
+        description="Runs API queries requesting OECD resources (SDMX).",
+        epilog="For API syntax consult: https://github.com/sdmx-twg/sdmx-rest/blob/master/doc/index.md",
+    )
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument(
+        "-i",
+        "--interactive",
+        nargs="*",
+        metavar="",
+        help="asks for the query interactively (takes no arguments)",
+    )
+    modes.add_argument(
+        "-s",
+        "--shell",
+        nargs="*",
+        metavar="ARG",
+        help='runs the query given as arguments: "structure" artefact [agency_id resource_id version item_id] '
+        '[parameters], or "data" context agency_id dataflow_id dataflow_version filter_expression optional_parameters',
+    )
+    modes.add_argument(
+        "-b",
+        "--batch",
+        nargs="*",
+        metavar="MANIFEST",
+        help="runs the data queries listed in a manifest (CSV file), checkpointed in job_ledger.db",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="profiles the run with cProfile/tracemalloc (stats in profile.prof)",
+    )
+    parser.add_argument(
+        "--languages",
+        type=languages_list,
+        metavar="fr,en",
+        help="languages the names are requested and extracted in, in order of preference",
+    )
+    return parser
+
+
+def parse(argv: list) -> argparse.Namespace:
+    """
+    Parses the command line's arguments (without the program's name): the run mode, found in "mode",
+    its arguments, found in "args", and the "--profile"/"--languages" flags.
+    Exits with the usage error if there's no run mode.
+    """
+    if not argv:
+        sys.exit("Provide at least one argument to specify the run mode\n")
+    else:
+        pass
+    options = parser().parse_args(argv)
+    options.mode = None
+    options.args = None
+    for mode in MODES:
+        if getattr(options, mode) is not None:
+            options.mode = mode
+            options.args = getattr(options, mode)
+        else:
+            pass
+    if options.mode is None:
+        sys.exit(f"{MODES_HELP}\n")
+    return options
+
 
-def query() -> None:
+def makes_query(args: list) -> bool:
+    """
+    Whether the arguments of a shell mode query have the number its query type takes:
+    - "structure", the artefact type, up to four path segments (agency, resource id, version, item id)
+      and, last, optionally the query parameters (the only argument containing "=")
+    - "data" and the six arguments of a data query
+    The values themselves are checked when the query is built (see "CustomSession.build_query()").
+    """
+    if args and args[0] == "structure":
+        return 2 <= len(args) <= 6 + ("=" in args[-1])
+    else:
+        return len(args) == 7 and args[0] == "data"
+
+
+def shell_args(args: list) -> list:
+    """
+    Checks the arguments of a shell mode query (everything after "--shell"), exiting with the usage error
+    if they don't make a query.
+    """
+    if not args:
+        sys.exit(
+            "Shell mode requires additional arguments, at least two more (for the query type and for the artefact/context)\n"
+        )
+    elif makes_query(args):
+        return list(args)
+    elif args[0] == "structure":
+        sys.exit(
+            "For structure queries, one to five more arguments needed after the query type: \n"
+            "* artefact\n"
+            "* agency_id (optional)\n"
+            "* resource_id (optional)\n"
+            "* version (optional)\n"
+            "* item_id (optional)\n"
+            'plus, optionally, the query parameters (e.g. "detail=allstubs&references=none")\n'
+        )
+    elif args[0] == "data":
+        sys.exit(
+            "For data queries, 6 more arguments needed after the query type: \n"
+            "* context\n"
+            "* agency_id\n"
+            "* dataflow_id\n"
+            "* dataflow_version\n"
+            "* filter_expression\n"
+            "* optional_parameters\n"
+        )
+    else:
+        sys.exit('Supported query types: "structure" and "data"\n')
+
+
+def write_outputs(session, response) -> None:
+    """
+    Writes the outputs of a query: the response's hierarchy (hierarchy.txt), and for dataflow/codelist
+    structure queries, the extracted dataflows/codes (dataflows.txt/codelists.txt).
+    """
+    response.detail()
+    print(
+        "\nPrettyfying the response and writing it to the output file(hierarchy.txt)..."
+    )
+    response.output_hierarchy()
+    print("Operation completed!")
+    if session.query_type == "structure":
+        if session.artefact_type == "dataflow":
+            print(
+                "\nExtracting relevant information from the inquired dataflows and writing it to the output file(dataflows.txt)..."
+            )
+            fct.output_dataflows(fct.dataflows(response), languages=response.languages)
+            print("Operation completed!")
+        elif session.artefact_type == "codelist":
+            print(
+                "\nExtracting relevant information from the inquired codelists and writing it to the output file(codelists.txt)..."
+            )
+            fct.output_codelists(fct.codelists(response), languages=response.languages)
+            print("Operation completed!")
+        else:
+            pass
+    else:
+        pass
+    print("\nWorkflow completed!")
+
+
+def interactive_mode(args: list, languages: tuple) -> None:
+    """
+    Asks for the query interactively (until a request succeeds), writes its outputs, and offers to query some more.
+    """
+    if args:
+        sys.exit("Interactive mode does not take other arguments\n")
+    else:
+        pass
+    load("CustomSession", "LANGUAGES", "RequestException", "fct")
+    languages = languages or LANGUAGES
+    while True:
+        session = CustomSession(languages=languages)
+        print(f"\nSession's resulting API: {session.url}")
+        try:
+            print("Sending request to endpoint, waiting for response...")
+            response = session.get()
+            break
+        except RequestException as e:
+            print(f'\nCaught an exception: "{e}"')
+            continue
+    write_outputs(session, response)
+
+    while True:
+        match input("Would you like to query some more? ").lower():
+            case "yes" | "y":
+                query(languages)
+            case "no" | "n":
+                sys.exit("End of session, EXITED\n")
+            case _:
+                print('Choose a valid option: "yes"/"y" or "no"/"n"')
+
+
+def shell_mode(args: list, languages: tuple) -> None:
+    """
+    Runs the query given as arguments (see "shell_args()"), and writes its outputs.
+    """
+    args = shell_args(args)
+    load("CustomSession", "LANGUAGES", "RequestException", "fct")
+    session = CustomSession(args, languages=languages or LANGUAGES)
+    print(f"\nSession's resulting API: {session.url}")
+    try:
+        print("Sending request to endpoint, waiting for response...")
+        response = session.get()
+    except RequestException as e:
+        sys.exit(f'\nCaught an exception: "{e}"\n')
+    write_outputs(session, response)
+
+
+def batch_mode(args: list, languages: tuple) -> None:
+    """
+    Runs the data queries listed in a manifest concurrently (see "batch.run_batch()"), checkpointed in job_ledger.db:
+    rerun after a failure, it skips the queries done and resumes the interrupted downloads.
+    """
+    if len(args) != 1:
+        sys.exit(
+            "Batch mode requires one more argument: the manifest of data queries (CSV file)\n"
+        )
+    else:
+        pass
+    load("batch", "JobLedger")
+    try:
+        manifest = batch.read_manifest(args[0])
+    except (OSError, ValueError) as e:
+        sys.exit(f'\nCaught an exception: "{e}"\n')
+    ledger = JobLedger()
+    try:
+        batch.run_batch(manifest, ledger=ledger, job=os.path.abspath(args[0]))
+    finally:
+        ledger.close()
+    print("Workflow completed!")
+
+
+MODES = {
+    "interactive": interactive_mode,
+    "shell": shell_mode,
+    "batch": batch_mode,
+}
+"""
+Function running each mode, by name; each imports its own dependencies when it runs.
+"""
+
+
+def query(languages: tuple = None, options: argparse.Namespace = None) -> None:
     """
     Function for running API queries requesting OECD resources.
-    Takes a command-line argument specifying the run mode.
-    Can be run in two modes:
+    Takes command-line arguments specifying the run mode (parsed from "sys.argv", unless given as "options").
+    Can be run in three modes:
     * intercatively (without taking other command-line arguments)
     * automatically (taking additional command-line arguments)
+    * in batch (taking a manifest of data queries, run concurrently, and checkpointed in job_ledger.db:
+      rerun after a failure, it skips the queries done and resumes the interrupted downloads)
+    The names of the dataflows/codes are extracted in the "languages", in order of preference
+    (by default, those of "--languages", otherwise "CustomSession.LANGUAGES").
+    Each mode checks its arguments before importing what it needs to run (see "MODES").
     """
-
-    if len(sys.argv) >= 2:
-        if sys.argv[1] == "--interactive" or sys.argv[1] == "-i":
-            if len(sys.argv) == 2:
-                while True:
-                    session = CustomSession()
-                    print(f"\nSession's resulting API: {session.url}")
-                    try:
-                        print("Sending request to endpoint, waiting for response...")
-                        response = session.get()
-                        break
-                    except RequestException as e:
-                        print(f'\nCaught an exception: "{e}"')
-                        continue
-
-                response.detail()
-                print(
-                    "\nPrettyfying the response and writing it to the output file(hierarchy.txt)..."
-                )
-                response.output_hierarchy()
-                print("Operation completed!")
-                if session.query_type == "structure":
-                    if session.artefact_type == "dataflow":
-                        print(
-                            "\nExtracting relevant information from the inquired dataflows and writing it to the output file(dataflows.txt)..."
-                        )
-                        fct.output_dataflows(fct.dataflows(response))
-                        print("Operation completed!")
-                    elif session.artefact_type == "codelist":
-                        print(
-                            "\nExtracting relevant information from the inquired codelists and writing it to the output file(codelists.txt)..."
-                        )
-                        fct.output_codelists(fct.codelists(response))
-                        print("Operation completed!")
-                    else:
-                        pass
-                else:
-                    pass
-                print("\nWorkflow completed!")
-
-                while True:
-                    match input("Would you like to query some more? ").lower():
-                        case "yes" | "y":
-                            query()
-                        case "no" | "n":
-                            sys.exit("End of session, EXITED\n")
-                        case _:
-                            print('Choose a valid option: "yes"/"y" or "no"/"n"')
-
-            else:
-                sys.exit("Interactive mode does not take other arguments\n")
-        elif sys.argv[1] == "--shell" or sys.argv[1] == "-s":
-            if len(sys.argv) == 2:
-                sys.exit(
-                    "Shell mode requires additional arguments, at least two more (for the query type and for the artefact/context)\n"
-                )
-            else:
-                if (len(sys.argv) == 4 and sys.argv[2] == "structure") or (
-                    len(sys.argv) == 9 and sys.argv[2] == "data"
-                ):
-                    args = []
-                    for arg in sys.argv[2:]:
-                        args.append(arg)
-                    session = CustomSession(args)
-                    print(f"\nSession's resulting API: {session.url}")
-                    try:
-                        print("Sending request to endpoint, waiting for response...")
-                        response = session.get()
-                    except RequestException as e:
-                        sys.exit(f'\nCaught an exception: "{e}"\n')
-
-                    response.detail()
-                    print(
-                        "\nPrettyfying the response and writing it to the output file(hierarchy.txt)..."
-                    )
-                    response.output_hierarchy()
-                    print("Operation completed!")
-                    if session.query_type == "structure":
-                        if session.artefact_type == "dataflow":
-                            print(
-                                "\nExtracting relevant information from the inquired dataflows and writing it to the output file(dataflows.txt)..."
-                            )
-                            fct.output_dataflows(fct.dataflows(response))
-                            print("Operation completed!")
-                        elif session.artefact_type == "codelist":
-                            print(
-                                "\nExtracting relevant information from the inquired codelists and writing it to the output file(codelists.txt)..."
-                            )
-                            fct.output_codelists(fct.codelists(response))
-                            print("Operation completed!")
-                        else:
-                            pass
-                    else:
-                        pass
-                    print("\nWorkflow completed!")
-                else:
-                    if sys.argv[2] == "structure":
-                        sys.exit(
-                            "For structure queries, only one more argument needed after the query type: \n"
-                            "* artefact\n"
-                        )
-                    elif sys.argv[2] == "data":
-                        sys.exit(
-                            "For data queries, 6 more arguments needed after the query type: \n"
-                            "* context\n"
-                            "* agency_id\n"
-                            "* dataflow_id\n"
-                            "* dataflow_version\n"
-                            "* filter_expression\n"
-                            "* optional_parameters\n"
-                        )
-                    else:
-                        sys.exit('Supported query types: "structure" and "data"\n')
-        else:
-            sys.exit('Choose mode among: "--interactive"|"-i" or "--shell"|"-s"\n')
+    if options is None:
+        options = parse(sys.argv[1:])
     else:
-        sys.exit("Provide at least one argument to specify the run mode\n")
+        pass
+    MODES[options.mode](options.args, languages or options.languages)
 
 
 def extract_fromDB(table: str, attribute: str) -> list:
@@ -137,31 +336,21 @@ def extract_fromDB(table: str, attribute: str) -> list:
     Function for extracting an attribute(column values) from a table inside the Macro.db sqlite3 database.
     Purpose: extract to compare with the API response.
     The DB extracted attribute values should be a subset of the values(codes) extracted, via API, from the codelist of that attribute
+    The values are normalized with the rules of "reconciliation.NORMALIZATION_RULES".
+    For comparing all the mapped attributes at once, see "reconciliation.reconcile()".
     """
+    load("sqlite3", "reconciliation")
     cx = sqlite3.connect("Macro.db")
     cu = cx.cursor()
     selected = []
     for row in cu.execute(f"SELECT DISTINCT {attribute} FROM {table};"):
-        row = row[0]
-        if table == "subjects":
-            if row.startswith("OECD"):
-                row = "OECD"
-            elif row.startswith("Euro area"):
-                row = "Euro area"
-            elif row.startswith("European Union"):
-                row = "European Union"
-            elif "China" in row:
-                row = "China"
-            else:
-                pass
-        else:
-            pass
+        row = reconciliation.normalize(table, row[0])
         selected.append(row)
     print(f"\n{selected}\n")
     return selected
 
 
-def extract_fromAPI(what: str) -> list:
+def extract_fromAPI(what: str, cache: "ResponseCache" = None) -> list:
     """
     Function for extracting all possible values(codes) from one of the codelists, via API:
     * "CL_AREA", codelist for the locations (in DB, corresponding to the attribute "name" in the "subjects" table)
@@ -169,46 +358,64 @@ def extract_fromAPI(what: str) -> list:
     * "CL_MEI_TEST_UNIT_MEASURE", codelist for the measure units (in DB, corresponding to the attribute "unit" in the "measures" table)
     Purpose: extract to compare with the DB attribute values.
     The API extracted codelist values(codes) should be a superset of the corresponding DB extracted attribute values.
+    Only the requested codelist is queried (structure/codelist/{agency_id}/{codelist_id}), not the whole codelist dump.
+    The codelist response, and the codes extracted from it, are cached on disk (by default in http_cache.db),
+    so that repeated calls only revalidate them with the endpoint; the cache opened by default is closed on return.
+    Exits if the codelist can't be queried.
     """
-    cl_session = CustomSession(["structure", "codelist"])
-    print(f"\nSession's resulting API: {cl_session.url}")
+    load("CustomSession", "RequestException", "ResponseCache", "fct", "reconciliation")
+    if what not in reconciliation.MAPPINGS:
+        sys.exit("Not a viable option")
+    _, _, agency_id, codelist_id = reconciliation.MAPPINGS[what]
+    owned = cache is None
+    if owned:
+        cache = ResponseCache()
+    else:
+        pass
     try:
-        print("Sending request to endpoint, waiting for response...")
-        cl_response = cl_session.get()
-    except RequestException as e:
-        print(f'\nCaught an exception: "{e}"')
-    cl = fct.codelists(cl_response)
+        cl_session = CustomSession(
+            ["structure", "codelist", agency_id, codelist_id], cache=cache
+        )
+        print(f"\nSession's resulting API: {cl_session.url}")
+        try:
+            print("Sending request to endpoint, waiting for response...")
+            cl_response = cl_session.get()
+        except RequestException as e:
+            sys.exit(f'\nCaught an exception: "{e}"\n')
+        cl = cache.extract(cl_response, fct.codelists)
+    finally:
+        if owned:
+            cache.close()
+        else:
+            pass
     list_ = []
-    match what:
-        case "subject":
-            for code in cl:
-                if code["agency_id"] == "OECD" and code["codelist_id"] == "CL_AREA":
-                    subject = code["codelist_name"]
-                    list_.append(subject)
-        case "indicator":
-            for code in cl:
-                if (
-                    code["agency_id"] == "OECD.SDD.NAD"
-                    and code["codelist_id"] == "CL_TRANSACTION"
-                ):
-                    indicator = code["codelist_name"]
-                    list_.append(indicator)
-        case "unit":
-            for code in cl:
-                if (
-                    code["agency_id"] == "OECD.SDD.SDPS"
-                    and code["codelist_id"] == "CL_MEI_TEST_UNIT_MEASURE"
-                ):
-                    unit = code["codelist_name"]
-                    list_.append(unit)
-        case _:
-            sys.exit("Not a viable option")
+    for code in cl:
+        if code["agency_id"] == agency_id and code["codelist_id"] == codelist_id:
+            list_.append(code["codelist_name"])
     print(f"{list_}\n")
     return list_
 
 
 def main() -> None:
-    query()
+    """
+    Runs the query, reporting the timings of its stages (see "instrumentation") to timing.json.
+    With the "--profile" flag (anywhere among the arguments), the run is also profiled with cProfile and tracemalloc:
+    the stats are dumped to profile.prof, and the top functions and allocations added to the report.
+    With the "--languages=fr,en" flag (anywhere among the arguments), the names are requested and extracted
+    in these languages, in order of preference, instead of English only.
+    Usage errors exit before any query is run, or any heavy dependency imported.
+    """
+    options = parse(sys.argv[1:])
+    report = instrumentation.TimingReport()
+    instrumentation.add_listener(instrumentation.console)
+    instrumentation.add_listener(report)
+    try:
+        with instrumentation.profiled(report) if options.profile else nullcontext():
+            query(options=options)
+    finally:
+        instrumentation.remove_listener(report)
+        instrumentation.remove_listener(instrumentation.console)
+        report.write("timing.json")
 
 
 if __name__ == "__main__":
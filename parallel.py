@@ -0,0 +1,178 @@
+from concurrent.futures import ProcessPoolExecutor
+from requests import Response
+from requests.exceptions import StreamConsumedError
+from CustomResponse import CustomResponse, LANGUAGES
+import standalone_functions as fct
+import instrumentation
+import os
+import re
+import spooling
+
+ARTEFACTS = {
+    fct.dataflows: "Dataflow",
+    fct.codelists: "Codelist",
+    fct.observations: "Series",
+}
+"""
+Top-level artefact each extractor works on, at whose boundaries the documents are split.
+"""
+
+NAMESPACE_DECLARATION = re.compile(rb'\sxmlns(?::[\w.-]+)?="[^"]*"')
+"""
+Namespace declarations, carried over to every piece of a split document.
+"""
+
+
+def artefact_tags(name: str) -> re.Pattern:
+    """
+    Matches the start, self-closing and end tags of an artefact, whatever its namespace prefix.
+    Attribute values are matched as quoted strings, so a ">" (or "/>") inside one doesn't end the tag.
+    Comments and CDATA sections are matched too (without groups), for their content not to be taken for tags.
+    """
+    name = re.escape(name.encode())
+    return re.compile(
+        rb"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<(/)?(?:[\w.-]+:)?"
+        + name
+        + rb"(?=[\s/>])(?:[^>\"'/]|/(?!>)|\"[^\"]*\"|'[^']*')*(/)?>",
+        re.DOTALL,
+    )
+
+
+def split(content: bytes, name: str, parts: int) -> list:
+    """
+    Splits an XML document into (at most) "parts" well-formed pieces, each holding a run of consecutive
+    top-level "name" artefacts (e.g. "Codelist"), wrapped in a root element carrying the document's namespace declarations.
+    Runs never span anything but siblings of the artefacts (a closing tag in between breaks them).
+    Returns an empty list if the document holds less than 2 artefacts.
+    """
+    spans = []
+    start = depth = 0
+    for match in artefact_tags(name).finditer(content):
+        if match.group(0).startswith(b"<!"):
+            continue
+        elif match.group(1):
+            depth -= 1
+            if depth == 0:
+                spans.append((start, match.end()))
+        elif match.group(2):
+            if depth == 0:
+                spans.append((match.start(), match.end()))
+        else:
+            if depth == 0:
+                start = match.start()
+            depth += 1
+    if len(spans) < 2:
+        return []
+    declarations = b"".join(
+        dict.fromkeys(NAMESPACE_DECLARATION.findall(content, 0, spans[0][0]))
+    )
+    runs = [[spans[0]]]
+    for previous, span in zip(spans, spans[1:]):
+        if b"</" in content[previous[1] : span[0]]:
+            runs.append([span])
+        else:
+            runs[-1].append(span)
+    size = -(-len(spans) // parts)
+    pieces = []
+    for run in runs:
+        for i in range(0, len(run), size):
+            chunk = run[i : i + size]
+            pieces.append(
+                b"<pieces"
+                + declarations
+                + b">"
+                + content[chunk[0][0] : chunk[-1][1]]
+                + b"</pieces>"
+            )
+    return pieces
+
+
+def quiet() -> None:
+    """
+    Worker initializer: the workers emit no instrumentation events (nor status messages).
+    """
+    instrumentation.LISTENERS.clear()
+
+
+def extract_piece(extractor, piece: bytes, languages: tuple = LANGUAGES) -> list:
+    """
+    Parses a piece of a split document, and runs the extractor on it (in the response's languages).
+    """
+    response = Response()
+    response.status_code = 200
+    response._content = piece
+    return extractor(CustomResponse(response, languages=languages))
+
+
+def response_content(response: CustomResponse) -> bytes:
+    """
+    The raw document of a response. A streamed response is read (and decoded) without being parsed,
+    and can't be consumed again. A spooled response's document is its spool file's memory map (see "spooling.mapped()"),
+    which the pieces are sliced from without reading the whole document into memory.
+    """
+    if response.spool is not None:
+        return spooling.mapped(response.spool)
+    elif not response.streaming:
+        return response.content
+    if response.stream_consumed:
+        raise StreamConsumedError("The response stream has already been consumed")
+    response.stream_consumed = True
+    if hasattr(response.raw, "decode_content"):
+        response.raw.decode_content = True
+    return response.raw.read()
+
+
+def extract_parallel(
+    response: CustomResponse,
+    extractor=fct.codelists,
+    max_workers: int = None,
+    pieces_per_worker: int = 4,
+    executor: ProcessPoolExecutor = None,
+) -> list:
+    """
+    Runs a list extractor ("dataflows()", "codelists()" or "observations()") on a large (non-streamed) response
+    in parallel:
+    - splits the raw document at the boundaries of its top-level artefacts (Dataflow, Codelist, Series),
+      into "pieces_per_worker" pieces per worker, for load balancing
+    - parses and extracts the pieces in a process pool ("max_workers" processes, by default one per core)
+    - merges the results in document order, so the output is the extractor's own
+    Falls back to the extractor itself if the document can't be split, or isn't XML (SDMX-CSV/SDMX-JSON responses
+    are decoded incrementally, see "decoders"). An executor can be passed, to be reused.
+    A non-streamed response has already been parsed as a whole, upfront: pass a streamed response
+    (e.g. from "CustomSession.get(stream=True)") to have the parsing itself done in parallel.
+    """
+    if response.format != "xml":
+        return extractor(response)
+    max_workers = max_workers or os.cpu_count() or 1
+    with instrumentation.span(
+        "extract", kind=f"{ARTEFACTS[extractor].lower()}s (parallel)"
+    ) as extract:
+        content = response_content(response)
+        pieces = split(content, ARTEFACTS[extractor], max_workers * pieces_per_worker)
+        extract["pieces"] = len(pieces)
+        if not pieces and response.spool is not None:
+            return extractor(response)
+        elif not pieces:
+            return extract_piece(extractor, content, response.languages)
+        if executor is None:
+            with ProcessPoolExecutor(max_workers, initializer=quiet) as pool:
+                results = list(
+                    pool.map(
+                        extract_piece,
+                        [extractor] * len(pieces),
+                        pieces,
+                        [response.languages] * len(pieces),
+                    )
+                )
+        else:
+            results = list(
+                executor.map(
+                    extract_piece,
+                    [extractor] * len(pieces),
+                    pieces,
+                    [response.languages] * len(pieces),
+                )
+            )
+        merged = [row for result in results for row in result]
+        extract["rows"] = len(merged)
+    return merged
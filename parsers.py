@@ -0,0 +1,114 @@
+from xml.etree import ElementTree
+import os
+import threading
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+
+class Backend:
+    """
+    Base class of the parser backends, caching their compiled paths.
+    """
+
+    def __init__(self) -> None:
+        self.local = threading.local()
+        """
+        Holds the compiled form of each path ("paths"), compiled once per thread (compiled XPath objects
+        are not to be shared between threads).
+        """
+
+    def path(self, path: str):
+        """
+        Returns a callable finding, under an element, the elements matching the path (in Clark notation).
+        """
+        paths = self.local.__dict__.setdefault("paths", {})
+        compiled = paths.get(path)
+        if compiled is None:
+            compiled = paths[path] = self.compile(path)
+        return compiled
+
+
+class StdlibBackend(Backend):
+    """
+    Parser backend on the standard library's "xml.etree.ElementTree" (C accelerated).
+    Its paths are ElementPath expressions.
+    """
+
+    name = "stdlib"
+
+    def iterparse(self, source, events: tuple):
+        return ElementTree.iterparse(source, events=events)
+
+    def compile(self, path: str):
+        def find(element) -> list:
+            return element.findall(path)
+
+        return find
+
+
+class LxmlBackend(Backend):
+    """
+    Parser backend on lxml (libxml2):
+    - parses with the "huge_tree" option, lifting libxml2's limits on the depth (up to 2048) and text size of big payloads
+    - drops comments and processing instructions, so that the trees only hold elements, as with the stdlib backend
+    - compiles its paths into "ETXPath" objects (XPath, with Clark notation)
+    """
+
+    name = "lxml"
+
+    def iterparse(self, source, events: tuple):
+        return lxml_etree.iterparse(
+            source,
+            events=events,
+            huge_tree=True,
+            remove_comments=True,
+            remove_pis=True,
+        )
+
+    def compile(self, path: str):
+        return lxml_etree.ETXPath(path)
+
+
+BACKENDS = {"stdlib": StdlibBackend()}
+"""
+Available parser backends, by name.
+"""
+if lxml_etree is not None:
+    BACKENDS["lxml"] = LxmlBackend()
+else:
+    pass
+
+DEFAULT_BACKEND = os.environ.get(
+    "SDMX_PARSER", "lxml" if "lxml" in BACKENDS else "stdlib"
+)
+"""
+Name of the backend used unless another one is asked for: lxml when installed (unless overridden with
+the SDMX_PARSER environment variable), the standard library otherwise.
+"""
+
+
+def too_deep(error: Exception) -> bool:
+    """
+    Whether a parse failed on libxml2's limit on the depth of the documents (2048 levels, even with "huge_tree"),
+    which the stdlib backend doesn't have: such documents are to be parsed with the stdlib backend instead.
+    """
+    return (
+        lxml_etree is not None
+        and isinstance(error, lxml_etree.XMLSyntaxError)
+        and "Excessive depth" in str(error)
+    )
+
+
+def backend(name: str = None):
+    """
+    Returns the parser backend of the given name (by default, "DEFAULT_BACKEND").
+    """
+    name = name or DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(
+            f'Parser backend "{name}" not available (available: {list(BACKENDS)})'
+        )
+    return BACKENDS[name]
@@ -0,0 +1,140 @@
+from CustomSession import CustomSession
+from ResponseCache import ResponseCache
+import standalone_functions as fct
+import json
+import re
+import sqlite3
+
+NORMALIZATION_RULES = {
+    "subjects": [
+        (re.compile(r"^OECD"), "OECD"),
+        (re.compile(r"^Euro area"), "Euro area"),
+        (re.compile(r"^European Union"), "European Union"),
+        (re.compile(r"China"), "China"),
+    ],
+}
+"""
+Rules normalizing the DB values of each table to the API names, by table:
+the first rule whose pattern is found in a value replaces it.
+"""
+
+MAPPINGS = {
+    "subject": ("subjects", "name", "OECD", "CL_AREA"),
+    "indicator": ("indicators", "name", "OECD.SDD.NAD", "CL_TRANSACTION"),
+    "unit": ("measures", "unit", "OECD.SDD.SDPS", "CL_MEI_TEST_UNIT_MEASURE"),
+}
+"""
+DB attributes mapped to the codelist holding their values, by attribute:
+(table, column, agency_id, codelist_id)
+"""
+
+
+def normalize(table: str, value: str) -> str:
+    """
+    Applies the normalization rules of the table to a DB value.
+    """
+    for pattern, replacement in NORMALIZATION_RULES.get(table, ()):
+        if pattern.search(value):
+            return replacement
+    return value
+
+
+def codelist_index(codelists: list) -> dict:
+    """
+    Indexes the output of "codelists()" in a single pass: (agency_id, codelist_id) -> {code_id: code_name}.
+    """
+    index = {}
+    for code in codelists:
+        index.setdefault((code["agency_id"], code["codelist_id"]), {})[
+            code["code_id"]
+        ] = code["code_name"]
+    return index
+
+
+def db_values(connection: sqlite3.Connection, mappings: dict = MAPPINGS) -> dict:
+    """
+    Loads the distinct (normalized) values of all the mapped DB attributes, with a single query.
+    """
+    query = " UNION ".join(
+        f'SELECT DISTINCT ? AS "attribute", "{column}" FROM "{table}"'
+        for table, column, _, _ in mappings.values()
+    )
+    values = {attribute: set() for attribute in mappings}
+    for attribute, value in connection.execute(query + ";", list(mappings)):
+        if value is not None:
+            values[attribute].add(normalize(mappings[attribute][0], str(value)))
+    return values
+
+
+def folded(value: str) -> str:
+    """
+    Case and whitespace insensitive form of a name, for matching renamed values.
+    """
+    return " ".join(value.split()).casefold()
+
+
+def reconcile(values: dict, index: dict, mappings: dict = MAPPINGS) -> dict:
+    """
+    Compares the DB values of each mapped attribute with the names of its codelist's codes, as sets:
+    - "missing": DB values not found among the API names
+    - "extra": API names not found among the DB values
+    - "renamed": missing DB values matching an API name up to case and whitespace, or matching a code id
+    Returns the machine-readable diff, by attribute.
+    """
+    diff = {}
+    for attribute, (table, column, agency_id, codelist_id) in mappings.items():
+        codes = index.get((agency_id, codelist_id), {})
+        api = set(codes.values())
+        db = values.get(attribute, set())
+        by_folded = {folded(name): name for name in api}
+        missing = db - api
+        renamed = {}
+        for value in missing:
+            if folded(value) in by_folded:
+                renamed[value] = by_folded[folded(value)]
+            elif value in codes:
+                renamed[value] = codes[value]
+        diff[attribute] = {
+            "table": table,
+            "column": column,
+            "agency_id": agency_id,
+            "codelist_id": codelist_id,
+            "codelist_found": (agency_id, codelist_id) in index,
+            "missing": sorted(missing - renamed.keys()),
+            "extra": sorted(api - db - set(renamed.values())),
+            "renamed": dict(sorted(renamed.items())),
+        }
+    return diff
+
+
+def write_diff(diff: dict, path: str = "reconciliation.json") -> None:
+    """
+    Writes the diff to an output file, as JSON.
+    """
+    with open(path, "w") as file:
+        json.dump(diff, file, indent=2, ensure_ascii=False)
+
+
+def main() -> None:
+    """
+    Reconciles Macro.db with the mapped codelists, each fetched (or revalidated) via API on its own,
+    and writes the diff to reconciliation.json.
+    """
+    cache = ResponseCache()
+    index = {}
+    for _, _, agency_id, codelist_id in MAPPINGS.values():
+        response = CustomSession(
+            ["structure", "codelist", agency_id, codelist_id], cache=cache
+        ).get()
+        index.update(codelist_index(cache.extract(response, fct.codelists)))
+    with sqlite3.connect("Macro.db") as connection:
+        diff = reconcile(db_values(connection), index)
+    write_diff(diff)
+    for attribute, d in diff.items():
+        print(
+            f"{attribute}: {len(d['missing'])} missing, {len(d['extra'])} extra, {len(d['renamed'])} renamed"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+from collections.abc import Mapping
+from itertools import chain
+import re
+
+SPACES = re.compile(" +")
+"""
+Runs of spaces, collapsed in the extracted names.
+"""
+
+
+class Record(Mapping):
+    """
+    Base class of the compact records returned by the extractors, in place of one dictionary per row:
+    - the properties are held in "__slots__" (no per-row dictionary, nor per-row copy of the keys)
+    - the record is a read-only mapping of its "fields", so it can be used wherever the rows used to be
+      dictionaries (indexing, "get()", "items()", "tabulate", "csv.DictWriter", comparison with a dictionary)
+    Turned into an actual dictionary with "dict(record)" (e.g. for "json.dumps()").
+    Extracted in several languages, a record also holds its name in each of them ("names"),
+    mapped as one more field per language (e.g. "dataflow_name_fr").
+    """
+
+    __slots__ = ()
+    fields = ()
+    """
+    Names of the properties, in the order of the former dictionaries' keys.
+    """
+    name_field = None
+    """
+    Field of the name (in the first of the requested languages it exists in), prefixing the fields of the other names.
+    """
+
+    def __getitem__(self, field: str):
+        if field in self.fields:
+            return getattr(self, field)
+        names = self.names
+        if names is not None and field.startswith(f"{self.name_field}_"):
+            language = field[len(self.name_field) + 1 :]
+            if language in names:
+                return names[language]
+            else:
+                pass
+        raise KeyError(field)
+
+    def __iter__(self):
+        if self.names is None:
+            return iter(self.fields)
+        return chain(self.fields, localized_fields(self.name_field, self.names))
+
+    def __len__(self) -> int:
+        return len(self.fields) + (len(self.names) if self.names is not None else 0)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({dict(self)})"
+
+    def __getstate__(self) -> tuple:
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state: tuple) -> None:
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+
+def normalized(text: str) -> str:
+    """
+    Normalizes the text of a name: line breaks dropped, runs of spaces collapsed.
+    """
+    if not text:
+        return ""
+    return SPACES.sub(" ", text.replace("\r", "").replace("\n", ""))
+
+
+def preferred(found: dict, languages: tuple) -> str:
+    """
+    The name in the first of the languages it exists in (fallback order), or an empty string.
+    """
+    for language in languages:
+        if language in found:
+            return found[language]
+    return ""
+
+
+def localized_fields(name_field: str, languages) -> list:
+    """
+    The fields of a name in each language, e.g. ["dataflow_name_en", "dataflow_name_fr"].
+    """
+    return [f"{name_field}_{language}" for language in languages]
+
+
+class Dataflow(Record):
+    """
+    Properties of a dataflow (see "iter_dataflows()").
+    """
+
+    fields = (
+        "dataflow_id",
+        "agency_id",
+        "dataflow_name",
+        "reference_id",
+        "reference_agencyID",
+        "reference_class",
+    )
+    __slots__ = fields + ("names",)
+    name_field = "dataflow_name"
+
+    def __init__(
+        self,
+        dataflow_id: str,
+        agency_id: str,
+        dataflow_name: str,
+        reference_id: str,
+        reference_agencyID: str,
+        reference_class: str,
+        names: dict = None,
+    ) -> None:
+        self.dataflow_id = dataflow_id
+        self.agency_id = agency_id
+        self.dataflow_name = dataflow_name
+        self.reference_id = reference_id
+        self.reference_agencyID = reference_agencyID
+        self.reference_class = reference_class
+        self.names = names
+
+
+class Codelist:
+    """
+    Identity of a codelist, shared by all of its codes rather than repeated in each of them,
+    along with its name (and its name in each language, if extracted in several).
+    """
+
+    __slots__ = ("agency_id", "codelist_id", "codelist_name", "names")
+
+    def __init__(
+        self, agency_id: str, codelist_id: str, codelist_name: str, names: dict = None
+    ) -> None:
+        self.agency_id = agency_id
+        self.codelist_id = codelist_id
+        self.codelist_name = codelist_name
+        self.names = names
+
+    def __getstate__(self) -> tuple:
+        return self.agency_id, self.codelist_id, self.codelist_name, self.names
+
+    def __setstate__(self, state: tuple) -> None:
+        self.agency_id, self.codelist_id, self.codelist_name, self.names = state
+
+
+class Code(Record):
+    """
+    Properties of a code (see "iter_codelists()"), grouped under its parent "Codelist()":
+    "agency_id" and "codelist_id" are read from the codelist.
+    "codelist_name" is kept per code, as extracted: the latest name read in the codelist
+    (the code's own name, if it has one).
+    """
+
+    __slots__ = (
+        "codelist",
+        "codelist_name",
+        "code_id",
+        "code_name",
+        "code_parent",
+        "names",
+    )
+    fields = (
+        "agency_id",
+        "codelist_id",
+        "codelist_name",
+        "code_id",
+        "code_name",
+        "code_parent",
+    )
+    name_field = "code_name"
+
+    def __init__(
+        self,
+        codelist: Codelist,
+        codelist_name: str,
+        code_id: str,
+        code_name: str,
+        code_parent: str,
+        names: dict = None,
+    ) -> None:
+        self.codelist = codelist
+        self.codelist_name = codelist_name
+        self.code_id = code_id
+        self.code_name = code_name
+        self.code_parent = code_parent
+        self.names = names
+
+    @property
+    def agency_id(self) -> str:
+        return self.codelist.agency_id
+
+    @property
+    def codelist_id(self) -> str:
+        return self.codelist.codelist_id
@@ -0,0 +1,78 @@
+"""
+Thin client of the daemon (see "daemon"): sends a shell mode query to the running daemon, which answers it
+with its warm session and caches, and prints the daemon's report.
+Takes the same arguments as the shell mode, e.g.: python sdmx_client.py -s structure dataflow [--languages=fr,en].
+Imports the standard library only (no requests, tabulate or sqlite3; the command line's parser is "main"'s, whose
+heavy dependencies are lazy), so that it starts in milliseconds.
+Falls back to running the query itself ("main.main()") when no daemon is running, or for the other modes.
+"""
+
+import http.client
+import json
+import os
+import sys
+
+DAEMON_HOST = "127.0.0.1"
+"""
+Address of the daemon (see "daemon.DAEMON_HOST").
+"""
+
+DAEMON_PORT = int(os.environ.get("SDMX_DAEMON_PORT", 8765))
+"""
+Port of the daemon (SDMX_DAEMON_PORT, by default 8765).
+"""
+
+
+def send_query(
+    args: list,
+    languages: list = None,
+    cwd: str = None,
+    host: str = DAEMON_HOST,
+    port: int = DAEMON_PORT,
+    timeout: float = 3600,
+) -> tuple:
+    """
+    Sends a shell mode query (the arguments after "--shell") to the daemon, to be answered in "cwd"
+    (by default the current directory). Returns the status and the report of the daemon (see "daemon.serve()").
+    Raises a "ConnectionError" if no daemon is running.
+    """
+    body = json.dumps(
+        {"args": args, "cwd": cwd or os.getcwd(), "languages": languages}
+    ).encode("utf-8")
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        connection.request("POST", "/query", body, {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def main() -> None:
+    """
+    Runs the shell mode query through the daemon, exiting with the daemon's error if it fails.
+    The arguments are parsed and checked by the command line's parser (see "main.parse()"), which loads none
+    of the heavy dependencies; these are only imported to run the query itself (see "main.main()").
+    """
+    import main as standalone
+
+    options = standalone.parse(sys.argv[1:])
+    if options.mode != "shell" or options.profile:
+        standalone.main()
+        return
+    try:
+        status, report = send_query(
+            standalone.shell_args(options.args), options.languages
+        )
+    except ConnectionError:
+        standalone.main()
+        return
+    if report["status"] != "OK":
+        sys.exit(f'\nCaught an exception: "{report["error"]}"\n')
+    for message in report["messages"]:
+        print(message)
+    print(f'Outputs: {", ".join(report["outputs"])} ({report["elapsed"]:.3f}s)')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+import io
+import json
+import os
+from requests import Response
+from CustomResponse import CustomResponse
+
+SDMX_NAMESPACES = (
+    'xmlns:message="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message" '
+    'xmlns:structure="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure" '
+    'xmlns:common="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+)
+"""
+Namespace declarations of the OECD SDMX-ML 2.1 messages.
+"""
+
+
+def structure_message(structures: str) -> bytes:
+    """
+    Wraps the structures into an SDMX-ML structure message, as returned by the OECD endpoint.
+    """
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        f"<message:Structure {SDMX_NAMESPACES}>\n"
+        "  <message:Header><message:ID>IREF000001</message:ID>"
+        "<message:Test>false</message:Test></message:Header>\n"
+        f"  <message:Structures>\n{structures}  </message:Structures>\n"
+        "</message:Structure>\n"
+    ).encode("utf-8")
+
+
+def names(text: str, indent: str) -> str:
+    """
+    Builds the multilingual names of an artefact or code.
+    """
+    return (
+        f'{indent}<common:Name xml:lang="fr">{text} (fr)</common:Name>\n'
+        f'{indent}<common:Name xml:lang="en">{text}</common:Name>\n'
+    )
+
+
+def codelists_xml(n_codelists: int, n_codes: int) -> bytes:
+    """
+    Synthetic structure message holding "n_codelists" codelists of "n_codes" codes each,
+    every other code having a parent.
+    """
+    parts = ["    <structure:Codelists>\n"]
+    for i in range(n_codelists):
+        parts.append(
+            f'      <structure:Codelist id="CL_{i}" agencyID="OECD.AG{i % 7}" version="1.0">\n'
+        )
+        parts.append(names(f"Codelist {i}", " " * 8))
+        for j in range(n_codes):
+            parts.append(f'        <structure:Code id="C{j}">\n')
+            parts.append(names(f"Code {i}.{j}", " " * 10))
+            if j % 2:
+                parts.append(
+                    f'          <structure:Parent><Ref id="C{j - 1}" /></structure:Parent>\n'
+                )
+            parts.append("        </structure:Code>\n")
+        parts.append("      </structure:Codelist>\n")
+    parts.append("    </structure:Codelists>\n")
+    return structure_message("".join(parts))
+
+
+def dataflows_xml(n_dataflows: int) -> bytes:
+    """
+    Synthetic structure message holding "n_dataflows" dataflows, every other one referencing its data structure.
+    """
+    parts = ["    <structure:Dataflows>\n"]
+    for i in range(n_dataflows):
+        parts.append(
+            f'      <structure:Dataflow id="DSD_{i}@DF_{i}" agencyID="OECD.AG{i % 7}" version="1.0">\n'
+        )
+        parts.append(names(f"Dataflow {i}", " " * 8))
+        if i % 2 == 0:
+            parts.append(
+                f'        <structure:Structure><Ref id="DSD_{i}" agencyID="OECD.AG{i % 7}" '
+                'class="DataStructure" /></structure:Structure>\n'
+            )
+        parts.append("      </structure:Dataflow>\n")
+    parts.append("    </structure:Dataflows>\n")
+    return structure_message("".join(parts))
+
+
+AREAS = ("AUS", "AUT", "BEL", "CAN", "CHE", "DEU", "FRA", "ITA", "JPN", "USA")
+"""
+Reference areas the synthetic series are spread over.
+"""
+
+
+def data_xml(n_series: int, n_obs: int, start_year: int = 2000) -> bytes:
+    """
+    Synthetic structure-specific data message holding "n_series" annual series of "n_obs" observations each.
+    """
+    parts = [
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        f"<message:StructureSpecificData {SDMX_NAMESPACES} "
+        'xmlns:ss="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/data/structurespecific" '
+        'xmlns:ns1="urn:sdmx:org.sdmx.infomodel.datastructure.Dataflow='
+        'OECD.SDD.NAD:DSD_NAAG@DF_NAAG_I(1.0):ObsLevelDim:TIME_PERIOD">\n'
+        "  <message:Header><message:ID>IREF000002</message:ID>"
+        "<message:Test>false</message:Test></message:Header>\n"
+        '  <message:DataSet ss:dataScope="DataStructure" xsi:type="ns1:DataSetType" '
+        'ss:structureRef="OECD_SDD_NAD_DSD_NAAG_DF_NAAG_I_1_0">\n'
+    ]
+    for i in range(n_series):
+        parts.append(
+            f'    <Series FREQ="A" REF_AREA="{AREAS[i % len(AREAS)]}" '
+            f'TRANSACTION="T{i // len(AREAS)}" UNIT_MEASURE="USD_PPP" UNIT_MULT="6">\n'
+        )
+        for j in range(n_obs):
+            parts.append(
+                f'      <Obs TIME_PERIOD="{start_year + j}" OBS_VALUE="{(i + 1) * (j + 1) / 8}" '
+                'OBS_STATUS="A" />\n'
+            )
+        parts.append("    </Series>\n")
+    parts.append("  </message:DataSet>\n</message:StructureSpecificData>\n")
+    return "".join(parts).encode("utf-8")
+
+
+def series_key(i: int) -> dict:
+    """
+    Dimensions and attributes of the i-th synthetic series (see "data_xml()").
+    """
+    return {
+        "FREQ": "A",
+        "REF_AREA": AREAS[i % len(AREAS)],
+        "TRANSACTION": f"T{i // len(AREAS)}",
+        "UNIT_MEASURE": "USD_PPP",
+        "UNIT_MULT": "6",
+    }
+
+
+def data_csv(n_series: int, n_obs: int, start_year: int = 2000) -> bytes:
+    """
+    The same data as "data_xml()", as an SDMX-CSV 2.0 message.
+    """
+    parts = [
+        "STRUCTURE,STRUCTURE_ID,ACTION,FREQ,REF_AREA,TRANSACTION,UNIT_MEASURE,"
+        "TIME_PERIOD,OBS_VALUE,UNIT_MULT,OBS_STATUS\r\n"
+    ]
+    for i in range(n_series):
+        key = series_key(i)
+        prefix = (
+            "dataflow,OECD.SDD.NAD:DSD_NAAG@DF_NAAG_I(1.0),I,"
+            f'{key["FREQ"]},{key["REF_AREA"]},{key["TRANSACTION"]},{key["UNIT_MEASURE"]},'
+        )
+        for j in range(n_obs):
+            parts.append(
+                f'{prefix}{start_year + j},{(i + 1) * (j + 1) / 8},{key["UNIT_MULT"]},A\r\n'
+            )
+    return "".join(parts).encode("utf-8")
+
+
+def data_json(n_series: int, n_obs: int, start_year: int = 2000) -> bytes:
+    """
+    The same data as "data_xml()", as an SDMX-JSON 2.0 message: the values of the dimensions and attributes
+    are listed once in the structure, and referenced by index in the series' keys and the observations.
+    """
+    keys = [series_key(i) for i in range(n_series)]
+    dimensions = ("FREQ", "REF_AREA", "TRANSACTION", "UNIT_MEASURE")
+    values = {
+        dimension: list(dict.fromkeys(key[dimension] for key in keys))
+        for dimension in dimensions
+    }
+    periods = [str(start_year + j) for j in range(n_obs)]
+    series = {}
+    for i, key in enumerate(keys):
+        series[":".join(str(values[d].index(key[d])) for d in dimensions)] = {
+            "attributes": [0],
+            "observations": {str(j): [(i + 1) * (j + 1) / 8, 0] for j in range(n_obs)},
+        }
+    structure = {
+        "dimensions": {
+            "dataSet": [],
+            "series": [
+                {"id": d, "values": [{"id": v} for v in values[d]]} for d in dimensions
+            ],
+            "observation": [
+                {"id": "TIME_PERIOD", "values": [{"value": p} for p in periods]}
+            ],
+        },
+        "attributes": {
+            "series": [{"id": "UNIT_MULT", "values": [{"id": "6"}]}],
+            "observation": [{"id": "OBS_STATUS", "values": [{"id": "A"}]}],
+        },
+        "measures": {"observation": [{"id": "OBS_VALUE"}]},
+    }
+    message = {
+        "meta": {"id": "IREF000002", "test": False},
+        "data": {"structures": [structure], "dataSets": [{"series": series}]},
+    }
+    return json.dumps(message).encode("utf-8")
+
+
+def json_names(text: str) -> dict:
+    """
+    Builds the multilingual names of an artefact or code, as "names()" does in SDMX-ML.
+    """
+    return {"name": text, "names": {"fr": f"{text} (fr)", "en": text}}
+
+
+def structure_json(artefact_type: str, artefacts: list) -> bytes:
+    """
+    Wraps the artefacts of a type (e.g. "codelists") into an SDMX-JSON 2.0 structure message.
+    """
+    message = {
+        "meta": {"id": "IREF000001", "test": False},
+        "data": {artefact_type: artefacts},
+    }
+    return json.dumps(message).encode("utf-8")
+
+
+def codelists_json(n_codelists: int, n_codes: int) -> bytes:
+    """
+    The same codelists as "codelists_xml()", as an SDMX-JSON 2.0 structure message.
+    """
+    codelists = []
+    for i in range(n_codelists):
+        codes = []
+        for j in range(n_codes):
+            code = {"id": f"C{j}", **json_names(f"Code {i}.{j}")}
+            if j % 2:
+                code["parent"] = f"C{j - 1}"
+            codes.append(code)
+        codelists.append(
+            {
+                "id": f"CL_{i}",
+                "agencyID": f"OECD.AG{i % 7}",
+                "version": "1.0",
+                **json_names(f"Codelist {i}"),
+                "codes": codes,
+            }
+        )
+    return structure_json("codelists", codelists)
+
+
+def dataflows_json(n_dataflows: int) -> bytes:
+    """
+    The same dataflows as "dataflows_xml()", as an SDMX-JSON 2.0 structure message
+    (the data structures being referenced by URN).
+    """
+    dataflows = []
+    for i in range(n_dataflows):
+        dataflow = {
+            "id": f"DSD_{i}@DF_{i}",
+            "agencyID": f"OECD.AG{i % 7}",
+            "version": "1.0",
+            **json_names(f"Dataflow {i}"),
+        }
+        if i % 2 == 0:
+            dataflow["structure"] = (
+                "urn:sdmx:org.sdmx.infomodel.datastructure.DataStructure="
+                f"OECD.AG{i % 7}:DSD_{i}(1.0)"
+            )
+        dataflows.append(dataflow)
+    return structure_json("dataflows", dataflows)
+
+
+FORMAT_FIXTURES = {
+    "xml": (data_xml, "application/vnd.sdmx.structurespecificdata+xml"),
+    "csv": (data_csv, "application/vnd.sdmx.data+csv; version=2.0.0"),
+    "json": (data_json, "application/vnd.sdmx.data+json; version=2.0.0"),
+}
+"""
+Builder and media type of the same synthetic data in each wire format.
+"""
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+"""
+Directory of the recorded fixtures (real OECD responses), see "record()".
+"""
+
+RECORDED = {
+    "dataflows": ["structure", "dataflow"],
+    "codelists": ["structure", "codelist"],
+    "data": [
+        "data",
+        "dataflow",
+        "OECD.SDD.NAD",
+        "DSD_NAAG@DF_NAAG_I",
+        "1.0",
+        "A..B1GQ+B1G+P3..",
+        "c[TIME_PERIOD]=ge:1990+le:2024",
+    ],
+}
+"""
+Queries whose responses are recorded, by fixture name.
+"""
+
+
+def record(directory: str = FIXTURES_DIR) -> None:
+    """
+    Records the responses of the OECD endpoint to the "RECORDED" queries (requires network access),
+    so that the benchmarks run on real messages rather than on the synthetic ones.
+    """
+    from CustomSession import CustomSession
+
+    os.makedirs(directory, exist_ok=True)
+    for name, args in RECORDED.items():
+        response = CustomSession(args).get()
+        with open(os.path.join(directory, f"{name}.xml"), "wb") as file:
+            file.write(response.content)
+
+
+def fixture(name: str, synthetic, directory: str = FIXTURES_DIR) -> bytes:
+    """
+    Returns the recorded fixture if there is one, otherwise builds the synthetic one (a callable).
+    """
+    path = os.path.join(directory, f"{name}.xml")
+    if os.path.exists(path):
+        with open(path, "rb") as file:
+            return file.read()
+    return synthetic()
+
+
+def make_response(
+    content: bytes, stream: bool = False, content_type: str = None, parser: str = None
+) -> CustomResponse:
+    """
+    Wraps the content into a "CustomResponse()", as if it was received from the endpoint
+    (with the given "Content-Type", e.g. of SDMX-CSV or SDMX-JSON), parsed with the given parser backend
+    (by default "parsers.DEFAULT_BACKEND").
+    """
+    response = Response()
+    response.status_code = 200
+    if content_type is not None:
+        response.headers["Content-Type"] = content_type
+    if stream:
+        response.raw = io.BytesIO(content)
+    else:
+        response._content = content
+    return CustomResponse(response, stream=stream, parser=parser)
+
+
+if __name__ == "__main__":
+    record()
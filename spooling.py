@@ -0,0 +1,148 @@
+"""
+Spooling of the response bodies to disk, for the bodies too large to be held in memory:
+- the (decoded) body is written to a file in large chunks, as it's downloaded
+- the file is then read through a read-only memory map: the parsers and decoders read it chunk by chunk,
+  and the body itself is never copied onto the Python heap (its pages are the OS page cache's, evicted as needed)
+- the file is kept, so the body can be parsed/extracted again, in this run or a later one, without a re-download
+"""
+
+import hashlib
+import io
+import mmap
+import os
+import tempfile
+import zlib
+
+SPOOL_CHUNK_SIZE = 1 << 20
+"""
+Size of the chunks the body is written to the spool file in, in bytes.
+"""
+
+SPOOL_PREFIX = "sdmx-"
+"""
+Prefix of the names of the spool files.
+"""
+
+CONTENT_ENCODINGS = ("gzip", "deflate")
+"""
+Content encodings of the bodies downloaded as is (e.g. to be resumed), decoded once complete (see "decode()").
+"""
+
+
+def spool(chunks, directory: str = None, suffix: str = ".xml") -> tuple:
+    """
+    Writes the chunks of a body to a new spool file (in "directory", by default the temporary directory),
+    named after its wire format (e.g. "sdmx-1a2b3c.xml").
+    Returns the path of the file, and its size. The file is removed if the download fails.
+    """
+    descriptor, path = tempfile.mkstemp(suffix, SPOOL_PREFIX, directory)
+    size = 0
+    try:
+        with open(descriptor, "wb", buffering=0) as file:
+            for chunk in chunks:
+                file.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, size
+
+
+def decompressor(encoding: str, head: bytes):
+    """
+    Decompressor of a body in one of the "CONTENT_ENCODINGS", given its first bytes: "deflate" bodies are
+    zlib streams, but some servers send raw deflate data instead, told apart by the zlib header.
+    """
+    if encoding == "deflate" and not (
+        len(head) >= 2
+        and head[0] & 0x0F == 8
+        and int.from_bytes(head[:2], "big") % 31 == 0
+    ):
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+    return zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+
+def decode(part: str, path: str, encoding: str = "identity") -> tuple:
+    """
+    Decodes a body downloaded as is (its "Content-Encoding", e.g. gzip) from the file "part" to the file "path",
+    chunk by chunk, and removes "part". Returns the size and the sha256 digest of the decoded body.
+    Raises a "ValueError" for any other encoding than "identity" and the "CONTENT_ENCODINGS" (e.g. brotli),
+    or a compressed body that's corrupt or truncated; "part" is then kept, and "path" not written.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    if encoding in CONTENT_ENCODINGS:
+        try:
+            with open(part, "rb") as source, open(path, "wb") as target:
+                chunk = source.read(SPOOL_CHUNK_SIZE)
+                stream = decompressor(encoding, chunk)
+                while chunk:
+                    chunk = stream.decompress(chunk)
+                    digest.update(chunk)
+                    size += target.write(chunk)
+                    chunk = source.read(SPOOL_CHUNK_SIZE)
+                chunk = stream.flush()
+                digest.update(chunk)
+                size += target.write(chunk)
+                if not stream.eof:
+                    raise ValueError(
+                        f"Truncated {encoding} body: the stream doesn't end"
+                    )
+                else:
+                    pass
+        except (ValueError, zlib.error) as e:
+            os.remove(path)
+            raise ValueError(f"Can't decode the {encoding} body: {e}") from e
+        os.remove(part)
+    elif encoding == "identity":
+        os.replace(part, path)
+        with open(path, "rb") as source:
+            while chunk := source.read(SPOOL_CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+    else:
+        raise ValueError(
+            f"Unsupported content encoding: {encoding} (expected {CONTENT_ENCODINGS})"
+        )
+    return size, digest.hexdigest()
+
+
+def mapped(path: str):
+    """
+    Maps a spool file into memory, read-only. An empty file (which can't be mapped) is read as empty bytes.
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class MappedBody(io.RawIOBase):
+    """
+    A spool file, read as a binary file through its memory map (see "mapped()"):
+    each read returns the next chunk of the map, so it can be handed to the parsers and decoders as a response's body.
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.mapping = mapped(path)
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self.mapping) if size is None or size < 0 else self.position + size
+        chunk = self.mapping[self.position : end]
+        self.position += len(chunk)
+        return chunk
+
+    def readinto(self, buffer) -> int:
+        chunk = self.read(len(buffer))
+        buffer[: len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self) -> None:
+        if isinstance(self.mapping, mmap.mmap):
+            self.mapping.close()
+        super().close()
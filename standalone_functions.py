@@ -1,117 +1,303 @@
 from CustomResponse import CustomResponse
-from tabulate import tabulate
-import re
+from ObservationColumns import ObservationColumns
+from records import Code, Codelist, Dataflow, localized_fields, normalized, preferred
+from sys import intern
+import decoders
+import exporters
+import instrumentation
 
+XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+"""
+Qualified name of the "xml:lang" attribute, holding the language of a name.
+"""
 
-def dataflows(response: CustomResponse) -> list:
+DATAFLOW_FIELDS = [
+    "dataflow_id",
+    "agency_id",
+    "dataflow_name",
+    "reference_id",
+    "reference_agencyID",
+    "reference_class",
+]
+"""
+Properties extracted from each dataflow (columns of the exported dataflows).
+"""
+
+CODELIST_FIELDS = [
+    "agency_id",
+    "codelist_id",
+    "codelist_name",
+    "code_id",
+    "code_name",
+    "code_parent",
+]
+"""
+Properties extracted from each code (columns of the exported codelists).
+"""
+
+
+def localized_names(names: list, languages: tuple) -> dict:
+    """
+    Reads the names of an artefact or code (its "Name" elements) in a single pass:
+    the first name in each of the requested languages, normalized.
+    """
+    found = {}
+    for name in names:
+        language = name.get(XML_LANG)
+        if language in languages and language not in found:
+            found[language] = normalized(name.text)
+        else:
+            pass
+    return found
+
+
+def iter_dataflows(response: CustomResponse, languages: tuple = None):
     """
     Extracts relevant information from the inquired dataflows.
-    Each dataflow has it's properties stored in a dictionary.
-    Adds the dictionaries to a list.
+    Each dataflow has it's properties stored in a compact "Dataflow()" record (a read-only mapping),
+    the ids repeated across dataflows (agencies, references' agencies and classes) being interned.
+    Yields the records one at a time, as the dataflows are extracted.
+    Works on streamed responses as well, with each dataflow being discarded once extracted.
+    The names, structure and references are found with the response's compiled paths (see "CustomResponse.path()").
+    The name is read in the first of the "languages" it exists in (by default, the languages the response
+    was requested in, see "CustomSession()"); with several languages, the record also holds the name in each of them
+    (e.g. "dataflow_name_fr", empty if missing), all read in a single pass over the names.
     """
-    dataflows = []
-    for dataflow in response.hierarchy.findall(
-        f".//{response.find_namespace('structure')}Dataflow"
-    ):
-        agency_id = dataflow.attrib["agencyID"]
+    languages = tuple(languages or response.languages)
+    multilingual = len(languages) > 1
+    if response.format != "xml":
+        yield from decoders.decoder(response, "dataflows")(response.body(), languages)
+        return
+    for dataflow in response.iter_elements("Dataflow"):
+        names = response.path("names")
+        structure = response.path("structure")
+        reference = response.path("reference")
+        agency_id = intern(dataflow.attrib["agencyID"])
         dataflow_id = dataflow.attrib["id"]
-        dataflow_name = ""
-        dataflow_names = dataflow.findall(f"./{response.find_namespace('common')}Name")
-        for name in dataflow_names:
-            if name.attrib[r"{http://www.w3.org/XML/1998/namespace}lang"] == "en":
-                dataflow_name = name.text.replace("\r", "").replace("\n", "")
-                dataflow_name = re.sub(" +", " ", dataflow_name)
-                break
-            else:
-                continue
-        dataflow_structure = dataflow.find(
-            f"./{response.find_namespace('structure')}Structure"
-        )
-        if dataflow_structure is not None:
-            dataflow_reference = dataflow_structure.find("./Ref")
+        dataflow_names = localized_names(names(dataflow), languages)
+        dataflow_name = preferred(dataflow_names, languages)
+        dataflow_structure = structure(dataflow)
+        if dataflow_structure:
+            dataflow_reference = reference(dataflow_structure[0])[0]
             reference_id = dataflow_reference.attrib["id"]
-            reference_agencyID = dataflow_reference.attrib["agencyID"]
-            reference_class = dataflow_reference.attrib["class"]
+            reference_agencyID = intern(dataflow_reference.attrib["agencyID"])
+            reference_class = intern(dataflow_reference.attrib["class"])
         else:
             reference_id = "None"
             reference_agencyID = "None"
             reference_class = "None"
-        dataflows.append(
-            {
-                "dataflow_id": dataflow_id,
-                "agency_id": agency_id,
-                "dataflow_name": dataflow_name,
-                "reference_id": reference_id,
-                "reference_agencyID": reference_agencyID,
-                "reference_class": reference_class,
-            }
+        yield Dataflow(
+            dataflow_id,
+            agency_id,
+            dataflow_name,
+            reference_id,
+            reference_agencyID,
+            reference_class,
+            (
+                {language: dataflow_names.get(language, "") for language in languages}
+                if multilingual
+                else None
+            ),
         )
+
+
+def dataflows(response: CustomResponse, languages: tuple = None) -> list:
+    """
+    Extracts relevant information from the inquired dataflows (see "iter_dataflows()").
+    Adds the records to a list.
+    """
+    with instrumentation.span("extract", kind="dataflows") as extract:
+        dataflows = list(iter_dataflows(response, languages))
+        extract["rows"] = len(dataflows)
     return dataflows
 
 
-def codelists(response: CustomResponse) -> list:
+def iter_codelists(response: CustomResponse, languages: tuple = None):
     """
     Extracts relevant information from the inquired codelists.
-    Each code has it's properties stored in a dictionary.
-    Adds the dictionaries to a list.
+    Each code has it's properties stored in a compact "Code()" record (a read-only mapping),
+    grouped under its codelist's "Codelist()" record, which holds the agency and codelist ids once for all its codes.
+    The parents' ids, repeated across codes, are interned.
+    Yields the records one at a time, as the codes are extracted.
+    Works on streamed responses as well, with each codelist being discarded once extracted.
+    The names, codes and parents are found with the response's compiled paths (see "CustomResponse.path()").
+    The names are read in the "languages" as the dataflows' are (see "iter_dataflows()"), e.g. "code_name_fr".
     """
-    codelists = []
-    for codelist in response.hierarchy.findall(
-        f".//{response.find_namespace('structure')}Codelist"
-    ):
+    languages = tuple(languages or response.languages)
+    multilingual = len(languages) > 1
+    if response.format != "xml":
+        yield from decoders.decoder(response, "codelists")(response.body(), languages)
+        return
+    for codelist in response.iter_elements("Codelist"):
+        names = response.path("names")
+        codes = response.path("codes")
+        parent = response.path("parent")
+        reference = response.path("reference")
         agency_id = codelist.attrib["agencyID"]
         codelist_id = codelist.attrib["id"]
-        codelist_names = codelist.findall(f"./{response.find_namespace('common')}Name")
-        codelist_name = ""
-        for name in codelist_names:
-            if name.attrib[r"{http://www.w3.org/XML/1998/namespace}lang"] == "en":
-                codelist_name = name.text.replace("\r", "").replace("\n", "")
-                codelist_name = re.sub(" +", " ", codelist_name)
-                break
-            else:
-                continue
-        codes = codelist.findall(f"./{response.find_namespace('structure')}Code")
-        for code in codes:
+        codelist_names = localized_names(names(codelist), languages)
+        codelist_name = preferred(codelist_names, languages)
+        parent_codelist = Codelist(
+            intern(agency_id),
+            codelist_id,
+            codelist_name,
+            (
+                {language: codelist_names.get(language, "") for language in languages}
+                if multilingual
+                else None
+            ),
+        )
+        for code in codes(codelist):
             code_id = code.attrib["id"]
-            code_name = ""
-            code_names = code.findall(f"./{response.find_namespace('common')}Name")
-            for name in code_names:
-                if name.attrib[r"{http://www.w3.org/XML/1998/namespace}lang"] == "en":
-                    code_name = name.text.replace("\r", "").replace("\n", "")
-                    code_name = codelist_name = re.sub(" +", " ", code_name)
-                    break
-                else:
-                    continue
-            parent = code.find(f"./{response.find_namespace('structure')}Parent")
-            if parent is not None:
-                code_reference = parent.find("./Ref")
-                code_parent = code_reference.attrib["id"]
+            code_names = localized_names(names(code), languages)
+            code_name = preferred(code_names, languages)
+            if code_names:
+                codelist_name = code_name
+            else:
+                pass
+            code_parents = parent(code)
+            if code_parents:
+                code_reference = reference(code_parents[0])[0]
+                code_parent = intern(code_reference.attrib["id"])
             else:
                 code_parent = "None"
-            codelists.append(
-                {
-                    "agency_id": agency_id,
-                    "codelist_id": codelist_id,
-                    "codelist_name": codelist_name,
-                    "code_id": code_id,
-                    "code_name": code_name,
-                    "code_parent": code_parent,
-                }
+            yield Code(
+                parent_codelist,
+                codelist_name,
+                code_id,
+                code_name,
+                code_parent,
+                (
+                    {language: code_names.get(language, "") for language in languages}
+                    if multilingual
+                    else None
+                ),
             )
+
+
+def codelists(response: CustomResponse, languages: tuple = None) -> list:
+    """
+    Extracts relevant information from the inquired codelists (see "iter_codelists()").
+    Adds the records to a list.
+    """
+    with instrumentation.span("extract", kind="codelists") as extract:
+        codelists = list(iter_codelists(response, languages))
+        extract["rows"] = len(codelists)
     return codelists
 
 
-def output_dataflows(out: list) -> None:
+def artefacts(response: CustomResponse, name: str = "Codelist") -> list:
+    """
+    Lists the identity of the inquired artefacts of a type (e.g. "Codelist", "Dataflow"),
+    e.g. from a stubs listing ("detail=allstubs"), without looking into their content.
+    Each artefact is a dictionary: agency_id, id, version.
+    """
+    return [
+        {
+            "agency_id": artefact.attrib["agencyID"],
+            "id": artefact.attrib["id"],
+            "version": artefact.attrib.get("version", "1.0"),
+        }
+        for artefact in response.iter_elements(name)
+    ]
+
+
+def iter_observations(response: CustomResponse):
+    """
+    Extracts the observations of the inquired (structure specific) data.
+    Each observation has its series key and its own properties (time period, value, attributes)
+    stored in a dictionary, the series' attributes first.
+    Yields the dictionaries one at a time, as the series are extracted.
+    Works on streamed responses as well, with each series being discarded once extracted.
+    The attributes are read with "items()", a single call with either parser backend.
+    SDMX-CSV and SDMX-JSON responses are decoded into the same dictionaries (see "decoders").
+    """
+    if response.format != "xml":
+        yield from decoders.decoder(response, "observations")(response.body())
+        return
+    for element in response.iter_elements("Series", "Obs"):
+        if element.tag.rpartition("}")[2] == "Series":
+            series = dict(element.items())
+            for obs in element:
+                observation = series.copy()
+                observation.update(obs.items())
+                yield observation
+        else:
+            yield dict(element.items())
+
+
+def observations(response: CustomResponse) -> list:
+    """
+    Extracts the observations of the inquired (structure specific) data (see "iter_observations()").
+    Adds the dictionaries to a list.
+    """
+    with instrumentation.span("extract", kind="observations") as extract:
+        observations = list(iter_observations(response))
+        extract["rows"] = len(observations)
+    return observations
+
+
+def observation_columns(response: CustomResponse) -> ObservationColumns:
+    """
+    Extracts the observations of the inquired (structure specific) data into column oriented buffers:
+    the values as doubles, the dimensions and attributes as dictionary-encoded integer codes.
+    Works on streamed responses as well, with each series being discarded once extracted,
+    and on SDMX-CSV/SDMX-JSON responses (see "iter_observations()").
+    """
+    columns = ObservationColumns()
+    with instrumentation.span("extract", kind="observation_columns") as extract:
+        if response.format != "xml":
+            for observation in iter_observations(response):
+                columns.add(observation)
+        else:
+            for element in response.iter_elements("Series", "Obs"):
+                if element.tag.rpartition("}")[2] == "Series":
+                    columns.add_series(element.attrib, (obs.attrib for obs in element))
+                else:
+                    columns.add(element.attrib)
+        extract["rows"] = len(columns)
+    return columns
+
+
+def output_fields(fields: list, name_field: str, languages) -> list:
+    """
+    The columns of the exported dataflows/codes: their fields, plus their name in each language, if extracted in several.
+    """
+    if languages is not None and len(languages) > 1:
+        return fields + localized_fields(name_field, languages)
+    return fields
+
+
+def output_dataflows(out, path: str = "dataflows.txt", languages=None) -> None:
+    """
+    Writes the dataflows to an output file (by default dataflows.txt), in the format given by its extension:
+    - ".txt": a fixed-width table (tabulate)
+    - any format of "exporters.EXPORTERS" (e.g. ".csv.gz", ".parquet"): written in chunks,
+      so "out" can be the generator returned by "iter_dataflows()"
+    The dataflows extracted in several "languages" have a column for their name in each of them.
+    """
+    exporters.export(
+        out, path, output_fields(DATAFLOW_FIELDS, "dataflow_name", languages)
+    )
+
+
+def output_codelists(out, path: str = "codelists.txt", languages=None) -> None:
     """
-    Writes the list of dataflows to an output file.
+    Writes the codes of the codelists to an output file (by default codelists.txt), in the format given by its extension
+    (see "output_dataflows()"); "out" can be the generator returned by "iter_codelists()".
     """
-    with open("dataflows.txt", "w") as file:
-        file.write(tabulate(out, "keys"))
+    exporters.export(out, path, output_fields(CODELIST_FIELDS, "code_name", languages))
 
 
-def output_codelists(out: list) -> None:
+def output_observations(out, path: str = "observations.csv.gz", fields=None) -> None:
     """
-    Writes the list of codelists to an output file.
+    Writes the observations to an output file (by default observations.csv.gz), in the format given by its extension
+    (see "output_dataflows()"); "out" can be the generator returned by "iter_observations()",
+    or the "ObservationColumns" returned by "observation_columns()".
+    Unless "fields" are given, the columns are those of all the observations, in order of appearance
+    (e.g. an attribute first appearing after the first chunk, see "exporters.export()").
     """
-    with open("codelists.txt", "w") as file:
-        file.write(tabulate(out, "keys"))
+    if isinstance(out, ObservationColumns):
+        fields = fields or out.fields
+        out = out.rows()
+    exporters.export(out, path, fields)
@@ -0,0 +1,167 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+import threading
+
+
+class StubServer:
+    """
+    Local HTTP server standing in for the OECD endpoint, for offline tests and benchmarks:
+    - serves the registered bodies by (unquoted) path, query string included
+    - answers conditional requests with "304 Not Modified" when the ETag/Last-Modified match
+    - can be scripted to answer a path with a sequence of statuses (e.g. 429/503) before serving its body
+    - can serve byte ranges of the bodies ("Range"/"If-Range"), and drop connections partway through a body
+    Records the path and headers of every request received.
+    """
+
+    def __init__(self) -> None:
+        self.resources = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                server.handle(self)
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        """
+        Root url of the server, to be used in place of the OECD endpoint root.
+        """
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def add(
+        self,
+        path: str,
+        body: bytes,
+        etag=None,
+        last_modified=None,
+        script=(),
+        headers=None,
+        ranges=False,
+        drops=(),
+    ) -> None:
+        """
+        Registers the body served under the path, with:
+        - "etag"/"last_modified", the validators sent along, and matched against conditional requests
+        - "script", the (status, headers) answers to send, one per request, before serving the body
+        - "headers", extra headers sent along with the body
+        - "ranges", whether byte ranges are served ("Accept-Ranges: bytes"), if "If-Range" matches the validators
+        - "drops", the number of bytes of the body sent before dropping the connection, one per request
+        """
+        with self.lock:
+            self.resources[path] = {
+                "body": body,
+                "etag": etag,
+                "last_modified": last_modified,
+                "script": list(script),
+                "headers": headers or {},
+                "ranges": ranges,
+                "drops": list(drops),
+            }
+
+    def handle(self, handler: BaseHTTPRequestHandler) -> None:
+        """
+        Answers a request, following the script of the requested path first.
+        """
+        with self.lock:
+            path = unquote(handler.path)
+            self.requests.append(
+                {"path": path, "headers": dict(handler.headers.items())}
+            )
+            resource = self.resources.get(path)
+            scripted = (
+                resource["script"].pop(0) if resource and resource["script"] else None
+            )
+            drop = resource["drops"].pop(0) if resource and resource["drops"] else None
+        if resource is None:
+            self.send(handler, 404, {}, b"Not Found")
+        elif scripted is not None:
+            status, headers = scripted
+            self.send(handler, status, headers, b"")
+        elif (
+            resource["etag"] is not None
+            and handler.headers.get("If-None-Match") == resource["etag"]
+        ) or (
+            resource["last_modified"] is not None
+            and handler.headers.get("If-Modified-Since") == resource["last_modified"]
+        ):
+            self.send(handler, 304, self.validators(resource), b"")
+        else:
+            headers = {"Content-Type": "application/xml"}
+            headers.update(self.validators(resource))
+            headers.update(resource["headers"])
+            body = resource["body"]
+            status = 200
+            requested = handler.headers.get("Range", "")
+            if resource["ranges"]:
+                headers["Accept-Ranges"] = "bytes"
+            else:
+                pass
+            if (
+                resource["ranges"]
+                and requested.startswith("bytes=")
+                and handler.headers.get("If-Range")
+                in (None, *self.validators(resource).values())
+            ):
+                start = int(requested[len("bytes=") :].split("-")[0])
+                if start >= len(body):
+                    self.send(
+                        handler, 416, {"Content-Range": f"bytes */{len(body)}"}, b""
+                    )
+                    return
+                headers["Content-Range"] = f"bytes {start}-{len(body) - 1}/{len(body)}"
+                body = body[start:]
+                status = 206
+            else:
+                pass
+            self.send(handler, status, headers, body, drop)
+
+    def validators(self, resource: dict) -> dict:
+        """
+        The ETag/Last-Modified headers of a resource.
+        """
+        validators = {}
+        if resource["etag"] is not None:
+            validators["ETag"] = resource["etag"]
+        if resource["last_modified"] is not None:
+            validators["Last-Modified"] = resource["last_modified"]
+        return validators
+
+    def send(
+        self,
+        handler: BaseHTTPRequestHandler,
+        status: int,
+        headers: dict,
+        body: bytes,
+        drop: int = None,
+    ) -> None:
+        """
+        Sends a complete response, or only its first "drop" bytes of body before closing the connection.
+        """
+        handler.send_response(status)
+        for key, val in headers.items():
+            handler.send_header(key, val)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        if drop is None:
+            handler.wfile.write(body)
+        else:
+            handler.wfile.write(body[:drop])
+            handler.wfile.flush()
+            handler.close_connection = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,409 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from CustomSession import CustomSession, URL_ROOT
+from DatabaseLoader import DatabaseLoader
+from ResponseCache import ResponseCache
+from RetryScheduler import RetryScheduler
+import standalone_functions as fct
+import hashlib
+import instrumentation
+import json
+import os
+import reconciliation
+import sqlite3
+import sys
+import threading
+import time
+
+ARTEFACT_TYPES = {
+    "codelist": ("Codelist", fct.codelists, "code_id"),
+    "dataflow": ("Dataflow", fct.dataflows, "dataflow_id"),
+}
+"""
+Artefact types kept in sync, with:
+- the tag of their artefacts in the structure messages
+- the extractor of their rows
+- the field identifying a row within its artefact
+"""
+
+
+def digest(row: dict) -> str:
+    """
+    Content hash of an extracted row.
+    """
+    return hashlib.sha256(
+        json.dumps(row, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+class SyncManifest:
+    """
+    Class for keeping track, in an on-disk sqlite3 store, of the structural metadata synced across runs:
+    - the artefacts of each type, keyed on (agency_id, id), with the version synced and the content hash of their rows
+    - the rows of each artefact (e.g. the codes of a codelist), with their own content hash,
+      so that the changes of the next sync can be told code by code
+    - checkpoints, the time of the last sync of anything else (e.g. a data query, for "updatedAfter")
+    """
+
+    def __init__(self, path: str = "sync_manifest.db") -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS artefacts ("
+                "type TEXT, agency_id TEXT, id TEXT, version TEXT, digest TEXT, synced_at REAL, "
+                "PRIMARY KEY (type, agency_id, id));"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS rows ("
+                "type TEXT, agency_id TEXT, id TEXT, key TEXT, row TEXT, digest TEXT, "
+                "PRIMARY KEY (type, agency_id, id, key));"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints (name TEXT PRIMARY KEY, synced_at REAL);"
+            )
+
+    def artefacts(self, artefact_type: str) -> dict:
+        """
+        The synced artefacts of a type: (agency_id, id) -> (version, digest).
+        """
+        with self.lock:
+            return {
+                (agency_id, id_): (version, digest_)
+                for agency_id, id_, version, digest_ in self.connection.execute(
+                    "SELECT agency_id, id, version, digest FROM artefacts WHERE type = ?;",
+                    (artefact_type,),
+                )
+            }
+
+    def rows(self, artefact_type: str, agency_id: str, id_: str) -> dict:
+        """
+        The synced rows of an artefact: key -> (row, digest).
+        """
+        with self.lock:
+            return {
+                key: (json.loads(row), digest_)
+                for key, row, digest_ in self.connection.execute(
+                    "SELECT key, row, digest FROM rows WHERE type = ? AND agency_id = ? AND id = ?;",
+                    (artefact_type, agency_id, id_),
+                )
+            }
+
+    def update(
+        self,
+        artefact_type: str,
+        agency_id: str,
+        id_: str,
+        version: str,
+        digest_: str,
+        rows: dict,
+    ) -> None:
+        """
+        Records the synced state of an artefact: its version, digest, and rows (key -> (row, digest)).
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO artefacts VALUES (?, ?, ?, ?, ?, ?);",
+                (artefact_type, agency_id, id_, version, digest_, time.time()),
+            )
+            self.connection.execute(
+                "DELETE FROM rows WHERE type = ? AND agency_id = ? AND id = ?;",
+                (artefact_type, agency_id, id_),
+            )
+            self.connection.executemany(
+                "INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?);",
+                (
+                    (
+                        artefact_type,
+                        agency_id,
+                        id_,
+                        key,
+                        json.dumps(row, ensure_ascii=False),
+                        row_digest,
+                    )
+                    for key, (row, row_digest) in rows.items()
+                ),
+            )
+
+    def remove(self, artefact_type: str, agency_id: str, id_: str) -> None:
+        """
+        Forgets an artefact, and its rows.
+        """
+        with self.lock, self.connection:
+            for table in ("artefacts", "rows"):
+                self.connection.execute(
+                    f"DELETE FROM {table} WHERE type = ? AND agency_id = ? AND id = ?;",
+                    (artefact_type, agency_id, id_),
+                )
+
+    def checkpoint(self, name: str):
+        """
+        The time (epoch) of the last recorded sync of "name", or None.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT synced_at FROM checkpoints WHERE name = ?;", (name,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_checkpoint(self, name: str, synced_at: float = None) -> None:
+        """
+        Records the time (by default, now) of a sync of "name".
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?);",
+                (name, synced_at if synced_at is not None else time.time()),
+            )
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def updated_after(args: list, since: float = None) -> list:
+    """
+    Returns the arguments of a data query (see "CustomSession()"), limited to the observations updated
+    after "since" (epoch) with the "updatedAfter" parameter, replacing any previous one.
+    Without "since" (e.g. a query never synced), the arguments are returned as is.
+    Only data queries take the parameter: structure queries are synced with "sync()".
+    """
+    if since is None:
+        return list(args)
+    timestamp = datetime.fromtimestamp(since, timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
+    parameters = [
+        p for p in args[6].split("&") if p and not p.startswith("updatedAfter=")
+    ]
+    parameters.append(f"updatedAfter={timestamp}")
+    return list(args[:6]) + ["&".join(parameters)]
+
+
+def diff_rows(previous: dict, current: dict, artefact: dict, artefact_type: str):
+    """
+    Yields the changes between the previous and current rows of an artefact (key -> (row, digest)):
+    "added", "removed" and "modified" rows, the latter along with their "previous" row.
+    """
+    for key, (row, row_digest) in current.items():
+        if key not in previous:
+            action = "added"
+        elif previous[key][1] != row_digest:
+            action = "modified"
+        else:
+            continue
+        change = {"artefact_type": artefact_type, **artefact, "action": action}
+        change.update({"key": key, "row": row})
+        if action == "modified":
+            change["previous"] = previous[key][0]
+        else:
+            pass
+        yield change
+    for key, (row, _) in previous.items():
+        if key not in current:
+            yield {
+                "artefact_type": artefact_type,
+                **artefact,
+                "action": "removed",
+                "key": key,
+                "row": row,
+            }
+
+
+def fetch_artefact(
+    artefact_type: str,
+    artefact: dict,
+    adapter: HTTPAdapter,
+    cache: ResponseCache = None,
+    url_root: str = URL_ROOT,
+    retry: RetryScheduler = None,
+) -> dict:
+    """
+    Fetches a single artefact (by agency, id and version), through the shared connection pool,
+    and returns its rows (key -> (row, digest)), as dictionaries.
+    """
+    _, extractor, key_field = ARTEFACT_TYPES[artefact_type]
+    session = CustomSession(
+        [
+            "structure",
+            artefact_type,
+            artefact["agency_id"],
+            artefact["id"],
+            artefact["version"],
+        ],
+        cache=cache,
+        url_root=url_root,
+        retry=retry,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    try:
+        response = session.get()
+        if cache is not None:
+            rows = cache.extract(response, extractor)
+        else:
+            rows = extractor(response)
+    finally:
+        # The connection pool is shared by the sync (and closed by "sync()"), not the session's own
+        for prefix in ("https://", "http://"):
+            session.adapters.pop(prefix, None)
+        session.close()
+    rows = (dict(row) for row in rows)
+    return {row[key_field]: (row, digest(row)) for row in rows}
+
+
+def sync(
+    artefact_type: str = "codelist",
+    manifest: SyncManifest = None,
+    cache: ResponseCache = None,
+    url_root: str = URL_ROOT,
+    retry: RetryScheduler = None,
+    revalidate: bool = False,
+    max_workers: int = 4,
+) -> list:
+    """
+    Syncs the structural metadata of an artefact type ("codelist" or "dataflow") with the manifest,
+    downloading only what changed since the last sync:
+    - lists the latest version of every artefact with a stubs query ("detail=allstubs"), holding no content
+    - fetches and extracts only the artefacts that are new, or whose version changed
+      (with "revalidate", the unchanged ones too, which the cache revalidates with conditional requests)
+    - compares the rows extracted with the manifest's, by content hash, and records the new state
+    Returns the change log: one change per added, removed or modified row (e.g. a code), in the format of
+    "diff_rows()", to be applied as a delta (see "DatabaseLoader.apply_changes()").
+    The artefacts no longer listed have all their rows removed.
+    """
+    if manifest is None:
+        manifest = SyncManifest()
+        try:
+            return sync(
+                artefact_type, manifest, cache, url_root, retry, revalidate, max_workers
+            )
+        finally:
+            manifest.close()
+    else:
+        pass
+    name, _, _ = ARTEFACT_TYPES[artefact_type]
+    retry = retry if retry is not None else RetryScheduler()
+    changes = []
+    with instrumentation.span("sync", artefact_type=artefact_type) as span:
+        with CustomSession(
+            ["structure", artefact_type, "*", "*", "~", "detail=allstubs"],
+            url_root=url_root,
+            retry=retry,
+        ) as session:
+            stubs = session.get()
+        listed = {(a["agency_id"], a["id"]): a for a in fct.artefacts(stubs, name)}
+        known = manifest.artefacts(artefact_type)
+        outdated = [
+            a
+            for key, a in listed.items()
+            if revalidate or key not in known or known[key][0] != a["version"]
+        ]
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        try:
+            with ThreadPoolExecutor(max_workers) as executor:
+                futures = {
+                    executor.submit(
+                        fetch_artefact,
+                        artefact_type,
+                        a,
+                        adapter,
+                        cache,
+                        url_root,
+                        retry,
+                    ): a
+                    for a in outdated
+                }
+                for future in as_completed(futures):
+                    artefact = futures[future]
+                    key = (artefact["agency_id"], artefact["id"])
+                    rows = future.result()
+                    artefact_digest = hashlib.sha256(
+                        "".join(sorted(d for _, d in rows.values())).encode()
+                    ).hexdigest()
+                    if key in known and known[key][1] == artefact_digest:
+                        previous = rows
+                    else:
+                        previous = manifest.rows(artefact_type, *key)
+                    changes.extend(diff_rows(previous, rows, artefact, artefact_type))
+                    manifest.update(
+                        artefact_type, *key, artefact["version"], artefact_digest, rows
+                    )
+        finally:
+            adapter.close()
+        for key in known.keys() - listed.keys():
+            artefact = {"agency_id": key[0], "id": key[1], "version": known[key][0]}
+            changes.extend(
+                diff_rows(
+                    manifest.rows(artefact_type, *key), {}, artefact, artefact_type
+                )
+            )
+            manifest.remove(artefact_type, *key)
+        span["listed"] = len(listed)
+        span["fetched"] = len(outdated)
+        span["changes"] = len(changes)
+    instrumentation.count("artefacts_fetched", len(outdated))
+    return changes
+
+
+def write_changes(changes: list, path: str = "changes.json") -> None:
+    """
+    Writes the change log to an output file, as JSON.
+    """
+    with open(path, "w") as file:
+        json.dump(changes, file, indent=2, ensure_ascii=False)
+
+
+def main() -> None:
+    """
+    Syncs the codelists and dataflows (or the artefact types given as arguments) with sync_manifest.db,
+    writes the change log to changes.json, and applies the codelists' changes to Macro.db, if any
+    (see "reconciliation.MAPPINGS").
+    With "--revalidate", the artefacts whose version did not change are checked as well.
+    The counts of changes are printed by the console listener (see "instrumentation.console()").
+    """
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    revalidate = "--revalidate" in sys.argv[1:]
+    for artefact_type in args:
+        if artefact_type not in ARTEFACT_TYPES:
+            sys.exit(f'"{artefact_type}" not in {tuple(ARTEFACT_TYPES)}')
+        else:
+            pass
+    manifest = SyncManifest()
+    cache = ResponseCache()
+    instrumentation.add_listener(instrumentation.console)
+    try:
+        changes = []
+        for artefact_type in args or ARTEFACT_TYPES:
+            changes.extend(
+                sync(artefact_type, manifest, cache=cache, revalidate=revalidate)
+            )
+        write_changes(changes)
+        for action in ("added", "modified", "removed"):
+            instrumentation.message(
+                f"{action}: {sum(c['action'] == action for c in changes)}"
+            )
+        if os.path.exists("Macro.db"):
+            loader = DatabaseLoader()
+            try:
+                renamed = loader.apply_changes(
+                    changes,
+                    {
+                        (agency_id, codelist_id): (table, column)
+                        for table, column, agency_id, codelist_id in reconciliation.MAPPINGS.values()
+                    },
+                )
+            finally:
+                loader.close()
+            instrumentation.message(f"Macro.db: {renamed} values renamed")
+        else:
+            pass
+    finally:
+        instrumentation.remove_listener(instrumentation.console)
+        cache.close()
+        manifest.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,59 @@
 import pytest
+import sqlite3
 import main
+import batch
+import chunking
+import exporters
+import instrumentation
+import json
+import reconciliation
+import standalone_functions as fct
+from requests import RequestException
+from requests.exceptions import StreamConsumedError
+from CustomSession import CustomSession
+from DatabaseLoader import DatabaseLoader, labels
+from ObservationColumns import ObservationColumns
+from ResponseCache import ResponseCache
+from RetryScheduler import RetryScheduler, TokenBucket
+from sdmx_fixtures import data_xml, make_response, FORMAT_FIXTURES
+from stub_server import StubServer
+
+STRUCTURE_XML = b"""<?xml version="1.0" encoding="utf-8"?>
+<message:Structure xmlns:message="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message" xmlns:structure="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure" xmlns:common="http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <message:Header><message:ID>IREF000001</message:ID></message:Header>
+  <message:Structures>
+    <structure:Dataflows>
+      <structure:Dataflow id="DSD_NAAG@DF_NAAG_I" agencyID="OECD.SDD.NAD" version="1.0">
+        <common:Name xml:lang="fr">Agr\xc3\xa9gats</common:Name>
+        <common:Name xml:lang="en">National   accounts
+ aggregates</common:Name>
+        <structure:Structure><Ref id="DSD_NAAG" agencyID="OECD.SDD.NAD" class="DataStructure" /></structure:Structure>
+      </structure:Dataflow>
+      <structure:Dataflow id="DF_EMPTY" agencyID="OECD">
+        <common:Name xml:lang="en">Empty</common:Name>
+      </structure:Dataflow>
+    </structure:Dataflows>
+    <structure:Codelists>
+      <structure:Codelist id="CL_AREA" agencyID="OECD" version="1.0">
+        <common:Name xml:lang="en">Reference area</common:Name>
+        <structure:Code id="AUS"><common:Name xml:lang="en">Australia</common:Name></structure:Code>
+        <structure:Code id="OECD"><common:Name xml:lang="en">OECD</common:Name></structure:Code>
+      </structure:Codelist>
+      <structure:Codelist id="CL_TRANSACTION" agencyID="OECD.SDD.NAD" version="1.0">
+        <common:Name xml:lang="en">Transaction</common:Name>
+        <structure:Code id="B1GQ"><common:Name xml:lang="en">Gross domestic product</common:Name></structure:Code>
+        <structure:Code id="B1G"><common:Name xml:lang="en">Value added</common:Name><structure:Parent><Ref id="B1GQ" /></structure:Parent></structure:Code>
+      </structure:Codelist>
+    </structure:Codelists>
+  </message:Structures>
+</message:Structure>
+"""
 
 
 def test_extract_fromDB():
     db = main.extract_fromDB("subjects", "name")
     api = main.extract_fromAPI("subject")
-    assert db <= api
+    assert set(db).issubset(set(api))
 
 
 def test_extract_fromAPI():
@@ -74,3 +122,1138 @@ def test_query_OK(monkeypatch):
         ],
     )
     assert main.query() is None
+
+
+def test_streaming_response(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert fct.dataflows(make_response(STRUCTURE_XML, stream=True)) == fct.dataflows(
+        make_response(STRUCTURE_XML)
+    )
+    assert fct.codelists(make_response(STRUCTURE_XML, stream=True)) == fct.codelists(
+        make_response(STRUCTURE_XML)
+    )
+
+    make_response(STRUCTURE_XML).output_hierarchy()
+    expected = (tmp_path / "hierarchy.txt").read_text()
+    streamed = make_response(STRUCTURE_XML, stream=True)
+    streamed.output_hierarchy()
+    assert (tmp_path / "hierarchy.txt").read_text() == expected
+    with pytest.raises(StreamConsumedError):
+        fct.dataflows(streamed)
+
+    make_response(STRUCTURE_XML, stream=True).output_hierarchy(rng=3)
+    assert (
+        tmp_path / "hierarchy.txt"
+    ).read_text().splitlines() == expected.splitlines()[:5]
+
+
+def test_namespace_index():
+    response = make_response(STRUCTURE_XML)
+    structure = "{http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure}"
+    assert response.find_namespace("structure") == structure
+    assert response.find_description(structure) == "structure"
+    assert response.prefixes["structure"] == structure
+    assert response.namespace_prefixes[structure] == "structure"
+    assert response.tags["Codelist"] == structure + "Codelist"
+    assert (
+        response.find_description("{http://www.w3.org/2001/XMLSchema-instance}") == ""
+    )
+
+
+def test_response_cache(tmp_path):
+    import pickle
+
+    cache = ResponseCache(str(tmp_path / "cache.db"), ttl=0)
+    with StubServer() as server:
+        server.add("/structure/codelist", STRUCTURE_XML, etag='"v1"')
+        session = CustomSession(
+            ["structure", "codelist"], cache=cache, url_root=server.url
+        )
+        first = session.get()
+        assert cache.extract(first, fct.codelists) == fct.codelists(first)
+
+        def extracted(response):
+            calls.append(response)
+            return fct.codelists(response)
+
+        calls = []
+        assert cache.extract(first, extracted) == cache.extract(first, extracted)
+        assert len(calls) == 1
+
+        second = session.get()
+        assert server.requests[-1]["headers"]["If-None-Match"] == '"v1"'
+        assert second.content == STRUCTURE_XML
+        assert cache.extract(second, lambda response: []) == []
+        assert cache.extract(second, fct.codelists) == fct.codelists(first)
+        with cache.connection:
+            cache.connection.execute(
+                "UPDATE extracts SET output = ?;",
+                (pickle.dumps([eval]),),
+            )
+        assert cache.extract(second, fct.codelists) == fct.codelists(first)
+
+        cache.ttl = 3600
+        session.get()
+        assert len(server.requests) == 2
+
+    cache.max_size = 0
+    cache.store("other", "accept", first)
+    assert cache.lookup(session.url, session.headers["Accept"]) is None
+
+
+def test_run_batch(tmp_path, capsys):
+    manifest_path = tmp_path / "manifest.csv"
+    manifest_path.write_text(
+        "# context,agency,dataflow,version,filter,parameters\n"
+        "dataflow,OECD.SDD.NAD,DSD_NAAG@DF_NAAG_I,1.0,A.AUS,c[TIME_PERIOD]=ge:2018\n"
+        "dataflow,OECD.SDD.NAD,DSD_NAAG@DF_NAAG_I,1.0,A.FRA,c[TIME_PERIOD]=ge:2018\n"
+        "dataflow,OECD.SDD.NAD,MISSING,1.0,*,\n"
+        "dataflow,OECD.SDD.NAD,MALFORMED,1.0,*,\n"
+    )
+    manifest = batch.read_manifest(str(manifest_path))
+    assert len(manifest) == 4
+    with StubServer() as server:
+        for area in ("AUS", "FRA"):
+            server.add(
+                f"/data/dataflow/OECD.SDD.NAD/DSD_NAAG@DF_NAAG_I/1.0/A.{area}?c[TIME_PERIOD]=ge:2018",
+                data_xml(2, 3),
+            )
+        server.add(
+            "/data/dataflow/OECD.SDD.NAD/MALFORMED/1.0/*", b"<message:Structure><"
+        )
+        results = batch.run_batch(
+            manifest, max_workers=3, output_dir=str(tmp_path), url_root=server.url
+        )
+    assert [r["status"] for r in results[:2]] == ["OK", "OK"]
+    assert results[2]["status"].startswith("Failed: RequestException")
+    assert results[3]["status"].startswith("Failed: XMLSyntaxError")
+    assert capsys.readouterr().out == ""
+    assert (tmp_path / "001_DSD_NAAG@DF_NAAG_I" / "hierarchy.txt").exists()
+
+
+def test_retry_scheduler():
+    retry = RetryScheduler(backoff=0.01, limiter=TokenBucket(rate=1000))
+    with StubServer() as server:
+        server.add(
+            "/structure/codelist",
+            STRUCTURE_XML,
+            script=[(429, {"Retry-After": "0.05"}), (503, {}), (502, {})],
+        )
+        server.add("/structure/dataflow", STRUCTURE_XML, script=[(503, {})] * 3)
+        session = CustomSession(
+            ["structure", "codelist"], url_root=server.url, retry=retry
+        )
+        assert session.get().content == STRUCTURE_XML
+        assert retry.metrics["retries"] == 3
+        assert retry.metrics["statuses"] == {"429": 1, "503": 1, "502": 1}
+        assert retry.metrics["throttled_time"] >= 0.04
+
+        retry.max_retries = 2
+        session = CustomSession(
+            ["structure", "dataflow"], url_root=server.url, retry=retry
+        )
+        with pytest.raises(RequestException):
+            session.get()
+        assert retry.metrics["failures"] == 1
+        assert len(server.requests) == 7
+
+    throttled = make_response(STRUCTURE_XML)
+    throttled.headers["Retry-After"] = "3600"
+    assert retry.delay(0, throttled) == retry.max_backoff
+    retry = RetryScheduler(backoff=0.01)
+    session = CustomSession(
+        ["structure", "codelist"], url_root="http://127.0.0.1:9", retry=retry
+    )
+    with pytest.raises(RequestException):
+        session.get()
+    assert retry.metrics["requests"] == retry.max_connect_retries + 1
+
+
+def test_fetch_chunked():
+    assert chunking.key_partitions("A.AUS+FRA+DEU.B1GQ", 2) == [
+        "A.AUS+FRA.B1GQ",
+        "A.DEU.B1GQ",
+    ]
+    root = "/data/dataflow/OECD.SDD.NAD/DSD_NAAG@DF_NAAG_I/1.0/A.AUS+AUT"
+    with StubServer() as server:
+        server.add(f"{root}?c[TIME_PERIOD]=ge:2000+le:2002", data_xml(2, 3, 2000))
+        server.add(f"{root}?c[TIME_PERIOD]=ge:2003+le:2005", data_xml(2, 4, 2002))
+        session = CustomSession(
+            [
+                "data",
+                "dataflow",
+                "OECD.SDD.NAD",
+                "DSD_NAAG@DF_NAAG_I",
+                "1.0",
+                "A.AUS+AUT",
+                "c[TIME_PERIOD]=ge:2000+le:2005",
+            ],
+            url_root=server.url,
+        )
+        observations = session.get_chunked(years=3, target_bytes=1e9)
+    assert len(server.requests) == 2
+    assert len(observations) == 12
+    assert [o["TIME_PERIOD"] for o in observations[:6]] == [
+        str(year) for year in range(2000, 2006)
+    ]
+    assert observations[2]["OBS_VALUE"] == str(3 / 8)
+
+    with StubServer() as server:
+        server.add(f"{root}?c[TIME_PERIOD]=ge:2000+le:2000", data_xml(2, 1, 2000))
+        server.add(f"{root}?c[TIME_PERIOD]=ge:2005+le:2005", data_xml(2, 1, 2005))
+        session.url_root = server.url
+        observations = session.get_chunked(years=1, max_workers=6, target_latency=0)
+        assert len(server.requests) == 6
+        assert [o["TIME_PERIOD"] for o in observations[:2]] == ["2000", "2005"]
+        session.data_query[-1] = "c[TIME_PERIOD]=ge:2001+le:2004"
+        with pytest.raises(RequestException):
+            session.get_chunked(years=1, target_latency=0)
+
+    build, content_type = FORMAT_FIXTURES["csv"]
+    report = instrumentation.TimingReport()
+    with StubServer() as server:
+        for start in (2000, 2003):
+            server.add(
+                f"{root}?c[TIME_PERIOD]=ge:{start}+le:{start + 2}",
+                build(2, 3, start),
+                headers={"Content-Type": content_type},
+            )
+        session = CustomSession(
+            ["data", *session.data_query[:-1], "c[TIME_PERIOD]=ge:2000+le:2005"],
+            url_root=server.url,
+            format="csv",
+            languages=("fr", "en"),
+        )
+        instrumentation.add_listener(report)
+        try:
+            observations = session.get_chunked(years=3, target_bytes=1e9)
+        finally:
+            instrumentation.remove_listener(report)
+        headers = [r["headers"] for r in server.requests]
+    assert len(observations) == 12
+    assert {h["Accept"] for h in headers} == {session.headers["Accept"]}
+    assert {h["Accept-Language"] for h in headers} == {
+        session.headers["Accept-Language"]
+    }
+    (stats,) = [s for s in report.spans if s["name"] == "fetch_chunked"]
+    assert (stats["chunks"], stats["observations"]) == (2, 12)
+
+
+def test_observation_columns():
+    content = data_xml(3, 4)
+    rows = fct.observations(make_response(content))
+    columns = fct.observation_columns(make_response(content, stream=True))
+    assert len(columns) == 12
+    assert list(columns.rows()) == [
+        {**row, "OBS_VALUE": float(row["OBS_VALUE"])} for row in rows
+    ]
+    assert columns.dictionaries["REF_AREA"] == [None, "AUS", "AUT", "BEL"]
+    assert list(columns.codes["REF_AREA"]) == [1] * 4 + [2] * 4 + [3] * 4
+
+    columns.add({"TIME_PERIOD": "2020", "OBS_VALUE": "NaN", "OBS_FLAG": "E"})
+    assert columns.column("REF_AREA")[-1] is None
+    assert columns.column("OBS_FLAG") == [None] * 12 + ["E"]
+    assert list(columns.records(["TIME_PERIOD", "OBS_FLAG"]))[-1] == ("2020", "E")
+
+
+def test_database_loader(tmp_path, capsys):
+    columns = fct.observation_columns(make_response(data_xml(3, 4)))
+    names = labels(
+        fct.codelists(make_response(STRUCTURE_XML)), {"REF_AREA": ("OECD", "CL_AREA")}
+    )
+    loader = DatabaseLoader(str(tmp_path / "Macro.db"), batch_size=5)
+    assert loader.load("DF_NAAG_I", columns, names, digest="v1") == 12
+    assert loader.load("DF_NAAG_I", columns, names, digest="v1") == 0
+    assert loader.load("DF_NAAG_I", columns, names, digest="v2") == 12
+    cx = loader.connection
+    assert cx.execute("SELECT COUNT(*) FROM scores;").fetchone()[0] == 12
+    assert cx.execute("SELECT name FROM subjects ORDER BY id;").fetchall() == [
+        ("Australia",),
+        ("AUT",),
+        ("BEL",),
+    ]
+    assert cx.execute("SELECT COUNT(*) FROM scopes;").fetchone()[0] == 4
+    assert capsys.readouterr().out == ""
+
+    cx.execute("UPDATE loads SET rows = 10, completed = 0;")
+    cx.commit()
+    assert (
+        DatabaseLoader(str(tmp_path / "Macro.db")).load(
+            "DF_NAAG_I", columns, names, digest="v2"
+        )
+        == 2
+    )
+
+    sparse = ObservationColumns()
+    for freq in ("A", "Q"):
+        sparse.add_series(
+            {"FREQ": freq, "REF_AREA": "AUS"},
+            [{"TIME_PERIOD": "2020", "OBS_VALUE": "1.5"}, {"TIME_PERIOD": "2021"}],
+        )
+    assert loader.load("DF_SPARSE", sparse, digest="v1") == 4
+    assert loader.load("DF_SPARSE", sparse, digest="v2") == 4
+    assert cx.execute(
+        "SELECT series_key, measure_id, flag_id, COUNT(*) FROM scores "
+        "WHERE dataflow_id = 'DF_SPARSE' GROUP BY series_key ORDER BY series_key;"
+    ).fetchall() == [("FREQ=A;REF_AREA=AUS", 0, 0, 2), ("FREQ=Q;REF_AREA=AUS", 0, 0, 2)]
+
+    for legacy in (
+        'CREATE TABLE "scores" ("id" INTEGER, "subject_id" INTEGER, "indicator_id" INTEGER, '
+        '"measure_id" INTEGER, "scope_id" INTEGER, "value" NUMERIC, "flag_id" INTEGER, PRIMARY KEY("id"));'
+        'CREATE UNIQUE INDEX "scores_key" ON "scores" ("subject_id", "indicator_id", "measure_id", "scope_id");',
+        "CREATE TABLE scores (id INTEGER, subject_id INTEGER, indicator_id INTEGER, "
+        "measure_id INTEGER, scope_id INTEGER, value NUMERIC, flag_id INTEGER);",
+    ):
+        path = tmp_path / "legacy.db"
+        path.unlink(missing_ok=True)
+        cx = sqlite3.connect(path)
+        cx.executescript(legacy)
+        cx.executemany(
+            "INSERT INTO scores (subject_id, indicator_id, measure_id, scope_id, value) "
+            "VALUES (?, ?, ?, ?, ?);",
+            [(1, 1, None, 1, 1.0), (1, 1, None, 2, 2.0), (2, 1, None, 1, 3.0)],
+        )
+        if "PRIMARY KEY" not in legacy:
+            cx.execute("INSERT INTO scores (subject_id, scope_id) VALUES (2, 1);")
+        cx.commit()
+        cx.close()
+        loader = DatabaseLoader(str(path))
+        assert loader.load("DF_SPARSE", sparse) == 4
+        loader.connection.execute(
+            "INSERT INTO scores (subject_id, indicator_id, measure_id, scope_id) "
+            "VALUES (1, 1, 0, 1), (1, 1, 0, 1);"
+        )
+        keys = loader.connection.execute(
+            "SELECT dataflow_id, series_key, scope_id FROM scores ORDER BY rowid;"
+        ).fetchall()
+        assert keys[:2] == [
+            ("", "subject_id=1;indicator_id=1;measure_id=0", 1),
+            ("", "subject_id=1;indicator_id=1;measure_id=0", 2),
+        ]
+        assert loader.load("DF_SPARSE", sparse, digest="v2") == 4
+        assert loader.connection.execute(
+            "SELECT COUNT(*) FROM scores WHERE dataflow_id = 'DF_SPARSE';"
+        ).fetchone() == (4,)
+        loader.close()
+
+
+def test_reconcile(tmp_path):
+    cx = sqlite3.connect(tmp_path / "Macro.db")
+    cx.execute("CREATE TABLE subjects (id INTEGER, name TEXT);")
+    cx.execute("CREATE TABLE indicators (id INTEGER, name TEXT);")
+    cx.execute("CREATE TABLE measures (id INTEGER, unit TEXT);")
+    cx.executemany(
+        "INSERT INTO subjects (name) VALUES (?);",
+        [("Australia",), ("OECD - Total",), ("Atlantis",)],
+    )
+    cx.executemany(
+        "INSERT INTO indicators (name) VALUES (?);",
+        [("gross  domestic product",), ("B1G",)],
+    )
+    values = reconciliation.db_values(cx)
+    assert values["subject"] == {"Australia", "OECD", "Atlantis"}
+    index = reconciliation.codelist_index(fct.codelists(make_response(STRUCTURE_XML)))
+    diff = reconciliation.reconcile(values, index)
+    assert diff["subject"]["missing"] == ["Atlantis"]
+    assert diff["subject"]["extra"] == []
+    assert diff["indicator"]["renamed"] == {
+        "B1G": "Value added",
+        "gross  domestic product": "Gross domestic product",
+    }
+    assert diff["unit"]["codelist_found"] is False
+
+
+def test_structure_url(tmp_path):
+    import daemon
+
+    session = CustomSession(
+        ["structure", "codelist", "OECD", "CL_AREA", "detail=allstubs"]
+    )
+    assert session.url.endswith("/structure/codelist/OECD/CL_AREA?detail=allstubs")
+    session = CustomSession(
+        ["structure", "dataflow", "OECD.SDD.NAD"], params={"references": "children"}
+    )
+    assert session.url.endswith("/structure/dataflow/OECD.SDD.NAD?references=children")
+    with pytest.raises(RequestException):
+        CustomSession(["structure", "codelist", "OECD", "detail=everything"])
+    with pytest.raises(RequestException):
+        CustomSession(["structure", "codelist", "A", "B", "C", "D", "E"])
+    full = ["structure", "codelist", "OECD", "CL_AREA", "1.0", "AUS", "detail=full"]
+    assert main.shell_args(full) == daemon.query_args(full) == full
+    assert CustomSession(full).url.endswith(
+        "/structure/codelist/OECD/CL_AREA/1.0/AUS?detail=full"
+    )
+    with pytest.raises(SystemExit):
+        main.shell_args(full[:-1] + ["E"])
+    with pytest.raises(RequestException):
+        daemon.query_args(full[:-1] + ["E"])
+
+    cache = ResponseCache(str(tmp_path / "cache.db"))
+    with StubServer() as server:
+        server.add("/structure/codelist/OECD/CL_AREA", STRUCTURE_XML)
+        response = CustomSession(
+            ["structure", "codelist", "OECD", "CL_AREA"],
+            cache=cache,
+            url_root=server.url,
+        ).get()
+        assert [c["code_id"] for c in fct.codelists(response)][:2] == ["AUS", "OECD"]
+
+
+def test_output_hierarchy(tmp_path):
+    depth = 5000
+    content = ("<a>" * depth + "x" + "</a>" * depth).encode()
+    path = tmp_path / "hierarchy.txt"
+    for stream in (False, True):
+        make_response(content, stream).output_hierarchy(path=str(path))
+        lines = path.read_text().splitlines()
+        assert len(lines) == depth + 2
+        assert lines[-1] == " " * 4 * (depth - 1) + "a [Attributes: None]: x"
+
+    response = make_response(STRUCTURE_XML)
+    assert response.label(response.tags["Codelist"]) == "-> (structure) Codelist"
+    response.output_hierarchy(rng=2, path=str(path))
+    assert path.read_text().splitlines()[2:] == [
+        "-> (message) Structure [Attributes: None]:  ",
+        "    -> (message) Header [Attributes: None]: None",
+    ]
+
+
+def test_exporters(tmp_path):
+    import csv
+    import gzip
+
+    expected = fct.codelists(make_response(STRUCTURE_XML))
+    path = tmp_path / "codelists.csv.gz"
+    fct.output_codelists(
+        fct.iter_codelists(make_response(STRUCTURE_XML, stream=True)), str(path)
+    )
+    with gzip.open(path, "rt", newline="") as file:
+        assert list(csv.DictReader(file)) == expected
+
+    fct.output_codelists(expected, str(tmp_path / "codelists.txt"))
+    assert (tmp_path / "codelists.txt").read_text().split()[:2] == [
+        "agency_id",
+        "codelist_id",
+    ]
+    with pytest.raises(ValueError):
+        fct.output_codelists(expected, str(tmp_path / "codelists.xlsx"))
+
+    columns = fct.observation_columns(make_response(data_xml(3, 4)))
+    assert (
+        exporters.export(columns.rows(), str(tmp_path / "obs.csv"), chunk_size=5) == 12
+    )
+    rows = [
+        {"TIME_PERIOD": "2000", "OBS_VALUE": 1},
+        {"TIME_PERIOD": "2001", "OBS_VALUE": 2},
+        {"TIME_PERIOD": "2002", "OBS_VALUE": 2.5, "OBS_COMMENT": "Estimated"},
+        {"TIME_PERIOD": "2003", "OBS_VALUE": "NaN", "OBS_STATUS": "M"},
+    ]
+    exporters.export(iter(rows), str(tmp_path / "late.csv.gz"), chunk_size=2)
+    with gzip.open(tmp_path / "late.csv.gz", "rt", newline="") as file:
+        late = list(csv.DictReader(file))
+    assert list(late[0]) == ["TIME_PERIOD", "OBS_VALUE", "OBS_COMMENT", "OBS_STATUS"]
+    assert [row["OBS_COMMENT"] for row in late] == ["", "", "Estimated", ""]
+    with pytest.raises(ValueError):
+        exporters.export(rows, str(tmp_path / "late.csv"), ["TIME_PERIOD"])
+
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    fct.output_observations(columns, str(tmp_path / "obs.parquet"))
+    table = pyarrow.parquet.read_table(tmp_path / "obs.parquet")
+    assert table.num_rows == 12
+    assert pyarrow.types.is_dictionary(table.schema.field("REF_AREA").type)
+    assert table.column("OBS_VALUE").to_pylist() == list(columns.values)
+
+    exporters.export(expected, str(tmp_path / "codelists.arrow"), chunk_size=1)
+    with pyarrow.ipc.open_file(tmp_path / "codelists.arrow") as reader:
+        assert reader.read_all().to_pylist() == expected
+
+    exporters.export(rows[:3], str(tmp_path / "late.parquet"), chunk_size=2)
+    table = pyarrow.parquet.read_table(tmp_path / "late.parquet")
+    assert table.column("OBS_VALUE").to_pylist() == [1.0, 2.0, 2.5]
+    assert table.column("OBS_COMMENT").to_pylist() == [None, None, "Estimated"]
+    exporters.export(rows, str(tmp_path / "late.arrow"), chunk_size=1)
+    with pyarrow.ipc.open_file(tmp_path / "late.arrow") as reader:
+        table = reader.read_all()
+    assert pyarrow.types.is_dictionary(table.schema.field("OBS_VALUE").type)
+    assert table.column("OBS_VALUE").to_pylist() == ["1.0", "2.0", "2.5", "NaN"]
+    assert table.column("OBS_STATUS").to_pylist() == [None, None, None, "M"]
+
+
+def test_instrumentation(tmp_path, capsys, monkeypatch):
+    report = instrumentation.TimingReport()
+    with StubServer() as server:
+        server.add("/structure/codelist", STRUCTURE_XML)
+        session = CustomSession(["structure", "codelist"], url_root=server.url)
+        response = session.get()
+        response.detail()
+        response.print_namespaces()
+        assert capsys.readouterr().out == ""
+
+        instrumentation.add_listener(instrumentation.console)
+        try:
+            response.detail()
+        finally:
+            instrumentation.remove_listener(instrumentation.console)
+        assert "- Code: 200" in capsys.readouterr().out
+
+        def failed(options):
+            raise OSError("query failed")
+
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr("sys.argv", ["main.py", "-s", "structure", "codelist"])
+        monkeypatch.setattr(main, "query", failed)
+        with pytest.raises(OSError):
+            main.main()
+        assert instrumentation.LISTENERS == []
+        assert (tmp_path / "timing.json").exists()
+
+        instrumentation.add_listener(report)
+        try:
+            response = session.get()
+            fct.output_codelists(fct.codelists(response), str(tmp_path / "cl.csv"))
+            streamed = session.get(stream=True)
+            streamed.output_hierarchy(rng=3, path=str(tmp_path / "hierarchy.txt"))
+        finally:
+            instrumentation.remove_listener(report)
+    assert list(report.summary()) == [
+        "request",
+        "download",
+        "parse",
+        "extract",
+        "write",
+        "stream_parse",
+    ]
+    assert report.summary()["request"]["calls"] == 2
+    assert report.counters["bytes_decoded"] == len(STRUCTURE_XML)
+    assert report.counters["elements"] > 3
+    extract = next(s for s in report.spans if s["name"] == "extract")
+    assert extract["rows"] == len(fct.codelists(make_response(STRUCTURE_XML)))
+
+    with instrumentation.profiled(report, str(tmp_path / "profile.prof")):
+        fct.codelists(make_response(STRUCTURE_XML))
+    report.write(str(tmp_path / "timing.json"))
+    timing = json.loads((tmp_path / "timing.json").read_text())
+    assert timing["stages"]["request"]["calls"] == 2
+    assert timing["profile"]["functions"]
+
+
+def test_async_session():
+    pytest.importorskip("httpx")
+    import asyncio
+    from AsyncSession import AsyncSession
+
+    retry = RetryScheduler(backoff=0.01)
+
+    async def run(url_root: str) -> list:
+        async with AsyncSession(url_root, retry=retry) as session:
+            return await session.gather(
+                [
+                    ["structure", "codelist"],
+                    ["structure", "dataflow", "OECD.SDD.NAD"],
+                    ["data", "dataflow", "OECD", "DF", "1.0", "A", "c=1"],
+                    ["structure", "codelist", "MISSING"],
+                ],
+                return_exceptions=True,
+            )
+
+    with StubServer() as server:
+        server.add("/structure/codelist", STRUCTURE_XML)
+        server.add(
+            "/structure/dataflow/OECD.SDD.NAD", STRUCTURE_XML, script=[(503, {})]
+        )
+        server.add("/data/dataflow/OECD/DF/1.0/A?c=1", data_xml(2, 3))
+        codelists, dataflows, data, missing = asyncio.run(run(server.url))
+        accepts = {r["path"]: r["headers"]["Accept"] for r in server.requests}
+    assert fct.codelists(codelists) == fct.codelists(make_response(STRUCTURE_XML))
+    assert fct.dataflows(dataflows) == fct.dataflows(make_response(STRUCTURE_XML))
+    assert len(fct.observations(data)) == 6
+    assert isinstance(missing, RequestException)
+    assert missing.response.status_code == 404
+    assert (retry.metrics["requests"], retry.metrics["statuses"]) == (5, {"503": 1})
+    assert "structurespecificdata" in accepts["/data/dataflow/OECD/DF/1.0/A?c=1"]
+
+
+def test_extract_parallel():
+    import parallel
+    from sdmx_fixtures import codelists_xml
+
+    content = codelists_xml(6, 4)
+    assert len(parallel.split(content, "Codelist", 4)) == 3
+    assert parallel.split(content, "Dataflow", 4) == []
+    quoted = STRUCTURE_XML.replace(
+        b'<structure:Codelist id="CL_AREA"',
+        b'<!-- <structure:Codelist> --><structure:Codelist id="CL_AREA" urn="a>b/>c"',
+    )
+    pieces = parallel.split(quoted, "Codelist", 4)
+    assert len(pieces) == 2 and b'urn="a>b/>c"' in pieces[0]
+    assert parallel.extract_parallel(
+        make_response(quoted, stream=True), fct.codelists, 2
+    ) == fct.codelists(make_response(quoted))
+    for content, extractor in (
+        (content, fct.codelists),
+        (STRUCTURE_XML, fct.dataflows),
+        (data_xml(5, 3), fct.observations),
+    ):
+        expected = extractor(make_response(content))
+        streamed = make_response(content, stream=True)
+        assert parallel.extract_parallel(streamed, extractor, 2) == expected
+        with pytest.raises(StreamConsumedError):
+            parallel.extract_parallel(streamed, extractor, 2)
+    expected = fct.observations(make_response(data_xml(5, 3)))
+    for format, (build, content_type) in FORMAT_FIXTURES.items():
+        response = make_response(build(5, 3), content_type=content_type)
+        assert parallel.extract_parallel(response, fct.observations, 2) == expected
+
+
+def test_parser_backends():
+    import parsers
+
+    pytest.importorskip("lxml")
+
+    assert set(parsers.BACKENDS) == {"stdlib", "lxml"}
+    with pytest.raises(ValueError):
+        parsers.backend("sax")
+    for stream in (False, True):
+        for extractor, content in (
+            (fct.dataflows, STRUCTURE_XML),
+            (fct.codelists, STRUCTURE_XML),
+            (fct.observations, data_xml(3, 4)),
+        ):
+            assert extractor(
+                make_response(content, stream, parser="lxml")
+            ) == extractor(make_response(content, stream, parser="stdlib"))
+    lxml_response = make_response(STRUCTURE_XML, parser="lxml")
+    assert (
+        lxml_response.printable_hierarchy()
+        == make_response(STRUCTURE_XML, parser="stdlib").printable_hierarchy()
+    )
+    deep = ("<a>" * 3000 + "</a>" * 3000).encode()
+    assert make_response(deep, parser="lxml").parser.name == "stdlib"
+    assert lxml_response.path("codes") is lxml_response.path("codes")
+
+
+def test_sync(tmp_path, monkeypatch):
+    import sync
+    from sdmx_fixtures import structure_message
+
+    def codelist(id_: str, version: str, codes: dict) -> str:
+        return (
+            f'<structure:Codelist id="{id_}" agencyID="OECD" version="{version}">'
+            '<common:Name xml:lang="en">Codelist</common:Name>'
+            + "".join(
+                f'<structure:Code id="{code}"><common:Name xml:lang="en">{name}</common:Name></structure:Code>'
+                for code, name in codes.items()
+            )
+            + "</structure:Codelist>"
+        )
+
+    def publish(server: StubServer, codelists: dict) -> None:
+        stubs = "".join(
+            codelist(id_, version, {}) for id_, (version, _) in codelists.items()
+        )
+        server.add(
+            "/structure/codelist/*/*/~?detail=allstubs", structure_message(stubs)
+        )
+        for id_, (version, codes) in codelists.items():
+            server.add(
+                f"/structure/codelist/OECD/{id_}/{version}",
+                structure_message(codelist(id_, version, codes)),
+            )
+
+    manifest = sync.SyncManifest(str(tmp_path / "sync_manifest.db"))
+    with StubServer() as server:
+        publish(
+            server,
+            {
+                "CL_AREA": ("1.0", {"AUS": "Australia", "ATL": "Atlantis"}),
+                "CL_FREQ": ("1.0", {"A": "Annual"}),
+                "CL_OLD": ("1.0", {"X": "Old"}),
+            },
+        )
+        changes = sync.sync("codelist", manifest, url_root=server.url)
+        assert sorted((c["id"], c["key"], c["action"]) for c in changes) == [
+            ("CL_AREA", "ATL", "added"),
+            ("CL_AREA", "AUS", "added"),
+            ("CL_FREQ", "A", "added"),
+            ("CL_OLD", "X", "added"),
+        ]
+        assert sync.sync("codelist", manifest, url_root=server.url) == []
+        assert len(server.requests) == 5
+
+        publish(
+            server,
+            {
+                "CL_AREA": (
+                    "1.1",
+                    {"AUS": "Australia", "DEU": "Germany", "ATL": "Atlantida"},
+                ),
+                "CL_FREQ": ("1.0", {"A": "Annual"}),
+            },
+        )
+        del server.requests[:]
+        changes = sync.sync("codelist", manifest, url_root=server.url)
+        assert [r["path"] for r in server.requests] == [
+            "/structure/codelist/*/*/~?detail=allstubs",
+            "/structure/codelist/OECD/CL_AREA/1.1",
+        ]
+    assert sorted((c["id"], c["key"], c["action"]) for c in changes) == [
+        ("CL_AREA", "ATL", "modified"),
+        ("CL_AREA", "DEU", "added"),
+        ("CL_OLD", "X", "removed"),
+    ]
+    assert manifest.artefacts("codelist").keys() == {
+        ("OECD", "CL_AREA"),
+        ("OECD", "CL_FREQ"),
+    }
+
+    loader = DatabaseLoader(str(tmp_path / "Macro.db"))
+    loader.upsert_dimension("subjects", [("Atlantis",), ("Australia",)])
+    assert (
+        loader.apply_changes(changes, {("OECD", "CL_AREA"): ("subjects", "name")}) == 1
+    )
+    assert loader.dimension_ids("subjects") == {("Atlantida",): 1, ("Australia",): 2}
+
+    def extracted(response):
+        calls.append(response)
+        return fct.codelists(response)
+
+    calls = []
+    monkeypatch.setitem(
+        sync.ARTEFACT_TYPES, "codelist", ("Codelist", extracted, "code_id")
+    )
+    cache = ResponseCache(str(tmp_path / "cache.db"), ttl=0)
+    with StubServer() as server:
+        publish(server, {"CL_FREQ": ("1.0", {"A": "Annual"})})
+        for _ in range(2):
+            sync.sync("codelist", manifest, cache, url_root=server.url, revalidate=True)
+    assert len(calls) == 1
+    cache.close()
+    manifest.close()
+
+    args = ["dataflow", "OECD", "DF", "1.0", "A..", "c[TIME_PERIOD]=ge:2000"]
+    assert sync.updated_after(["data", *args], None) == ["data", *args]
+    assert sync.updated_after(["data", *args], 0)[-1] == (
+        "c[TIME_PERIOD]=ge:2000&updatedAfter=1970-01-01T00:00:00Z"
+    )
+
+
+def test_records():
+    import pickle
+
+    codes = fct.codelists(make_response(STRUCTURE_XML))
+    assert codes[0] == {
+        "agency_id": "OECD",
+        "codelist_id": "CL_AREA",
+        "codelist_name": "Australia",
+        "code_id": "AUS",
+        "code_name": "Australia",
+        "code_parent": "None",
+    }
+    assert list(codes[3]) == fct.CODELIST_FIELDS
+    assert codes[0].codelist is codes[1].codelist
+    assert not hasattr(codes[0], "__dict__")
+    with pytest.raises(KeyError):
+        codes[0]["codelist"]
+    copies = pickle.loads(pickle.dumps(codes))
+    assert copies == codes and copies[0].codelist is copies[1].codelist
+    dataflows = fct.dataflows(make_response(STRUCTURE_XML))
+    assert dict(dataflows[1]) == {
+        "dataflow_id": "DF_EMPTY",
+        "agency_id": "OECD",
+        "dataflow_name": "Empty",
+        "reference_id": "None",
+        "reference_agencyID": "None",
+        "reference_class": "None",
+    }
+    assert json.loads(json.dumps(dict(dataflows[0])))["reference_class"] == (
+        "DataStructure"
+    )
+
+
+def test_languages(tmp_path):
+    from CustomSession import accept_language
+
+    response = make_response(STRUCTURE_XML)
+    assert fct.dataflows(response) == fct.dataflows(response, ("en",))
+    dataflows = fct.dataflows(response, ("fr", "en"))
+    assert [d["dataflow_name"] for d in dataflows] == ["Agr\xe9gats", "Empty"]
+    assert dict(dataflows[1])["dataflow_name_fr"] == ""
+    assert dataflows[0]["dataflow_name_en"] == "National accounts aggregates"
+    assert list(dataflows[0])[-2:] == ["dataflow_name_fr", "dataflow_name_en"]
+    codes = fct.codelists(response, ("de", "en"))
+    assert codes[3]["code_name"] == codes[3]["code_name_en"] == "Value added"
+    assert codes[3]["code_name_de"] == "" and codes[3].codelist.names["en"] == (
+        "Transaction"
+    )
+
+    assert accept_language(("fr", "en", "de")) == "fr, en;q=0.9, de;q=0.8"
+    with StubServer() as server:
+        server.add("/structure/dataflow", STRUCTURE_XML, etag='"v1"')
+        cache = ResponseCache(str(tmp_path / "cache.db"))
+        english = CustomSession(["structure", "dataflow"], cache, server.url).get()
+        session = CustomSession(
+            ["structure", "dataflow"], cache, server.url, languages=("fr", "en")
+        )
+        french = session.get()
+        assert server.requests[-1]["headers"]["Accept-Language"] == "fr, en;q=0.9"
+        assert len(server.requests) == 2
+        assert french.cache_key != english.cache_key
+    assert fct.dataflows(french)[0]["dataflow_name"] == "Agr\xe9gats"
+    path = str(tmp_path / "dataflows.csv")
+    fct.output_dataflows(fct.dataflows(french), path, languages=french.languages)
+    with open(path, encoding="utf-8") as file:
+        assert file.readline().strip().endswith("dataflow_name_fr,dataflow_name_en")
+
+
+def test_formats(tmp_path):
+    from CustomSession import media_type
+    from sdmx_fixtures import (
+        codelists_json,
+        codelists_xml,
+        dataflows_json,
+        dataflows_xml,
+    )
+
+    expected = fct.observations(make_response(data_xml(12, 5)))
+    for format, (build, content_type) in FORMAT_FIXTURES.items():
+        for stream in (False, True):
+            response = make_response(build(12, 5), stream, content_type)
+            assert response.format == format
+            assert fct.observations(response) == expected
+    build, content_type = FORMAT_FIXTURES["json"]
+    message = json.loads(build(12, 5))
+    message["data"] = dict(reversed(message["data"].items()))
+    assert list(message["data"])[0] == "dataSets"
+    for stream in (False, True):
+        response = make_response(json.dumps(message).encode(), stream, content_type)
+        assert fct.observations(response) == expected
+    message["data"]["structures"] *= 2
+    for stream in (False, True):
+        response = make_response(json.dumps(message).encode(), stream, content_type)
+        with pytest.raises(ValueError):
+            fct.observations(response)
+    build, content_type = FORMAT_FIXTURES["csv"]
+    lines = build(12, 5).split(b"\r\n")
+    lines[1] = lines[1].rpartition(b",")[0].rpartition(b",")[0]
+    short = fct.observations(
+        make_response(b"\r\n".join(lines), content_type=content_type)
+    )
+    assert short[1:] == expected[1:]
+    assert "OBS_STATUS" not in short[0] and "UNIT_MULT" not in short[0]
+    columns = fct.observation_columns(make_response(build(12, 5), False, content_type))
+    assert list(columns.rows()) == list(
+        fct.observation_columns(make_response(data_xml(12, 5))).rows()
+    )
+
+    structure = "application/vnd.sdmx.structure+json; version=2.0.0"
+    for languages in (("en",), ("fr", "en")):
+        assert fct.codelists(
+            make_response(codelists_json(3, 4), True, structure), languages
+        ) == fct.codelists(make_response(codelists_xml(3, 4)), languages)
+        assert fct.dataflows(
+            make_response(dataflows_json(5), False, structure), languages
+        ) == fct.dataflows(make_response(dataflows_xml(5)), languages)
+    with pytest.raises(ValueError):
+        fct.codelists(make_response(b"", content_type="application/vnd.sdmx.data+csv"))
+    with pytest.raises(RequestException):
+        media_type("structure", "csv")
+
+    build, content_type = FORMAT_FIXTURES["json"]
+    content = build(12, 5)
+    with StubServer() as server:
+        server.add(
+            "/data/dataflow/OECD/DF/1.0/A?c=1",
+            content,
+            headers={"Content-Type": content_type},
+        )
+        session = CustomSession(
+            ["data", "dataflow", "OECD", "DF", "1.0", "A", "c=1"],
+            ResponseCache(str(tmp_path / "cache.db")),
+            server.url,
+            format="json",
+        )
+        response = session.get()
+        assert server.requests[-1]["headers"]["Accept"] == media_type("data", "json")
+        assert fct.observations(response) == expected
+        assert fct.observations(session.get(stream=True)) == expected
+
+
+def test_spooled_response(tmp_path, monkeypatch):
+    import gzip
+    import parallel
+    from CustomResponse import CustomResponse
+
+    monkeypatch.chdir(tmp_path)
+    expected = fct.observations(make_response(data_xml(12, 5)))
+    build, content_type = FORMAT_FIXTURES["csv"]
+    with StubServer() as server:
+        server.add(
+            "/data/dataflow/OECD/DF/1.0/A?c=1",
+            gzip.compress(data_xml(12, 5)),
+            headers={"Content-Encoding": "gzip"},
+        )
+        server.add(
+            "/data/dataflow/OECD/DF/1.0/B?c=1",
+            build(12, 5),
+            headers={"Content-Type": content_type},
+        )
+        cache = ResponseCache(str(tmp_path / "cache.db"))
+        session = CustomSession(
+            ["data", "dataflow", "OECD", "DF", "1.0", "A", "c=1"], cache, server.url
+        )
+        response = session.get(spool=str(tmp_path))
+        csv_response = CustomSession(
+            ["data", "dataflow", "OECD", "DF", "1.0", "B", "c=1"],
+            url_root=server.url,
+            format="csv",
+        ).get(spool=str(tmp_path))
+    assert response.spool.endswith(".xml") and response.cache_key is None
+    assert cache.lookup(session.url, session.headers["Accept"]) is None
+    assert response.content == data_xml(12, 5)
+    assert fct.observations(response) == expected
+    assert fct.observations(response) == expected
+    assert parallel.extract_parallel(response, fct.observations, 2) == expected
+    response.output_hierarchy()
+    assert (tmp_path / "hierarchy.txt").stat().st_size > 0
+
+    respooled = CustomResponse.from_spool(response.spool)
+    assert respooled.format == "xml" and fct.observations(respooled) == expected
+    assert csv_response.spool.endswith(".csv")
+    assert fct.observations(csv_response) == expected
+    assert fct.observations(CustomResponse.from_spool(csv_response.spool)) == expected
+
+    import spooling
+    import zlib
+
+    content = data_xml(12, 5)
+    raw = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    for encoding, body in [
+        ("gzip", gzip.compress(content)),
+        ("deflate", zlib.compress(content)),
+        ("deflate", raw.compress(content) + raw.flush()),
+    ]:
+        (tmp_path / "body.part").write_bytes(body)
+        spooling.decode(
+            str(tmp_path / "body.part"), str(tmp_path / "body.xml"), encoding
+        )
+        assert (tmp_path / "body.xml").read_bytes() == content
+    for encoding, body in [("gzip", gzip.compress(content)[:-100]), ("br", b"...")]:
+        (tmp_path / "body.part").write_bytes(body)
+        with pytest.raises(ValueError):
+            spooling.decode(
+                str(tmp_path / "body.part"), str(tmp_path / "truncated.xml"), encoding
+            )
+        assert (tmp_path / "body.part").exists()
+        assert not (tmp_path / "truncated.xml").exists()
+
+
+def test_job_ledger(tmp_path):
+    import gzip
+    import os
+    from JobLedger import JobLedger
+
+    ledger = JobLedger(str(tmp_path / "job_ledger.db"))
+    manifest = [
+        ("dataflow", "OECD", "DF_A", "1.0", "A", "c=1"),
+        ("dataflow", "OECD", "DF_B", "1.0", "A", "c=1"),
+        ("dataflow", "OECD", "DF_C", "1.0", "A", "c=1"),
+    ]
+    body = gzip.compress(data_xml(20, 10))
+    with StubServer() as server:
+        server.add("/data/dataflow/OECD/DF_A/1.0/A?c=1", data_xml(2, 3))
+        server.add(
+            "/data/dataflow/OECD/DF_B/1.0/A?c=1",
+            body,
+            etag='"v1"',
+            headers={"Content-Encoding": "gzip"},
+            ranges=True,
+            drops=[len(body) // 2],
+        )
+        options = {"output_dir": str(tmp_path), "url_root": server.url}
+        results = batch.run_batch(manifest, ledger=ledger, job="nightly", **options)
+        assert [r["status"][:6] for r in results] == ["OK", "Failed", "Failed"]
+        assert sorted(t["status"] for t in ledger.tasks("nightly")) == [
+            "done",
+            "partial",
+        ]
+
+        server.add("/data/dataflow/OECD/DF_C/1.0/A?c=1", data_xml(2, 3))
+        server.requests.clear()
+        results = batch.run_batch(manifest, ledger=ledger, job="nightly", **options)
+        assert [r["status"] for r in results] == ["Skipped (done)", "OK", "OK"]
+        resumed = [r for r in server.requests if "DF_B" in r["path"]][0]
+        assert resumed["headers"]["Range"] == f"bytes={len(body) // 2}-"
+        assert resumed["headers"]["If-Range"] == '"v1"'
+        assert len(server.requests) == 2
+    assert ledger.tasks("nightly") == []
+    assert sorted(p.name for p in (tmp_path / "001_DF_B").iterdir()) == [
+        "hierarchy.txt"
+    ]
+
+    path = "/data/dataflow/OECD/DF_D/1.0/A?c=1"
+    directory = tmp_path / "000_DF_D"
+    manifest = [("dataflow", "OECD", "DF_D", "1.0", "A", "c=1")]
+    gzipped = {"headers": {"Content-Encoding": "gzip"}, "ranges": True}
+    with StubServer() as server:
+        options = {"output_dir": str(tmp_path), "url_root": server.url}
+        server.add(path, body, etag='"v1"', drops=[len(body) // 2], **gzipped)
+        batch.run_batch(manifest, ledger=ledger, job="resync", **options)
+        server.add(path, body, etag='"v2"', drops=[len(body) // 4], **gzipped)
+        batch.run_batch(manifest, ledger=ledger, job="resync", **options)
+        assert server.requests[-1]["headers"]["If-Range"] == '"v1"'
+        (part,) = directory.glob("*.part")
+        assert part.stat().st_size == len(body) // 4
+        server.add(
+            path,
+            body,
+            etag='"v2"',
+            script=[(206, {"Content-Range": f"bytes 0-9/{len(body)}"})],
+            **gzipped,
+        )
+        (result,) = batch.run_batch(manifest, ledger=ledger, job="resync", **options)
+        assert result["status"] == "OK"
+        assert "Range" not in server.requests[-1]["headers"]
+    assert sorted(p.name for p in directory.iterdir()) == ["hierarchy.txt"]
+
+    path = "/data/dataflow/OECD/DF_E/1.0/A?c=1"
+    manifest = [("dataflow", "OECD", "DF_E", "1.0", "A", "c=1")]
+    with StubServer() as server:
+        options = {"output_dir": str(tmp_path), "url_root": server.url}
+        server.add(path, body, etag='"v1"', drops=[0], **gzipped)
+        (result,) = batch.run_batch(manifest, ledger=ledger, job="empty", **options)
+        assert result["status"].startswith("Failed")
+        (task,) = ledger.tasks("empty")
+        assert task["validator"] == '"v1"'
+        assert os.path.getsize(task["path"]) == 0
+        (result,) = batch.run_batch(manifest, ledger=ledger, job="empty", **options)
+        assert result["status"] == "OK"
+        assert "Range" not in server.requests[-1]["headers"]
+
+    root = "/data/dataflow/OECD/DF/1.0/A.AUS+AUT"
+    args = ["data", "dataflow", "OECD", "DF", "1.0", "A.AUS+AUT"]
+    with StubServer() as server:
+        server.add(f"{root}?c[TIME_PERIOD]=ge:2000+le:2002", data_xml(2, 3, 2000))
+        server.add(
+            f"{root}?c[TIME_PERIOD]=ge:2003+le:2003",
+            data_xml(2, 3, 2003),
+            drops=[100],
+        )
+        session = CustomSession(
+            args + ["c[TIME_PERIOD]=ge:2000+le:2003"], url_root=server.url
+        )
+        options = {"years": 3, "target_bytes": 1e9, "max_workers": 1}
+        with pytest.raises(RequestException):
+            session.get_chunked(ledger=ledger, directory=str(tmp_path), **options)
+        assert len(ledger.tasks(session.url, "downloaded")) == 1
+        server.requests.clear()
+        observations = session.get_chunked(
+            ledger=ledger, directory=str(tmp_path), **options
+        )
+        assert [r["path"] for r in server.requests] == [
+            f"{root}?c[TIME_PERIOD]=ge:2003+le:2003"
+        ]
+    assert len(observations) == 12
+    assert ledger.tasks(session.url) == []
+    assert chunking.next_window(2000, 3, 2005, [(2003, 2005)]) == (2000, 2002)
+    assert chunking.next_window(2000, 3, 2005, [(2000, 2001), (2002, 2002)]) == (
+        2003,
+        2005,
+    )
+
+
+def test_daemon(tmp_path):
+    import daemon
+    import http.client
+    import sdmx_client
+    import threading
+
+    with StubServer() as server:
+        server.add("/structure/dataflow", STRUCTURE_XML)
+        query_daemon = daemon.QueryDaemon(
+            ResponseCache(str(tmp_path / "cache.db")), server.url
+        )
+        httpd = daemon.serve(query_daemon, port=0)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        port = httpd.server_address[1]
+        try:
+            reports = [
+                sdmx_client.send_query(
+                    ["structure", "dataflow"], cwd=str(tmp_path), port=port
+                )
+                for _ in range(3)
+            ]
+            assert [report["served"] for _, report in reports] == [
+                "network",
+                "warm",
+                "warm",
+            ]
+            assert len(server.requests) == 1
+            status, report = sdmx_client.send_query(
+                ["structure"], cwd=str(tmp_path), port=port
+            )
+            assert status == 400 and report["status"] == "Failed"
+            status, report = sdmx_client.send_query(
+                ["structure", "codelist"], cwd=str(tmp_path), port=port
+            )
+            assert status == 502 and "404" in report["error"]
+            status, report = sdmx_client.send_query(
+                ["structure", "dataflow"], cwd=str(tmp_path / "missing"), port=port
+            )
+            assert status == 500 and "FileNotFoundError" in report["error"]
+            for headers, expected in [
+                ({"Host": "attacker.example", "Content-Type": "application/json"}, 403),
+                ({"Content-Type": "text/plain"}, 415),
+            ]:
+                connection = http.client.HTTPConnection("127.0.0.1", port)
+                connection.request("POST", "/query", b"{}", headers)
+                assert connection.getresponse().status == expected
+                connection.close()
+            assert query_daemon.health()["served"] == {
+                "warm": 3,
+                "cache": 0,
+                "network": 1,
+                "failed": 1,
+            }
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            query_daemon.close()
+    dataflows = (tmp_path / "dataflows.txt").read_text()
+    fct.output_dataflows(
+        fct.dataflows(make_response(STRUCTURE_XML)), str(tmp_path / "expected.txt")
+    )
+    assert dataflows == (tmp_path / "expected.txt").read_text()
+    assert (tmp_path / "hierarchy.txt").exists()
+
+
+def test_lazy_imports():
+    import subprocess
+    import sys
+
+    options = main.parse(
+        ["--languages=fr,en", "-s", "structure", "dataflow", "--profile"]
+    )
+    assert (options.mode, options.args) == ("shell", ["structure", "dataflow"])
+    assert options.languages == ("fr", "en") and options.profile
+    for argv, message in [
+        (["--shell", "data"], "For data queries, 6 more arguments needed"),
+        (["-s", "spam", "eggs"], 'Supported query types: "structure" and "data"'),
+        (["--batch"], "Batch mode requires one more argument"),
+        (["-i", "-s"], "Choose mode among"),
+        (["--help"], "usage: main.py"),
+    ]:
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "main.py"] + argv,
+            capture_output=True,
+            text=True,
+        )
+        assert message in process.stdout + process.stderr
+        imported = {
+            line.split("|")[-1].strip()
+            for line in process.stderr.splitlines()
+            if line.startswith("import time:")
+        }
+        assert not imported & {"requests", "CustomSession", "tabulate", "sqlite3"}